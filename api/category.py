@@ -48,6 +48,22 @@ class AdminCategoryResource(Resource):
     @handle_exceptions
     def get(self): # Get all categories               
         page = request.args.get('page', 1, type=int) # Get the page number from the query string
+        cursor = request.args.get('cursor', type=str) # Get the cursor from the query string, an empty cursor is the first page
+        include_total = request.args.get('include_total', 'false').lower() == 'true' # Only count the categories if asked to
+
+        # Use cursor pagination if a cursor is provided
+        if cursor is not None:
+            results = CategoryService.get_all_admin_categories_by_cursor(cursor, per_page=10, include_total=include_total)
+
+            response = {
+                'categories': marshal(results['categories'], category_model),
+                'next_cursor': results['next_cursor']
+            }
+
+            if include_total:
+                response['total_categories'] = results['total_categories']
+
+            return response, 200
 
         results = CategoryService.get_all_admin_categories(page) 
 
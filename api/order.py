@@ -5,7 +5,7 @@ from decorators import admin_required
 from services.order_service import OrderService
 from decorators import handle_exceptions, customer_required
 from models import User
-from services.utils import stripe_webhook_handler
+from services.webhook_service import WebhookService
 import stripe
 
 order_ns = Namespace('order', description='Order operations')
@@ -95,6 +95,22 @@ class AdminOrderResource(Resource):
     def get(self): # Get all customer orders        
         page = request.args.get('page', 1, type=int) # Get the page number from the query string
         status = request.args.get('status', type=str) # Get the status from the query string
+        cursor = request.args.get('cursor', type=str) # Get the cursor from the query string, an empty cursor is the first page
+        include_total = request.args.get('include_total', 'false').lower() == 'true' # Only count the orders if asked to
+
+        # Use cursor pagination if a cursor is provided
+        if cursor is not None:
+            results = OrderService.get_all_customer_orders_by_cursor(cursor, per_page=10, status=status, include_total=include_total)
+
+            response = {
+                'orders': marshal(results['orders'], order_admin_model),
+                'next_cursor': results['next_cursor']
+            }
+
+            if include_total:
+                response['total_orders'] = results['total_orders']
+
+            return response, 200
 
         results = OrderService.get_all_customer_orders(page, per_page=10, status=status)        
         
@@ -153,14 +169,10 @@ class OrderResource(Resource):
         payload = request.get_data(as_text=True)
         sig_header = request.headers.get('Stripe-Signature')
 
-        order_data = stripe_webhook_handler(payload, sig_header)
+        # Store the event and answer Stripe straight away, the event is handled by the Celery worker
+        response = WebhookService.receive_event(payload, sig_header)
 
-        if order_data:
-            response = OrderService.create_order(order_data)
-        else:
-            return {'message': 'Webhook received but no order data processed'}, 200
-        
-        return marshal(response, order_model), 200
+        return response, 200
     
 @order_ns.route('/stripe_session_status', methods=['GET'])
 class OrderResource(Resource):
@@ -35,6 +35,23 @@ product_admin_model = product_ns.model('ProductAdmin', {
     'reserved_stock': fields.Integer(required=True),
 })
 
+product_search_facet_model = product_ns.model('ProductSearchFacet', {
+    'category_id': fields.Integer(required=True),
+    'category_name': fields.String(required=True),
+    'product_count': fields.Integer(required=True),
+})
+
+product_price_facet_model = product_ns.model('ProductPriceFacet', {
+    'min_price': fields.Float(required=False), # No minimum for the lowest range
+    'max_price': fields.Float(required=False), # No maximum for the highest range
+    'product_count': fields.Integer(required=True),
+})
+
+product_suggestion_model = product_ns.model('ProductSuggestion', {
+    'id': fields.Integer(required=True),
+    'name': fields.String(required=True),
+})
+
 featured_product_model = product_ns.model('FeaturedProduct', {
     'id': fields.Integer(required=True),
     'product_id': fields.Integer(required=True),
@@ -42,6 +59,9 @@ featured_product_model = product_ns.model('FeaturedProduct', {
 
 product_image_model = product_ns.model('ProductImage', {
     'image_path': fields.String(required=True),
+    'thumbnail_path': fields.String(required=False),
+    'thumbnail_avif_path': fields.String(required=False),
+    'webp_path': fields.String(required=False),
     'product_id': fields.Integer(required=True),
 })
 
@@ -51,11 +71,19 @@ class ProductResource(Resource):
     @handle_exceptions
     def get(self): # Get all products
         page = request.args.get('page', 1, type=int) # Get the page number from the query string
-        category_id = request.args.get('category_id', type=int) # Get the category id from the query string
+        category_ids = sorted(set(request.args.getlist('category_id', type=int))) # Get the category ids from the query string, the parameter can be repeated
         sort_by = request.args.get('sort_by', type=str) # Get the sort by value from the query string
+        min_price = request.args.get('min_price', type=float) # Get the price range from the query string
+        max_price = request.args.get('max_price', type=float)
+        in_stock_only = request.args.get('in_stock_only', 'true').lower() == 'true' # Only show the products in stock unless asked not to
+        include_facets = request.args.get('include_facets', 'false').lower() == 'true' # Only count the facets if asked to
+
+        # A single category id is passed as is, so the listing shares its cache entry with the unfiltered category listing
+        category_id = category_ids[0] if len(category_ids) == 1 else category_ids or None
+        filters = {'category_id': category_id, 'min_price': min_price, 'max_price': max_price, 'in_stock_only': in_stock_only}
+
+        results = ProductService.get_all_products(page, per_page=9, sort_by=sort_by, **filters)
 
-        results = ProductService.get_all_products(page, per_page=9, category_id=category_id, sort_by=sort_by)        
-        
         response = {
             'products': marshal(results['products'], product_shop_model),
             'total_pages': results['total_pages'],
@@ -63,8 +91,60 @@ class ProductResource(Resource):
             'total_products': results['total_products']
         }
 
+        # The facets are cached per filter, so paging or sorting the listing doesn't count them again
+        if include_facets:
+            facets = ProductService.get_product_facets(**filters)
+
+            response['facets'] = {
+                'categories': marshal(facets['categories'], product_search_facet_model),
+                'price_ranges': marshal(facets['price_ranges'], product_price_facet_model),
+                'in_stock_count': facets['in_stock_count']
+            }
+
         return response, 200
         
+@product_ns.route('/search', methods=['GET'])
+class ProductSearchResource(Resource):
+    @handle_exceptions
+    def get(self): # Search the products in stock
+        query = request.args.get('q', type=str) # Get the search query from the query string
+        page = request.args.get('page', 1, type=int) # Get the page number from the query string
+        category_id = request.args.get('category_id', type=int) # Get the category id from the query string
+
+        results = ProductService.search_products(query, page, per_page=9, category_id=category_id)
+
+        response = {
+            'products': marshal(results['products'], product_shop_model),
+            'facets': marshal(results['facets'], product_search_facet_model),
+            'total_pages': results['total_pages'],
+            'current_page': results['current_page'],
+            'total_products': results['total_products']
+        }
+
+        return response, 200
+
+@product_ns.route('/search/autocomplete', methods=['GET'])
+class ProductAutocompleteResource(Resource):
+    @handle_exceptions
+    def get(self): # Suggest product names for a partly typed, possibly misspelt, search
+        query = request.args.get('q', type=str) # Get the search query from the query string
+        limit = request.args.get('limit', 5, type=int) # Get the number of suggestions from the query string
+
+        suggestions = ProductService.autocomplete_products(query, limit)
+
+        return marshal(suggestions, product_suggestion_model), 200
+
+@product_ns.route('/suggest', methods=['GET'])
+class ProductSuggestResource(Resource):
+    @handle_exceptions
+    def get(self): # Suggest product names for a partly typed, possibly misspelt, name
+        query = request.args.get('q', type=str) # Get the typed name from the query string
+        limit = request.args.get('limit', 5, type=int) # Get the number of suggestions from the query string
+
+        suggestions = ProductService.autocomplete_products(query, limit)
+
+        return marshal(suggestions, product_suggestion_model), 200
+
 @product_ns.route('/<int:product_id>', methods=['GET'])
 class ProductResource(Resource):
     @handle_exceptions
@@ -109,6 +189,22 @@ class AdminProductResource(Resource):
     def get(self): # Get all products for admin
         page = request.args.get('page', 1, type=int) # Get the page number from the query string
         category_id = request.args.get('category_id', type=int) # Get the category id from the query string
+        cursor = request.args.get('cursor', type=str) # Get the cursor from the query string, an empty cursor is the first page
+        include_total = request.args.get('include_total', 'false').lower() == 'true' # Only count the products if asked to
+
+        # Use cursor pagination if a cursor is provided
+        if cursor is not None:
+            results = ProductService.get_all_admin_products_by_cursor(cursor, per_page=10, category_id=category_id, include_total=include_total)
+
+            response = {
+                'products': marshal(results['products'], product_admin_model),
+                'next_cursor': results['next_cursor']
+            }
+
+            if include_total:
+                response['total_products'] = results['total_products']
+
+            return response, 200
 
         results = ProductService.get_all_admin_products(page, per_page=10, category_id=category_id)
 
@@ -187,6 +283,30 @@ class AdminProductImageResource(Resource):
         
         return {'message': 'Product image created successfully'}, 201
 
+@product_ns.route('/admin/product-image/<int:product_id>/upload-url', methods=['POST'])
+class AdminProductImageUploadUrlResource(Resource):
+    @jwt_required()
+    @admin_required()
+    @handle_exceptions
+    def post(self, product_id): # Get a signed URL for the browser to upload a product image straight to the bucket
+        data = request.get_json()
+
+        response = ProductImageService.create_product_image_upload_url(data, product_id)
+
+        return response, 200
+
+@product_ns.route('/admin/product-image/<int:product_id>/confirm', methods=['POST'])
+class AdminProductImageConfirmResource(Resource):
+    @jwt_required()
+    @admin_required()
+    @handle_exceptions
+    def post(self, product_id): # Add a product image uploaded with a signed URL
+        data = request.get_json()
+
+        ProductImageService.confirm_product_image_upload(data, product_id)
+
+        return {'message': 'Product image created successfully'}, 201
+
 # @product_ns.route('/admin/product-image/<int:product_image_id>', methods=['DELETE'])
 # class AdminProductImageResource(Resource):
 #     @jwt_required()
@@ -172,6 +172,22 @@ class AdminResource(Resource):
     @handle_exceptions
     def get(self): # Get all users
         page = request.args.get('page', 1, type=int)
+        cursor = request.args.get('cursor', type=str) # Get the cursor from the query string, an empty cursor is the first page
+        include_total = request.args.get('include_total', 'false').lower() == 'true' # Only count the users if asked to
+
+        # Use cursor pagination if a cursor is provided
+        if cursor is not None:
+            results = UserService.get_all_admin_users_by_cursor(cursor, per_page=10, include_total=include_total)
+
+            response = {
+                'users': marshal(results['users'], user_admin_model),
+                'next_cursor': results['next_cursor']
+            }
+
+            if include_total:
+                response['total_users'] = results['total_users']
+
+            return response, 200
 
         results = UserService.get_all_admin_users(page)
 
@@ -0,0 +1,22 @@
+import os
+from config import Config, database_engine_options
+
+# Configuration class for the benchmarks
+class Benchmark(Config):
+    SQLALCHEMY_DATABASE_URI = os.getenv('BENCHMARK_DATABASE_URI')
+    CACHE_TYPE = 'SimpleCache' # Use an in-memory cache so Redis isn't required
+    CACHE_LOCAL_ENABLED = False # There is no Redis to publish invalidations
+    CACHE_THRESHOLD = 100000 # Hold the whole working set like Redis would, the default of 500 entries prunes the cache
+    CACHE_REDIS_URL = os.getenv('BENCHMARK_REDIS_URL', 'redis://localhost:6379/0') # Only used by the rate limiter, the benchmarks don't connect to it
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 32)),
+        'max_overflow': 0,
+    }
+
+# Configuration of the app served by Gunicorn in the load test. Stripe, Mailgun and Google Cloud Storage are local stubs
+# started by the load test, which passes their URLs in MAILGUN_API_BASE_URL, GOOGLE_CLOUD_STORAGE_API_ENDPOINT and STRIPE_API_BASE
+class LoadTest(Benchmark):
+    CACHE_TYPE = 'RedisCache' if os.getenv('LOAD_TEST_CACHE') == 'redis' else 'SimpleCache' # SimpleCache is per Gunicorn worker, Redis is shared like production
+    CACHE_LOCAL_ENABLED = os.getenv('LOAD_TEST_CACHE') == 'redis'
+    CELERY_TASK_ALWAYS_EAGER = True # There is no Celery worker, nothing queued by the benchmarked routes is slow
+    SQLALCHEMY_ENGINE_OPTIONS = database_engine_options('backend') # The pool of a Gunicorn worker in production
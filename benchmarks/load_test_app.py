@@ -0,0 +1,15 @@
+# App served by Gunicorn in the load test, see benchmarks/load_test.py
+import os
+from main import create_app
+from benchmarks.config import LoadTest
+import exts
+import stripe
+
+app = create_app(LoadTest)
+
+# Send the Stripe requests to the stub
+stripe.api_base = os.getenv('STRIPE_API_BASE')
+
+# Without Redis there are no other processes to tell about cache invalidations
+if os.getenv('LOAD_TEST_CACHE') != 'redis':
+    exts.redis_client = None
@@ -0,0 +1,335 @@
+from collections import Counter
+from functools import wraps
+import hashlib
+import inspect
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from cachetools import TTLCache
+from flask import current_app
+import redis
+import exts
+from exts import cache
+from instrumentation import record_cache_result
+
+# Tagged caching
+#
+# Every cached entry records the generation token of each tag it depends on (e.g. 'products', 'category:3', 'product:12').
+# Writes invalidate only the tags they affect by giving those tags a new generation token, entries holding an old token
+# are treated as a miss and are left to expire. This replaces delete_memoized, which wiped every variant of a function.
+
+# Generation tokens never expire, if a token is evicted a new one is created which only causes a cache miss.
+# Random tokens are used rather than counters so an evicted tag can never come back with an old generation
+GENERATION_TIMEOUT = 0
+
+# Local hit, hit, miss and stale counts per cached function
+cache_stats = Counter()
+
+def count_cache_result(name, result):
+    cache_stats[f'{name}:{result}'] += 1
+    record_cache_result(name, result)
+
+# Two-tier caching
+#
+# Functions cached with local=True are also kept in an in-process TTL cache (L1) in front of Redis (L2), along with the
+# generation tokens of their tags, so a hot read is served from memory without a Redis round trip or unpickling.
+# invalidate_tags publishes the invalidated tags over Redis pub/sub and every process drops them from its local tokens.
+# The local TTL bounds how stale a process can be if it misses a message.
+INVALIDATION_CHANNEL = 'cache:invalidate'
+
+class LocalCache:
+    def __init__(self, maxsize, ttl):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.generations = TTLCache(maxsize=maxsize * 4, ttl=ttl) # Entries depend on several tags
+        self.lock = threading.Lock() # TTLCache isn't thread safe
+
+    def get_entry(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def set_entry(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+
+    def get_generations(self, tags):
+        with self.lock:
+            return {tag: self.generations[tag] for tag in tags if tag in self.generations}
+
+    def set_generations(self, generations):
+        with self.lock:
+            self.generations.update(generations)
+
+    def drop_generations(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.generations.pop(tag, None)
+
+    def clear_generations(self):
+        with self.lock:
+            self.generations.clear()
+
+_local_cache = None
+_local_cache_pid = None
+_local_cache_lock = threading.Lock()
+
+# Get the local cache of this process, creating it and its invalidation subscriber on first use.
+# Gunicorn forks its workers, so the pid is checked and a forked worker builds its own cache and subscriber thread
+def get_local_cache():
+    global _local_cache, _local_cache_pid
+
+    if not current_app.config.get('CACHE_LOCAL_ENABLED') or exts.redis_client is None:
+        return None
+
+    if _local_cache_pid != os.getpid():
+        with _local_cache_lock:
+            if _local_cache_pid != os.getpid():
+                _local_cache = LocalCache(current_app.config.get('CACHE_LOCAL_MAXSIZE', 1024), current_app.config.get('CACHE_LOCAL_TTL', 60))
+                start_invalidation_subscriber(_local_cache, exts.redis_client)
+                _local_cache_pid = os.getpid()
+
+    return _local_cache
+
+def start_invalidation_subscriber(local_cache, redis_client):
+    thread = threading.Thread(target=listen_for_invalidations, args=(local_cache, redis_client), name='cache-invalidation-subscriber', daemon=True)
+    thread.start()
+
+def listen_for_invalidations(local_cache, redis_client):
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+
+            # Anything published before subscribing was missed, so every local token is dropped
+            local_cache.clear_generations()
+
+            for message in pubsub.listen():
+                handle_invalidation_message(local_cache, message)
+        except redis.RedisError as e:
+            print(f'Cache invalidation subscriber disconnected: {e}')
+            local_cache.clear_generations()
+            time.sleep(1)
+
+def handle_invalidation_message(local_cache, message):
+    local_cache.drop_generations(json.loads(message['data']))
+
+def tag_key(tag):
+    return f'tag:{tag}'
+
+# Get the current generation token of each tag, creating tokens for new tags.
+# Tokens held in the local cache are used if one is given, the rest are fetched with a single get_many
+def get_tag_generations(tags, local_cache=None):
+    tags = list(dict.fromkeys(tags)) # Remove duplicate tags, keeping the order
+
+    if not tags:
+        return {}
+
+    local_generations = local_cache.get_generations(tags) if local_cache else {}
+    missing_tags = [tag for tag in tags if tag not in local_generations]
+
+    if not missing_tags:
+        return local_generations
+
+    generations = dict(zip(missing_tags, cache.get_many(*[tag_key(tag) for tag in missing_tags])))
+
+    for tag, generation in generations.items():
+        if generation is None:
+            # add() only sets the token if it doesn't exist yet, so a token created by a concurrent request is kept
+            token = uuid.uuid4().hex
+            if not cache.add(tag_key(tag), token, timeout=GENERATION_TIMEOUT):
+                token = cache.get(tag_key(tag))
+            generations[tag] = token
+
+    if local_cache:
+        local_cache.set_generations({tag: generation for tag, generation in generations.items() if generation is not None})
+
+    return {**local_generations, **generations}
+
+# Invalidate every cached entry that depends on any of the given tags
+def invalidate_tags(*tags):
+    if not tags:
+        return
+
+    generations = {tag: uuid.uuid4().hex for tag in dict.fromkeys(tags)}
+    cache.set_many({tag_key(tag): generation for tag, generation in generations.items()}, timeout=GENERATION_TIMEOUT)
+
+    # Update this process's local tokens, then tell the other processes to drop theirs
+    if _local_cache is not None and _local_cache_pid == os.getpid():
+        _local_cache.set_generations(generations)
+
+    if exts.redis_client is not None:
+        exts.redis_client.publish(INVALIDATION_CHANNEL, json.dumps(list(generations)))
+
+# Invalidate every cached entry of the given functions, the equivalent of delete_memoized
+def invalidate_functions(*functions):
+    invalidate_tags(*[function.cache_tag for function in functions])
+
+# Only one caller recomputes an entry at a time, a lock in the cache stops other processes and a local claim on the key
+# stops other threads. While the entry is recomputed the other callers get the stale value, or wait if there isn't one
+LOCK_TIMEOUT = 30 # Seconds before a recompute lock expires if its holder dies
+LOCK_WAIT = 10 # Seconds a caller without a stale value waits for the recompute before running the function itself
+LOCK_POLL_INTERVAL = 0.05
+STALE_TIMEOUT = 60 * 5 # Seconds an expired entry is kept so it can be served stale while it is recomputed
+
+# The recomputes running in this process by key, the other threads only wait for a recompute of the same key. A key is
+# removed once its recompute is done, so only the keys being recomputed are kept however many keys are cached
+_local_recomputes = {}
+_local_recomputes_lock = threading.Lock()
+
+# Claim the recompute of a key in this process, returns None if this thread has the claim, otherwise the event that is
+# set when the thread holding it is done
+def claim_local_recompute(key):
+    with _local_recomputes_lock:
+        done = _local_recomputes.get(key)
+
+        if done is None:
+            _local_recomputes[key] = threading.Event()
+
+        return done
+
+def release_local_recompute(key):
+    with _local_recomputes_lock:
+        _local_recomputes.pop(key).set()
+
+# XFetch probabilistic early refresh, an entry is refreshed before it expires with a probability that grows as the
+# expiry gets closer and with how long the entry took to compute, so hot entries are refreshed by one caller and never expire
+def should_refresh_early(entry, beta):
+    return time.time() - entry['delta'] * beta * math.log(1 - random.random()) >= entry['expires_at']
+
+# Cache the result of a function, tags is called with the function arguments and result_tags with the result,
+# both return the tags the entry depends on. Every entry also depends on the function's own tag.
+# local=True also keeps the entry in the in-process cache, for hot reads such as the catalogue
+def cached(timeout, tags=None, result_tags=None, early_refresh_beta=1.0, local=False):
+    def decorator(fn):
+        name = f'{fn.__module__}.{fn.__qualname__}'
+        function_tag = f'function:{name}'
+        signature = inspect.signature(fn)
+
+        def is_fresh(entry, local_cache=None):
+            # The entry is only fresh if none of its tags have been invalidated since it was stored
+            return entry is not None and get_tag_generations(entry['generations'], local_cache) == entry['generations']
+
+        def recompute(key, bound, args, kwargs, local_cache):
+            # Read the generations before running the function, so an invalidation while it runs makes the new entry stale
+            generations = get_tag_generations([function_tag, *(tags(**bound.arguments) if tags else [])], local_cache)
+
+            started = time.time()
+            value = fn(*args, **kwargs)
+            delta = time.time() - started
+
+            # Tags that depend on the result, e.g. the products on a page
+            if result_tags:
+                generations.update(get_tag_generations(result_tags(value), local_cache))
+
+            # The entry is kept past its expiry so it can be served stale, should_refresh_early is always true once it has expired
+            entry = {'value': value, 'generations': generations, 'delta': delta, 'expires_at': time.time() + timeout}
+            cache.set(key, entry, timeout=timeout + STALE_TIMEOUT)
+
+            if local_cache:
+                local_cache.set_entry(key, entry)
+
+            return value
+
+        def make_key(*args, **kwargs):
+            # Bind the arguments so positional and keyword calls share the same key
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments_hash = hashlib.md5(repr(sorted(bound.arguments.items())).encode()).hexdigest()
+            return f'cached:{name}:{arguments_hash}', bound
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            key, bound = make_key(*args, **kwargs)
+            local_cache = get_local_cache() if local else None
+
+            # Serve the entry from the local cache, checked against the local tokens, without going to Redis
+            if local_cache:
+                entry = local_cache.get_entry(key)
+
+                if is_fresh(entry, local_cache) and not should_refresh_early(entry, early_refresh_beta):
+                    count_cache_result(name, 'local_hit')
+                    return entry['value']
+
+            entry = cache.get(key)
+
+            if is_fresh(entry) and not should_refresh_early(entry, early_refresh_beta):
+                if local_cache:
+                    local_cache.set_entry(key, entry)
+
+                count_cache_result(name, 'hit')
+                return entry['value']
+
+            lock_key = f'lock:{key}'
+
+            # The entry is stale or due an early refresh, recompute it if no one else is, otherwise serve the stale value
+            if entry is not None:
+                if claim_local_recompute(key) is None:
+                    try:
+                        if cache.add(lock_key, 1, timeout=LOCK_TIMEOUT):
+                            try:
+                                count_cache_result(name, 'miss')
+                                return recompute(key, bound, args, kwargs, local_cache)
+                            finally:
+                                cache.delete(lock_key)
+                    finally:
+                        release_local_recompute(key)
+
+                count_cache_result(name, 'stale')
+                return entry['value']
+
+            # There is no entry, one thread of the process waits for any other process recomputing it and the other
+            # threads wait for that thread
+            deadline = time.time() + LOCK_WAIT
+            done = claim_local_recompute(key)
+
+            while done is not None:
+                done.wait(max(deadline - time.time(), 0))
+
+                entry = cache.get(key)
+                if is_fresh(entry):
+                    count_cache_result(name, 'hit')
+                    return entry['value']
+
+                # The other thread took too long, it is computed anyway
+                if time.time() >= deadline:
+                    count_cache_result(name, 'miss')
+                    return recompute(key, bound, args, kwargs, local_cache)
+
+                # The other thread failed, take over the recompute
+                done = claim_local_recompute(key)
+
+            try:
+                entry = cache.get(key)
+                if is_fresh(entry):
+                    count_cache_result(name, 'hit')
+                    return entry['value']
+
+                locked = cache.add(lock_key, 1, timeout=LOCK_TIMEOUT)
+
+                while not locked and time.time() < deadline:
+                    time.sleep(LOCK_POLL_INTERVAL)
+
+                    entry = cache.get(key)
+                    if is_fresh(entry):
+                        count_cache_result(name, 'hit')
+                        return entry['value']
+
+                    locked = cache.add(lock_key, 1, timeout=LOCK_TIMEOUT)
+
+                # Either this caller holds the lock, or the other caller took too long and it is computed anyway
+                try:
+                    count_cache_result(name, 'miss')
+                    return recompute(key, bound, args, kwargs, local_cache)
+                finally:
+                    if locked:
+                        cache.delete(lock_key)
+            finally:
+                release_local_recompute(key)
+
+        wrapper.cache_tag = function_tag
+        wrapper.cache_key = lambda *args, **kwargs: make_key(*args, **kwargs)[0]
+        return wrapper
+    return decorator
@@ -1,15 +1,15 @@
-import ssl
 import os
 from celery import Celery
-from config import Development, Production
+from config import Development, Production, celery_connection_options
 from celery.schedules import crontab
+from celery.signals import beat_init, worker_init, worker_process_init, worker_process_shutdown
 from main import create_app
+from exts import db
+from metrics import mark_process_dead, start_metrics_server
 import redis
 
-# Determine is ssl certification is required based on the environment
-# ssl certification required for celery when using upstash
+# Determine the environment
 flask_env = os.getenv('FLASK_ENV', 'development')
-redis_ssl_required = os.getenv('REDIS_SSL_REQUIRED', 'False')
 
 # Set up configuration based on the environment
 if flask_env == 'development':
@@ -28,9 +28,7 @@ redis_client = redis.StrictRedis.from_url(config.CACHE_REDIS_URL)
 # Create a Celery instance
 celery = Celery(
     __name__,
-    broker=config.CELERY_BROKER_URL,
-    backend=config.CELERY_RESULT_BACKEND,
-    include=['tasks.cart_cleanup', 'tasks.guest_cleanup'],  # Load tasks from this module
+    include=['tasks.cart_cleanup', 'tasks.guest_cleanup', 'tasks.statistics_reconcile', 'tasks.email_delivery', 'tasks.stripe_sync', 'tasks.stripe_webhooks', 'tasks.image_derivatives'],  # Load tasks from this module
 )
 
 # Configure Celery
@@ -48,12 +46,52 @@ celery_conf = {
             'task': 'tasks.guest_cleanup.cleanup_old_guest_users',
             'schedule': crontab(minute='*/15'),  # Every 15 minutes
         },
+        'reconcile-dashboard-statistics-daily': {
+            'task': 'tasks.statistics_reconcile.reconcile_dashboard_statistics',
+            'schedule': crontab(hour=3, minute=0),  # Every day at 3am
+        },
+        'process-stripe-sync-outbox-every-minute': {
+            'task': 'tasks.stripe_sync.process_stripe_sync_outbox',
+            'schedule': crontab(minute='*'),  # Every minute
+        },
+        'reconcile-stripe-catalog-daily': {
+            'task': 'tasks.stripe_sync.reconcile_stripe_catalog',
+            'schedule': crontab(hour=4, minute=0),  # Every day at 4am
+        },
+        'process-pending-stripe-events-every-minute': {
+            'task': 'tasks.stripe_webhooks.process_pending_stripe_events',
+            'schedule': crontab(minute='*'),  # Every minute
+        },
+        'purge-processed-stripe-events-daily': {
+            'task': 'tasks.stripe_webhooks.purge_processed_stripe_events',
+            'schedule': crontab(hour=4, minute=30),  # Every day at 4:30am
+        },
+        'generate-missing-image-derivatives-daily': {
+            'task': 'tasks.image_derivatives.generate_missing_image_derivatives',
+            'schedule': crontab(hour=5, minute=0),  # Every day at 5am
+        },
     }
 }
 
-# Set up Redis SSL if required
-if redis_ssl_required == 'True':
-    celery_conf['broker_use_ssl'] = {'ssl_cert_reqs': ssl.CERT_REQUIRED}
-    celery_conf['redis_backend_use_ssl'] = {'ssl_cert_reqs': ssl.CERT_REQUIRED}
+# Connect to the broker and result backend, over SSL if required
+celery_conf.update(celery_connection_options(flask_app.config))
+
+celery.conf.update(celery_conf)
+
+# Give each forked worker process its own connection pool, connections opened before the fork can't be shared between processes
+@worker_process_init.connect
+def reset_database_pool(**kwargs):
+    with flask_app.app_context():
+        db.engine.dispose(close=False)
+
+# Serve the metrics of the worker's processes, or of beat, on their own port for Prometheus to scrape
+@worker_init.connect
+@beat_init.connect
+def serve_metrics(**kwargs):
+    if flask_app.config.get('METRICS_PORT'):
+        start_metrics_server(flask_app.config['METRICS_PORT'])
 
-celery.conf.update(celery_conf)
\ No newline at end of file
+# Remove the live pool gauges of a worker process when it exits
+@worker_process_shutdown.connect
+def remove_process_metrics(pid=None, **kwargs):
+    mark_process_dead(pid or os.getpid())
\ No newline at end of file
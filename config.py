@@ -1,10 +1,58 @@
 import os
+import ssl
 from datetime import timedelta
 from dotenv import load_dotenv
 from sqlalchemy import NullPool
+from metrics import InstrumentedQueuePool
 
 load_dotenv() # Load environment variables from the .env file
 
+# Role of the process, set by entrypoint.sh: backend (Gunicorn), celery (Celery worker) or beat (Celery beat)
+SERVICE_ROLE = os.getenv('SERVICE_ROLE', 'backend')
+
+# Default connection pool size and overflow of each role, per process
+DATABASE_POOL_DEFAULTS = {
+    'backend': (5, 5), # A Gunicorn worker, the overflow covers bursts of requests
+    'celery': (2, 2), # A Celery worker process runs one task at a time
+    'beat': (1, 0), # Celery beat only schedules tasks, it doesn't query the database
+}
+
+# Get a connection pool setting, a role specific environment variable such as DB_POOL_SIZE_CELERY overrides DB_POOL_SIZE
+def pool_setting(name, role, default):
+    return int(os.getenv(f'{name}_{role.upper()}', os.getenv(name, default)))
+
+# SQLAlchemy engine options for the connection pool of a role, DB_POOL_CLASS overrides the configuration's default pool class
+def database_engine_options(role, default_pool_class='queue'):
+    # Open a new connection for every checkout, e.g. to leave all pooling to pgbouncer
+    if os.getenv(f'DB_POOL_CLASS_{role.upper()}', os.getenv('DB_POOL_CLASS', default_pool_class)) == 'null':
+        return {'poolclass': NullPool}
+
+    pool_size, max_overflow = DATABASE_POOL_DEFAULTS.get(role, DATABASE_POOL_DEFAULTS['backend'])
+
+    return {
+        'poolclass': InstrumentedQueuePool, # Keep connections open between requests and record the checkout latency and saturation
+        'pool_size': pool_setting('DB_POOL_SIZE', role, pool_size), # Set the pool size for the database connection
+        'max_overflow': pool_setting('DB_MAX_OVERFLOW', role, max_overflow), # Set the maximum overflow for the database connection
+        'pool_timeout': pool_setting('DB_POOL_TIMEOUT', role, 30), # Set the pool timeout for the database connection
+        'pool_recycle': pool_setting('DB_POOL_RECYCLE', role, 1800), # Set the pool recycle time for the database connection
+        'pool_pre_ping': True, # Check a connection is still alive before using it, e.g. after pgbouncer or the database has closed it
+    }
+
+# Celery settings of the broker and result backend connections. Shared by the Celery worker and beat and by the Celery
+# client the app queues tasks with, so both connect to the broker the same way
+def celery_connection_options(app_config):
+    options = {
+        'broker_url': app_config.get('CELERY_BROKER_URL'),
+        'result_backend': app_config.get('CELERY_RESULT_BACKEND'),
+    }
+
+    # SSL certification required for the rediss:// broker and backend when using upstash
+    if os.getenv('REDIS_SSL_REQUIRED', 'False') == 'True':
+        options['broker_use_ssl'] = {'ssl_cert_reqs': ssl.CERT_REQUIRED}
+        options['redis_backend_use_ssl'] = {'ssl_cert_reqs': ssl.CERT_REQUIRED}
+
+    return options
+
 # Configuration class
 class Config:
     SECRET_KEY = os.getenv('SECRET_KEY') # Get the secret key from the environment variables
@@ -20,6 +68,8 @@ class Config:
     JWT_COOKIE_CSRF_PROTECT = False  # Set to True to enable CSRF protection        
     STRIPE_API_KEY = os.getenv('STRIPE_API_KEY') # Get the Stripe API key from the environment variables
     STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET') # Get the Stripe webhook secret from the environment variables
+    MAILGUN_API_BASE_URL = os.getenv('MAILGUN_API_BASE_URL', 'https://api.mailgun.net/v3') # Get the MAILGUN API base URL from the environment variables, the EU region uses https://api.eu.mailgun.net/v3
+    MAILGUN_TIMEOUT = int(os.getenv('MAILGUN_TIMEOUT', 10)) # Get the MAILGUN request timeout in seconds from the environment variables
     MAILGUN_DOMAIN_NAME = os.getenv('MAILGUN_DOMAIN_NAME') # Get the MAILGUN domain name from the environment variables
     MAILGUN_API_KEY = os.getenv('MAILGUN_API_KEY') # Get the MAILGUN API key from the environment variables
     MAILGUN_SENDER_EMAIL = os.getenv('MAILGUN_SENDER_EMAIL') # Get the MAILGUN sender email from the environment variables
@@ -28,7 +78,21 @@ class Config:
     MAILGUN_ORDER_SHIPPED_TEMPLATE= os.getenv('MAILGUN_ORDER_SHIPPED_TEMPLATE') # Get the MAILGUN order shipped template from the environment variables
     CONTACT_US_EMAIL = os.getenv('CONTACT_US_EMAIL') # Get the contact us email from the environment variables
     CACHE_TYPE = 'RedisCache' # Set the cache type to Redis
+    CACHE_LOCAL_ENABLED = True # Keep hot catalogue reads in an in-process cache in front of Redis
+    CACHE_LOCAL_MAXSIZE = int(os.getenv('CACHE_LOCAL_MAXSIZE', 1024)) # Get the maximum number of entries in the in-process cache from the environment variables
+    CACHE_LOCAL_TTL = int(os.getenv('CACHE_LOCAL_TTL', 60)) # Get the in-process cache TTL in seconds from the environment variables, this bounds how stale a worker can be if it misses an invalidation
     GOOGLE_CLOUD_STORAGE_BUCKET_NAME = os.getenv('GOOGLE_CLOUD_STORAGE_BUCKET_NAME') # Get the Google Cloud Storage bucket name from the environment variables
+    GOOGLE_CLOUD_STORAGE_API_ENDPOINT = os.getenv('GOOGLE_CLOUD_STORAGE_API_ENDPOINT') # Get the Google Cloud Storage API endpoint from the environment variables, only set to use a local emulator
+    GOOGLE_CLOUD_STORAGE_UPLOAD_CHUNK_SIZE = int(os.getenv('GOOGLE_CLOUD_STORAGE_UPLOAD_CHUNK_SIZE', 1024 * 1024)) # Get the size in bytes of each chunk of an image upload from the environment variables, must be a multiple of 256 KiB
+    GOOGLE_CLOUD_STORAGE_SIGNED_URL_UPLOADS = os.getenv('GOOGLE_CLOUD_STORAGE_SIGNED_URL_UPLOADS', 'False') == 'True' # Let the browser upload images straight to the bucket with a signed URL
+    GOOGLE_CLOUD_STORAGE_SIGNED_URL_EXPIRATION = int(os.getenv('GOOGLE_CLOUD_STORAGE_SIGNED_URL_EXPIRATION', 60 * 15)) # Get the number of seconds a signed upload URL is valid for from the environment variables
+    CELERY_TASK_ALWAYS_EAGER = False # Queue tasks such as emails for the Celery worker rather than running them in the request
+    SERVICE_ROLE = SERVICE_ROLE
+    SQLALCHEMY_ENGINE_OPTIONS = database_engine_options(SERVICE_ROLE) # SQLAlchemy engine options for database pooling
+    SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'True') == 'True' # Send the database, cache and external service timings of each request in a Server-Timing header
+    SLOW_REQUEST_THRESHOLD_MS = int(os.getenv('SLOW_REQUEST_THRESHOLD_MS', 1000)) # Log the requests taking at least this many milliseconds, 0 to disable
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN') # Get the bearer token Prometheus scrapes /metrics with from the environment variables, /metrics is disabled if not set
+    METRICS_PORT = int(os.getenv('METRICS_PORT', 0)) # Get the port the Celery worker and beat serve their metrics on from the environment variables, they have no web server, 0 to disable
 
 # Development configuration class
 class Development(Config):
@@ -39,14 +103,6 @@ class Development(Config):
     CACHE_REDIS_URL = os.getenv('DEVELOPMENT_REDIS_URL') # Get the Redis URL from the environment variables
     CELERY_BROKER_URL = os.getenv('DEVELOPMENT_REDIS_URL') # Get the Celery broker URL from the environment variables
     CELERY_RESULT_BACKEND = os.getenv('DEVELOPMENT_REDIS_URL') # Get the Celery result backend URL from the environment variables
-    
-    # SQLAlchemy engine options for database pooling
-    SQLALCHEMY_ENGINE_OPTIONS = {
-        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)), # Set the pool size for the database connection
-        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 5)), # Set the maximum overflow for the database connection
-        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)), # Set the pool timeout for the database connection
-        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)), # Set the pool recycle time for the database connection
-    }
 
 # Production configuration class
 class Production(Config):    
@@ -57,11 +113,8 @@ class Production(Config):
     CELERY_BROKER_URL = os.getenv('PRODUCTION_REDIS_URL') # Get the Celery broker URL from the environment variables
     CELERY_RESULT_BACKEND = os.getenv('PRODUCTION_REDIS_URL') # Get the Celery result backend URL from the environment variables
     FRONTEND_SECRET_HEADER = os.getenv('FRONTEND_SECRET_HEADER') # Get the frontend secret header from the environment variables
-
-    # SQLAlchemy engine options for database pooling
-    SQLALCHEMY_ENGINE_OPTIONS = {
-        'poolclass': NullPool, # Use NullPool to disable connection pooling in favour of pgbouncer connection pooling        
-    }
+    SQLALCHEMY_ENGINE_OPTIONS = database_engine_options(SERVICE_ROLE, default_pool_class='null') # Use NullPool by default in favour of pgbouncer connection pooling, DB_POOL_CLASS=queue pools in the app
+    SERVER_TIMING_ENABLED = os.getenv('SERVER_TIMING_ENABLED', 'False') == 'True' # Off by default, the Server-Timing header shows every client the queries, cache results and external call times of the request
 
 # Test configuration class
 class Test(Config):
@@ -71,4 +124,7 @@ class Test(Config):
     JWT_COOKIE_SAMESITE = None # Set the SameSite attribute for cookies to None in testing
     CACHE_TYPE = 'SimpleCache' # Set the cache type to SimpleCache for testing
     CACHE_DEFAULT_TIMEOUT = 300 # Set the cache timeout to 5 minutes, this makes sure that the cache is cleared after 5 minutes
-    CACHE_REDIS_URL = "memory://" # Use in-memory Redis for testing
\ No newline at end of file
+    CACHE_LOCAL_ENABLED = False # Disable the in-process cache, there is no Redis to publish invalidations in testing
+    CACHE_REDIS_URL = "memory://" # Use in-memory Redis for testing
+    CELERY_TASK_ALWAYS_EAGER = True # Run tasks in the request, there is no Celery worker in testing
+    STRIPE_WEBHOOK_SECRET = 'whsec_test' # Sign the test webhook events with a known secret
\ No newline at end of file
@@ -1,6 +1,6 @@
 from functools import wraps
 from flask import jsonify
-from flask_jwt_extended import get_jwt_identity
+from flask_jwt_extended import get_jwt, get_jwt_identity
 from marshmallow import ValidationError
 from models import User
 from werkzeug.exceptions import TooManyRequests
@@ -9,13 +9,25 @@ import os
 # Get the environment variable to determine if errors should be shown
 show_errors = os.getenv('SHOW_ERRORS', False)
 
+# Claims added to the access and refresh tokens, the role is embedded so the decorators don't need to look up the user
+def get_user_claims(user):
+    return {'role': user.role}
+
+# Get the role of the current user from the token, tokens issued before the role claim was added fall back to the database
+def get_current_user_role():
+    role = get_jwt().get('role')
+
+    if role is None:
+        user = User.query.get(get_jwt_identity())
+        role = user.role if user else None
+
+    return role
+
 def admin_required():
     def decorator(fn):
         @wraps(fn)        
         def wrapper(*args, **kwargs):
-            current_user_id = get_jwt_identity()
-            user = User.query.get(current_user_id)
-            if user.role != 'admin':
+            if get_current_user_role() != 'admin':
                 return {'error': 'Unauthorized access'}, 403
             return fn(*args, **kwargs)
         return wrapper
@@ -25,9 +37,8 @@ def customer_required():
     def decorator(fn):
         @wraps(fn)        
         def wrapper(*args, **kwargs):
-            current_user_id = get_jwt_identity()
-            user = User.query.get(current_user_id)
-            if user.role != 'customer' and user.role != 'admin':
+            role = get_current_user_role()
+            if role != 'customer' and role != 'admin':
                 return {'error': 'Unauthorized access'}, 403
             return fn(*args, **kwargs)
         return wrapper
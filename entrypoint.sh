@@ -4,6 +4,15 @@ set -e # Exit immediately if a command exits with a non-zero status
 # Use docker compose role if provided, otherwise default to SERVICE_ROLE environment variable
 ROLE=${1:-$SERVICE_ROLE}
 
+# Tell the app its role, the database connection pool is configured per role
+export SERVICE_ROLE=$ROLE
+
+# Every process of the role writes its Prometheus metrics to this directory, so they are added up when scraped.
+# Cleared on start so the metrics of a previous run aren't kept
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus_metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
 echo "Running entrypoint script for role: $ROLE"
 
 if [ "$ROLE" == "backend" ]; then
@@ -21,7 +30,7 @@ if [ "$ROLE" == "backend" ]; then
     
     # Start the flask application
     echo "Starting Gunicorn..."
-    exec gunicorn -w $GUNICORN_WORKERS -b 0.0.0.0:${PORT:-5050} run:app
+    exec gunicorn -c gunicorn.conf.py -w $GUNICORN_WORKERS -b 0.0.0.0:${PORT:-5050} run:app
 
 elif [ "$ROLE" == "celery" ]; then
     # Start the Celery worker
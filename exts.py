@@ -2,7 +2,8 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_caching import Cache
-from config import Test
+from celery import Celery
+from config import Test, celery_connection_options
 import redis
 
 # Create an instance of SQLAlchemy, which will be used to interact with the database
@@ -14,6 +15,9 @@ limiter = Limiter(key_func=get_remote_address)
 # Create an instance of Cache
 cache = Cache()
 
+# Create a Celery client, used to queue tasks for the Celery worker
+celery_client = Celery('exts')
+
 # Create an instance of Redis
 redis_client = None # Will be set in init_extensions
 
@@ -35,4 +39,7 @@ def init_extensions(app, config):
     limiter.init_app(app)
 
     # Initialise the cache
-    cache.init_app(app)
\ No newline at end of file
+    cache.init_app(app)
+
+    # Point the Celery client at the broker, with the same SSL settings as the Celery worker
+    celery_client.conf.update(celery_connection_options(app.config))
\ No newline at end of file
@@ -0,0 +1,7 @@
+from metrics import mark_process_dead
+
+# Gunicorn settings, the workers and bind address are set on the command line by entrypoint.sh
+
+# Remove the live pool gauges of a worker that has exited, e.g. restarted after a timeout
+def child_exit(server, worker):
+    mark_process_dead(worker.pid)
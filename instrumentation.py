@@ -0,0 +1,123 @@
+from functools import wraps
+import time
+from flask import g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from prometheus_client import Counter, Histogram
+
+# Request instrumentation
+#
+# Every request counts its SQL statements and the time spent running them, its cache hits and misses and the time spent
+# calling Stripe, Mailgun and Google Cloud Storage. The totals are sent back in a Server-Timing header, which the browser
+# dev tools show next to the request, recorded as Prometheus metrics per endpoint and logged for slow requests
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+request_count = Counter('http_requests_total', 'Requests handled', ['method', 'endpoint', 'status'])
+request_seconds = Histogram('http_request_duration_seconds', 'Time taken to handle a request', ['method', 'endpoint'], buckets=REQUEST_BUCKETS)
+request_queries = Histogram('http_request_db_queries', 'SQL statements run by a request', ['method', 'endpoint'], buckets=QUERY_COUNT_BUCKETS)
+request_db_seconds = Histogram('http_request_db_seconds', 'Time a request spent running SQL statements', ['method', 'endpoint'], buckets=REQUEST_BUCKETS)
+request_external_seconds = Histogram('http_request_external_seconds', 'Time a request spent calling an external service', ['method', 'endpoint', 'service'], buckets=REQUEST_BUCKETS)
+cache_results = Counter('cache_requests_total', 'Cached function calls by result', ['function', 'result'])
+external_call_seconds = Histogram('external_call_seconds', 'Time taken by calls to an external service, in requests and Celery tasks', ['service'], buckets=REQUEST_BUCKETS)
+
+# Services timed with instrument_external_call, in the order they are shown in the Server-Timing header
+EXTERNAL_SERVICES = ('stripe', 'mailgun', 'gcs')
+
+# Get the stats of the current request, None outside a request, e.g. in a Celery task
+def get_request_stats():
+    return g.get('request_stats') if has_app_context() else None
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started'] = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('query_started', None)
+    stats = get_request_stats()
+
+    if stats is not None and started is not None:
+        stats['queries'] += 1
+        stats['db_seconds'] += time.perf_counter() - started
+
+# Record a call to a cached function, result is hit, local_hit, stale or miss
+def record_cache_result(function, result):
+    cache_results.labels(function=function, result=result).inc()
+    stats = get_request_stats()
+
+    if stats is not None:
+        stats['cache_misses' if result == 'miss' else 'cache_hits'] += 1
+
+# Time the calls a function makes to an external service, e.g. @instrument_external_call('stripe')
+def instrument_external_call(service):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                external_call_seconds.labels(service=service).observe(elapsed)
+
+                stats = get_request_stats()
+                if stats is not None:
+                    stats['external_seconds'][service] = stats['external_seconds'].get(service, 0.0) + elapsed
+        return wrapper
+    return decorator
+
+def server_timing_header(stats, elapsed):
+    entries = [f'db;desc="{stats["queries"]} queries";dur={stats["db_seconds"] * 1000:.1f}']
+
+    if stats['cache_hits'] or stats['cache_misses']:
+        entries.append(f'cache;desc="{stats["cache_hits"]} hits, {stats["cache_misses"]} misses"')
+
+    for service in EXTERNAL_SERVICES:
+        if service in stats['external_seconds']:
+            entries.append(f'{service};dur={stats["external_seconds"][service] * 1000:.1f}')
+
+    entries.append(f'total;dur={elapsed * 1000:.1f}')
+
+    return ', '.join(entries)
+
+def init_instrumentation(app):
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = {'started': time.perf_counter(), 'queries': 0, 'db_seconds': 0.0, 'cache_hits': 0, 'cache_misses': 0, 'external_seconds': {}}
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = g.pop('request_stats', None)
+
+        # The request was answered by an earlier before_request hook
+        if stats is None:
+            return response
+
+        elapsed = time.perf_counter() - stats['started']
+
+        # Label by route rule rather than path so every product page shares one series, unmatched paths share one too
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        labels = {'method': request.method, 'endpoint': endpoint}
+
+        request_count.labels(status=response.status_code, **labels).inc()
+        request_seconds.labels(**labels).observe(elapsed)
+        request_queries.labels(**labels).observe(stats['queries'])
+        request_db_seconds.labels(**labels).observe(stats['db_seconds'])
+        for service, seconds in stats['external_seconds'].items():
+            request_external_seconds.labels(service=service, **labels).observe(seconds)
+
+        if app.config.get('SERVER_TIMING_ENABLED'):
+            response.headers['Server-Timing'] = server_timing_header(stats, elapsed)
+
+        slow_request_threshold = app.config.get('SLOW_REQUEST_THRESHOLD_MS')
+        if slow_request_threshold and elapsed * 1000 >= slow_request_threshold:
+            external = ' '.join(f'{service}={seconds * 1000:.0f}ms' for service, seconds in stats['external_seconds'].items())
+            print(
+                f"Slow request: {request.method} {request.path} {response.status_code} took {elapsed * 1000:.0f}ms, "
+                f"{stats['queries']} queries in {stats['db_seconds'] * 1000:.0f}ms, "
+                f"cache {stats['cache_hits']} hits {stats['cache_misses']} misses {external}".rstrip()
+            )
+
+        return response
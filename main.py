@@ -1,9 +1,11 @@
-from flask import Flask, request
+from flask import Flask, Response, abort, request
 from flask_restx import Api
 from flask_jwt_extended import JWTManager
 from flask_migrate import Migrate
 from flask_cors import CORS
 from exts import db, init_extensions, limiter, cache
+from metrics import render_metrics
+from instrumentation import init_instrumentation
 from api.user import user_ns
 from api.category import category_ns
 from api.product import product_ns
@@ -58,6 +60,9 @@ def create_app(config):
     api.add_namespace(address_ns)
     api.add_namespace(cart_ns)
 
+    # Record the queries, cache results and external calls of every request
+    init_instrumentation(app)
+
     # Restrict api access to the frontend
     @app.before_request
     def restrict_api_access():
@@ -69,6 +74,10 @@ def create_app(config):
             # Skip the check for stripe webhook endpoint
             if request.path == '/order/webhook':
                 return
+
+            # Skip the check for the metrics endpoint, Prometheus uses the metrics token
+            if request.path == '/metrics':
+                return
             
             expected_secret = app.config.get("FRONTEND_SECRET_HEADER")
             secret_header = request.headers.get('X-Frontend-Secret')
@@ -77,6 +86,22 @@ def create_app(config):
             if secret_header != expected_secret:
                 return {'error': 'Forbidden'}, 403
 
+    # Prometheus metrics of the Gunicorn workers, e.g. the database connection pool
+    @app.route('/metrics')
+    def metrics():
+        metrics_token = app.config.get('METRICS_TOKEN')
+
+        # The endpoint is disabled if no token is set
+        if not metrics_token:
+            abort(404)
+
+        if request.headers.get('Authorization') != f'Bearer {metrics_token}':
+            return {'error': 'Missing or invalid token'}, 401
+
+        body, content_type = render_metrics()
+
+        return Response(body, content_type=content_type)
+
     # Error handler for 401 error when user is logged out
     @api.errorhandler(NoAuthorizationError)
     def handle_no_authorisation_error(e):
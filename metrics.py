@@ -0,0 +1,93 @@
+import os
+import time
+import weakref
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess, start_http_server
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+# Prometheus metrics
+#
+# Gunicorn runs its workers behind one port and the Celery worker forks a pool of processes, so a scrape only reaches
+# one process. entrypoint.sh sets PROMETHEUS_MULTIPROC_DIR, where every process of the role writes its metrics, and a
+# scrape adds up the metrics of all of them. Without it, e.g. in the tests, the metrics of the current process are shown
+def metrics_registry():
+    if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        return REGISTRY
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+# Render the metrics in the Prometheus text format, returns the body and its content type
+def render_metrics():
+    return generate_latest(metrics_registry()), CONTENT_TYPE_LATEST
+
+# Serve the metrics on their own port, for the Celery worker and beat which have no web server
+def start_metrics_server(port):
+    start_http_server(port, registry=metrics_registry())
+
+# Remove the live gauges of a process that has exited, e.g. a Gunicorn worker that has been restarted
+def mark_process_dead(pid):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.mark_process_dead(pid)
+
+# Database connection pool metrics
+#
+# Checkout latency is the time a request waits for a connection, including opening a new connection when the pool
+# has none idle. A checkout that finds every connection in use has to wait for one to be returned, so the waits and
+# timeouts show the pool is saturated and needs to be bigger, or the queries holding the connections need to be faster
+POOL_CHECKOUT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Every pool in the process, the engine creates a new pool when it is disposed, e.g. after a Celery worker process is forked
+pools = weakref.WeakSet()
+
+pool_checkout_seconds = Histogram('db_pool_checkout_seconds', 'Time taken to check out a database connection from the pool', buckets=POOL_CHECKOUT_BUCKETS)
+pool_checkout_waits = Counter('db_pool_checkout_waits_total', 'Checkouts that found every connection in use and had to wait for one')
+pool_checkout_timeouts = Counter('db_pool_checkout_timeouts_total', 'Checkouts that gave up waiting for a connection')
+pool_connections_opened = Counter('db_pool_connections_opened_total', 'Database connections opened by the pool')
+
+# The pool gauges are set by each process when its pools change and added up over the live processes
+pool_size = Gauge('db_pool_size', 'Connections the pool keeps open', multiprocess_mode='livesum')
+pool_max_connections = Gauge('db_pool_max_connections', 'Connections the pool can open, including the overflow', multiprocess_mode='livesum')
+pool_checked_out = Gauge('db_pool_checked_out', 'Connections in use', multiprocess_mode='livesum')
+pool_idle = Gauge('db_pool_idle', 'Open connections waiting in the pool', multiprocess_mode='livesum')
+
+# Set the pool gauges from every pool in the process
+def record_pool_status():
+    current_pools = list(pools)
+
+    pool_size.set(sum(pool.size() for pool in current_pools))
+    pool_max_connections.set(sum(pool.size() + pool.max_overflow for pool in current_pools))
+    pool_checked_out.set(sum(pool.checkedout() for pool in current_pools))
+    pool_idle.set(sum(pool.checkedin() for pool in current_pools))
+
+# QueuePool that records the checkout latency, waits and timeouts, used with SQLALCHEMY_ENGINE_OPTIONS['poolclass']
+class InstrumentedQueuePool(QueuePool):
+    def __init__(self, creator, pool_size=5, max_overflow=10, **kwargs):
+        super().__init__(creator, pool_size=pool_size, max_overflow=max_overflow, **kwargs)
+        self.max_overflow = max_overflow # Connections opened beyond the pool size, -1 for no limit
+        pools.add(self)
+
+    def connect(self):
+        started = time.perf_counter()
+
+        # Every connection is in use and the pool can't open another one
+        if self.max_overflow > -1 and self.checkedout() >= self.size() + self.max_overflow:
+            pool_checkout_waits.inc()
+
+        try:
+            return super().connect()
+        except PoolTimeoutError:
+            pool_checkout_timeouts.inc()
+            raise
+        finally:
+            pool_checkout_seconds.observe(time.perf_counter() - started)
+            record_pool_status()
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        record_pool_status()
+
+    def _create_connection(self):
+        pool_connections_opened.inc()
+        return super()._create_connection()
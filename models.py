@@ -1,5 +1,11 @@
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred
 from exts import db
 
+# Search document of a product, the name is weighted above the description so products matching by name rank first
+PRODUCT_SEARCH_VECTOR = "setweight(to_tsvector('english', name), 'A') || setweight(to_tsvector('english', description), 'B')"
+
 class User(db.Model):
     __tablename__ = 'User'
     id = db.Column(db.Integer, primary_key=True)
@@ -18,6 +24,12 @@ class User(db.Model):
     carts = db.relationship('Cart', backref='user', lazy=True, uselist=False, cascade="all, delete", passive_deletes=True) # uselist=False ensures that a user can only have one cart, cascade="all, delete" ensures that when a user is deleted, their cart is also deleted, and passive_deletes=True ensures that the database handles the deletion of the cart
     orders = db.relationship('Order', backref='user', lazy=True)
 
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_User_role_created_at', 'role', 'created_at'), # Lets the guest cleanup find expired guests with an index range scan
+        db.Index('ix_User_created_at_id', 'created_at', 'id'), # Admin user listing, latest users first
+    )
+
     def __repr__(self):
         return f'<User {self.id} {self.full_name}>'
     
@@ -42,6 +54,11 @@ class Address(db.Model):
     # Foreign key
     user_id = db.Column(db.Integer, db.ForeignKey('User.id', ondelete='CASCADE'), nullable=False)
 
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_Address_user_id_is_default', 'user_id', 'is_default'), # A user's addresses and their default address
+    )
+
     def __repr__(self):
         return f'<Address {self.id} {self.address_line_1}>'
     
@@ -82,6 +99,7 @@ class Product(db.Model):
     reserved_stock = db.Column(db.Integer, nullable=False, default=0) # Reserved stock is the stock that is reserved in the cart but not yet purchased
     stripe_product_id = db.Column(db.String(50), nullable=True) # Stripe product id
     stripe_price_id = db.Column(db.String(50), nullable=True) # Stripe price id
+    search_vector = deferred(db.Column(TSVECTOR, db.Computed(PRODUCT_SEARCH_VECTOR, persisted=True))) # Generated by Postgres from the name and description, only loaded by the product search
 
     # Foreign key
     category_id = db.Column(db.Integer, db.ForeignKey('Category.id', ondelete='CASCADE'), nullable=False) # ondelete='CASCADE' ensures that when a category is deleted, all products in that category are also deleted
@@ -91,6 +109,13 @@ class Product(db.Model):
     featured_products = db.relationship('FeaturedProduct', backref='product', lazy=True, uselist=False, cascade="all, delete", passive_deletes=True) # uselist=False ensures that a product can only be featured once. cascade="all, delete" ensures that when a product is deleted, the featured product is also deleted and passive_deletes=True ensures that the database handles the deletion of the featured product
     cart_products = db.relationship('CartProduct', backref='product', lazy=True, cascade="all, delete", passive_deletes=True) # cascade="all, delete" ensures that when a product is deleted, all cart products are also deleted and passive_deletes=True ensures that the database handles the deletion of the cart products
 
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_Product_category_id_stock', 'category_id', 'stock'), # Shop listing of a category, only products in stock
+        db.Index('ix_Product_search_vector', 'search_vector', postgresql_using='gin'), # Product search
+        db.Index('ix_Product_name_trgm', 'name', postgresql_using='gin', postgresql_ops={'name': 'gin_trgm_ops'}), # Typo tolerant product name suggestions
+    )
+
     def __repr__(self):
         return f'<Product {self.id} {self.name}>'
     
@@ -102,6 +127,9 @@ class Product(db.Model):
         db.session.delete(self)
         db.session.commit()
 
+# The trigram index on the product names needs the pg_trgm extension, create it with the tables, e.g. for the tests
+event.listen(Product.__table__, 'before_create', DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+
 class Cart(db.Model):
     __tablename__ = 'Cart'
     id = db.Column(db.Integer, primary_key=True)
@@ -110,7 +138,7 @@ class Cart(db.Model):
     product_added_at = db.Column(db.DateTime(timezone=True), nullable=True) # Date and time when the item was added to the cart
 
     # Foreign key
-    user_id = db.Column(db.Integer, db.ForeignKey('User.id', ondelete='CASCADE'), nullable=False) # ondelete='CASCADE' ensures that when a user is deleted, their cart is also deleted
+    user_id = db.Column(db.Integer, db.ForeignKey('User.id', ondelete='CASCADE'), nullable=False, index=True) # ondelete='CASCADE' ensures that when a user is deleted, their cart is also deleted
 
     # Relationships
     cart_products = db.relationship('CartProduct', backref='cart', lazy=True, cascade="all, delete", passive_deletes=True) # cascade="all, delete" ensures that when a cart is deleted, all cart products are also deleted and passive_deletes=True ensures that the database handles the deletion of the cart products
@@ -136,6 +164,11 @@ class CartProduct(db.Model):
     cart_id = db.Column(db.Integer, db.ForeignKey('Cart.id', ondelete='CASCADE'), nullable=False) # ondelete='CASCADE' ensures that when a cart is deleted, all cart products are also deleted
     product_id = db.Column(db.Integer, db.ForeignKey('Product.id', ondelete='CASCADE'), nullable=False) # ondelete='CASCADE' ensures that when a product is deleted, all cart products are also deleted
 
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_Cart_Product_cart_id_product_id', 'cart_id', 'product_id'), # The products in a cart and a product already in a cart
+    )
+
     def __repr__(self):
         return f'<CartProduct {self.id} {self.quantity}>'
     
@@ -152,9 +185,20 @@ class ProductImage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     image_path = db.Column(db.String(1000), nullable=False)
 
+    # Smaller variants of the image, generated in the background after upload so they are null until then
+    thumbnail_path = db.Column(db.String(1000), nullable=True) # WebP thumbnail shown in the listings
+    thumbnail_avif_path = db.Column(db.String(1000), nullable=True) # AVIF thumbnail for browsers that support it
+    webp_path = db.Column(db.String(1000), nullable=True) # Full size WebP shown on the product page
+    derivatives_failed_at = db.Column(db.DateTime(timezone=True), nullable=True) # Set if the uploaded file can't be read as an image, the variants aren't tried again
+
     # Foreign key
     product_id = db.Column(db.Integer, db.ForeignKey('Product.id', ondelete='CASCADE'), nullable=False) # ondelete='CASCADE' ensures that when a product is deleted, all product images are also deleted
 
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_Product_Image_product_id_id', 'product_id', 'id'), # The images of a product and the first image of each product
+    )
+
     def __repr__(self):
         return f'<ProductImage {self.id} {self.image_path}>'
     
@@ -196,7 +240,7 @@ class Order(db.Model):
     city = db.Column(db.String(100), nullable=False)
     postcode = db.Column(db.String(20), nullable=False)
     customer_email = db.Column(db.String(100), nullable=False)
-    stripe_session_id = db.Column(db.String(200), nullable=False)
+    stripe_session_id = db.Column(db.String(200), nullable=False, index=True)
     tracking_url = db.Column(db.String(300), nullable=True)
     
     # Foreign keys
@@ -205,6 +249,13 @@ class Order(db.Model):
     # Relationships
     order_items = db.relationship('OrderItem', backref='order', lazy=True, cascade="all, delete", passive_deletes=True) # cascade="all, delete" ensures that when an order is deleted, all order items are also deleted and passive_deletes=True ensures that the database handles the deletion of the order items    
 
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_Order_user_id_order_date', 'user_id', 'order_date'), # A user's orders, latest first
+        db.Index('ix_Order_status_order_date_id', 'status', 'order_date', 'id'), # Admin order listing filtered by status
+        db.Index('ix_Order_order_date_id', 'order_date', 'id'), # Admin order listing, latest first
+    )
+
     def __repr__(self):
         return f'<Order {self.id} {self.total_price}>'
     
@@ -224,7 +275,7 @@ class OrderItem(db.Model):
     name = db.Column(db.String(100), nullable=False) # Product name at the time of purchase
 
     # Foreign key
-    order_id = db.Column(db.Integer, db.ForeignKey('Order.id', ondelete='CASCADE'), nullable=False) # ondelete='CASCADE' ensures that when an order is deleted, all order items are also deleted
+    order_id = db.Column(db.Integer, db.ForeignKey('Order.id', ondelete='CASCADE'), nullable=False, index=True) # ondelete='CASCADE' ensures that when an order is deleted, all order items are also deleted
     product_id = db.Column(db.Integer, db.ForeignKey('Product.id', ondelete='SET NULL'), nullable=True)  # Allow NULL
     
     def __repr__(self):
@@ -236,4 +287,66 @@ class OrderItem(db.Model):
 
     def delete(self):
         db.session.delete(self)
+        db.session.commit()
+
+class DashboardStatistic(db.Model):
+    __tablename__ = 'Dashboard_Statistic'
+    name = db.Column(db.String(50), primary_key=True) # e.g. total_users, total_revenue or orders_in_month:2025-06
+    value = db.Column(db.DECIMAL(14, 2), nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DashboardStatistic {self.name} {self.value}>'
+    
+    def save(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+
+# Outbox of products waiting to be pushed to Stripe, written in the same transaction as the product change.
+# There is one row per product, so several changes before the sync runs are pushed to Stripe together
+class StripeProductSync(db.Model):
+    __tablename__ = 'Stripe_Product_Sync'
+    product_id = db.Column(db.Integer, db.ForeignKey('Product.id', ondelete='CASCADE'), primary_key=True) # ondelete='CASCADE' ensures that when a product is deleted, its pending sync is also deleted
+    requested_at = db.Column(db.DateTime(timezone=True), nullable=False) # Date and time of the latest change waiting to be synced
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=False, index=True) # Date and time the sync is next tried, pushed back after a failure
+    locked_until = db.Column(db.DateTime(timezone=True), nullable=True) # Date and time the worker syncing the product gives up its claim
+    attempts = db.Column(db.Integer, nullable=False, default=0) # Number of failed attempts since the latest change
+    last_error = db.Column(db.String(500), nullable=True)
+
+    def __repr__(self):
+        return f'<StripeProductSync {self.product_id} {self.attempts}>'
+    
+    def save(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def delete(self):
+        db.session.delete(self)
+        db.session.commit()
+
+# Stripe webhook event model, the inbox of verified Stripe events. The event id is the primary key, so a redelivered event is stored once
+class StripeWebhookEvent(db.Model):
+    __tablename__ = 'Stripe_Webhook_Event'
+    id = db.Column(db.String(255), primary_key=True) # Stripe event id
+    type = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.JSON, nullable=False) # The event as sent by Stripe
+    received_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    processed_at = db.Column(db.DateTime(timezone=True), nullable=True) # Set in the same commit as the changes made by the event, null until then
+    next_attempt_at = db.Column(db.DateTime(timezone=True), nullable=False) # Date and time the event is next tried, pushed back after a failure
+    attempts = db.Column(db.Integer, nullable=False, default=0) # Number of failed attempts
+    last_error = db.Column(db.String(500), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_Stripe_Webhook_Event_next_attempt_at_unprocessed', 'next_attempt_at', postgresql_where=db.text('processed_at IS NULL')), # Unprocessed events that are due
+        db.Index('ix_Stripe_Webhook_Event_processed_at', 'processed_at'), # Processed events to purge
+    )
+
+    def __repr__(self):
+        return f'<StripeWebhookEvent {self.id} {self.type}>'
+    
+    def save(self):
+        db.session.add(self)
         db.session.commit()
\ No newline at end of file
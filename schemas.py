@@ -43,6 +43,9 @@ class FeaturedProductSchema(Schema):
 
 class ProductImageSchema(Schema):
     image_path = ma_fields.String(required=True, error_messages={'required': 'Image path is required', 'null': 'Image path cannot be empty'})
+    thumbnail_path = ma_fields.String(dump_only=True)
+    thumbnail_avif_path = ma_fields.String(dump_only=True)
+    webp_path = ma_fields.String(dump_only=True)
     product_id = ma_fields.Integer(required=True, error_messages={'required': 'Product ID is required', 'null': 'Product ID cannot be empty'})
 
 # Order schemas
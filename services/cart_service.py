@@ -1,13 +1,16 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
+import time
 from flask import jsonify, make_response
 from marshmallow import ValidationError
+from sqlalchemy import select, update
 from models import Cart, CartProduct, Product
 from flask_jwt_extended import get_jwt_identity, set_access_cookies, set_refresh_cookies
 from schemas import CartSchema, CartProductSchema, ProductSchema, ProductCartProductCombinedSchema
 from services.product_service import FeaturedProductService, ProductService
 from services.user_service import UserService
-from exts import cache
+from services.stock_service import StockService
+from exts import db, cache
 
 # Define the schema instances
 cart_schema = CartSchema()
@@ -39,7 +42,8 @@ class CartService:
         # get the products and add it to an array using each item's product_id in cart_products
         for cart_product in cart_products:
             product = Product.query.get(cart_product.product_id)
-            image_path = product.product_images[0].image_path if product.product_images else None # Get the first image path if it exists, otherwise set it to None
+            product_image = product.product_images[0] if product.product_images else None
+            image_path = (product_image.thumbnail_path or product_image.image_path) if product_image else None # Get the thumbnail of the first image if it exists, otherwise set it to None
             cart_products_and_products.append({
                 'cart_product': cart_product,
                 'product': {
@@ -76,25 +80,14 @@ class CartService:
         if not cart_product:
             raise ValidationError('Cart product not found')
 
-        # Reserve the stock for the product
-        product = Product.query.get(cart_product.product_id)
-
-        # Check if the product exists
-        if not product:
-            raise ValidationError('Product not found')
-
         # if product.stock < valid_data['quantity'] or product.reserved_stock < valid_data['quantity']:
         #     raise ValidationError('Product is out of stock')
         
         # Calculate the difference in quantity
         quantity_difference = valid_data['quantity'] - cart_product.quantity
 
-        if product.stock < quantity_difference + product.reserved_stock:
-            raise ValidationError('Product is out of stock.')
-        
-        # Reserve the stock for the product
-        product.reserved_stock += quantity_difference
-        product.save()
+        # Reserve or release the stock for the product, raises an error if there isn't enough unreserved stock
+        StockService.adjust_reserved_stock(cart_product.product_id, quantity_difference)
 
         # Update the cart product quantity
         cart_product.quantity = valid_data['quantity']
@@ -129,7 +122,8 @@ class CartService:
         if product.stock < valid_data['quantity']:
             raise ValidationError('Product is out of stock')
         
-        # Reserve the stock for the product
+        # Check if there is enough unreserved stock before creating a guest user,
+        # the stock is reserved atomically further down so this check is only an early exit
         if product.stock < valid_data['quantity'] + product.reserved_stock:
             raise ValidationError('Product is out of stock.')
         
@@ -157,13 +151,8 @@ class CartService:
             # Calculate the difference in quantity
             quantity_difference = valid_data['quantity'] - existing_cart_product.quantity
 
-            # Adjust the reserved stock
-            if product.stock < quantity_difference + product.reserved_stock:
-                raise ValidationError('Product is out of stock.')
-            
-            # Reserve the stock for the product
-            product.reserved_stock += quantity_difference
-            product.save()
+            # Reserve or release the stock for the product, raises an error if there isn't enough unreserved stock
+            StockService.adjust_reserved_stock(product_id, quantity_difference)
 
             # Update the cart product quantity
             existing_cart_product.quantity = valid_data['quantity']
@@ -171,8 +160,7 @@ class CartService:
             return cart_product_schema.dump(existing_cart_product)
 
         # If the product doesnt exist in the cart, reserve the stock for the product
-        product.reserved_stock += valid_data['quantity']
-        product.save()
+        StockService.reserve_stock(product_id, valid_data['quantity'])
 
         # Otherwise create a new cart product if it doesn't exist already
         cart_product = CartProduct(
@@ -220,11 +208,7 @@ class CartService:
             raise ValidationError('Cart product not found')
         
         # Restore the stock for the product
-        product = Product.query.get(cart_product.product_id)
-        if product:
-            # product.reserved_stock -= cart_product.quantity
-            product.reserved_stock = max(product.reserved_stock - cart_product.quantity, 0) # Ensure stock doesn't go negative
-            product.save()
+        StockService.release_stock(cart_product.product_id, cart_product.quantity)
         
         # If the cart product has a quantity of 1, delete the cart product
         cart_product.delete()
@@ -233,4 +217,51 @@ class CartService:
         # cache.delete_memoized(ProductService.get_all_products)
         # cache.delete_memoized(FeaturedProductService.get_all_featured_products)
 
-        return cart_product
\ No newline at end of file
+        return cart_product
+
+    @staticmethod
+    def cleanup_abandoned_carts(cart_unlock_time_hours, reserved_stock_cleanup_hours):
+        now = datetime.now(tz=ZoneInfo("UTC"))
+
+        # Rows affected and elapsed time of each phase
+        phases = []
+
+        # Unlock carts locked > cart unlock time, meaning any cart that been locked due to abandoned stripe checkout session
+        started = time.perf_counter()
+        unlocked_carts = db.session.execute(
+            update(Cart)
+            .where(Cart.locked == True, Cart.locked_at < now - timedelta(hours=cart_unlock_time_hours))
+            .values(locked=False, locked_at=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        phases.append({'phase': 'unlock_carts', 'rows': unlocked_carts, 'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)})
+
+        # Stale carts are carts that are not locked and had a product added more than reserved stock cleanup hours ago
+        stale_carts = select(Cart.id).where(Cart.locked == False, Cart.product_added_at < now - timedelta(hours=reserved_stock_cleanup_hours))
+
+        # Remove the products from the stale carts
+        started = time.perf_counter()
+        deleted = StockService.delete_cart_products_for_carts(stale_carts)
+        phases.append({'phase': 'delete_cart_products', 'rows': sum(row.cart_products for row in deleted), 'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)})
+
+        # Release the reserved stock of the removed products
+        started = time.perf_counter()
+        products_released, quantity_released = StockService.release_reserved_stock_quantities(deleted)
+        phases.append({'phase': 'release_reserved_stock', 'rows': products_released, 'quantity': quantity_released, 'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)})
+
+        # Reset the product added timestamp of the stale carts
+        started = time.perf_counter()
+        cleaned_carts = db.session.execute(
+            update(Cart)
+            .where(Cart.id.in_(stale_carts))
+            .values(product_added_at=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        phases.append({'phase': 'reset_stale_carts', 'rows': cleaned_carts, 'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)})
+
+        # Commit all phases together
+        started = time.perf_counter()
+        db.session.commit()
+        phases.append({'phase': 'commit', 'rows': 0, 'elapsed_ms': round((time.perf_counter() - started) * 1000, 2)})
+
+        return phases
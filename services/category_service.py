@@ -1,9 +1,9 @@
 from marshmallow import ValidationError
 from models import Category
 from schemas import CategorySchema, ProductSchema
-from services.product_service import FeaturedProductService, ProductService
-from services.utils import remove_image_from_google_cloud_storage # Used to delete product images from cloud bucket if admin deletes a category
-from exts import cache
+from services.utils import paginate_by_cursor, remove_image_from_google_cloud_storage, get_product_image_paths # Used to delete product images from cloud bucket if admin deletes a category
+from services.product_service import ProductService
+from caching import cached, invalidate_tags
 
 # Define the schema instances
 category_schema = CategorySchema()
@@ -32,13 +32,12 @@ class CategoryService:
         new_category.save()
 
         # Clear the cache
-        cache.delete_memoized(CategoryService.get_all_admin_categories)
-        cache.delete_memoized(CategoryService.get_all_categories)
+        invalidate_tags('categories')
 
         return new_category
     
     @staticmethod
-    @cache.memoize(timeout=86400) # Cache for 24 hours
+    @cached(timeout=86400, tags=lambda page, per_page: ['categories']) # Cache for 24 hours
     def get_all_admin_categories(page=1, per_page=10):
         print('Fetching admin categories')
         # Paginate the categories. Order by id in descending order to get the latest categories first
@@ -60,7 +59,29 @@ class CategoryService:
         }
     
     @staticmethod
-    @cache.memoize(timeout=86400) # Cache for 24 hours
+    @cached(timeout=86400, tags=lambda cursor, per_page, include_total: ['categories']) # Cache for 24 hours
+    def get_all_admin_categories_by_cursor(cursor=None, per_page=10, include_total=False):
+        print('Fetching admin categories by cursor')
+        # Get the page after the cursor, latest categories first
+        categories, next_cursor = paginate_by_cursor(Category.query, [Category.id], cursor, per_page)
+
+        # Check if there are any categories
+        if not categories:
+            raise ValidationError('No categories found')
+
+        results = {
+            'categories': category_schema.dump(categories, many=True),
+            'next_cursor': next_cursor
+        }
+
+        # Only count the categories if asked to
+        if include_total:
+            results['total_categories'] = Category.query.count()
+
+        return results
+    
+    @staticmethod
+    @cached(timeout=86400, tags=lambda: ['categories'], local=True) # Cache for 24 hours, read on every page view so also kept in the in-process cache
     def get_all_categories():
         print('Fetching categories')
         categories = Category.query.all()
@@ -113,12 +134,8 @@ class CategoryService:
         category.name = valid_data['name']
         category.save()
 
-        # Clear the cache
-        cache.delete_memoized(CategoryService.get_all_admin_categories)
-        cache.delete_memoized(CategoryService.get_all_categories)
-        cache.delete_memoized(ProductService.get_all_products)
-        cache.delete_memoized(ProductService.get_all_admin_products)
-        cache.delete_memoized(FeaturedProductService.get_all_featured_products)
+        # Clear the cache, the category name is shown on the unfiltered shop listings, its own listings and the featured products
+        invalidate_tags('categories', 'products', 'featured_products', f'category:{category.id}')
 
         return category
     
@@ -143,15 +160,15 @@ class CategoryService:
             for product in products:
                 product_images = product.product_images
                 for product_image in product_images:
-                    remove_image_from_google_cloud_storage(product_image.image_path)
+                    for image_path in get_product_image_paths(product_image):
+                        remove_image_from_google_cloud_storage(image_path)
         
+        product_ids = [product.id for product in products]
+
         category.delete()
 
-        # Clear the cache
-        cache.delete_memoized(CategoryService.get_all_admin_categories)
-        cache.delete_memoized(CategoryService.get_all_categories)
-        cache.delete_memoized(ProductService.get_all_products)
-        cache.delete_memoized(ProductService.get_all_admin_products)
-        cache.delete_memoized(FeaturedProductService.get_all_featured_products)
+        # Clear the cache, the category's products are deleted with it so every listing, search and suggestion showing them
+        invalidate_tags('categories', 'admin_products', *[tag for product_id in product_ids for tag in (f'product:{product_id}', f'product:{product_id}:stock')])
+        ProductService.invalidate_product_listings([category.id])
 
         return category
\ No newline at end of file
@@ -0,0 +1,151 @@
+from datetime import datetime
+from io import BytesIO
+import tempfile
+from zoneinfo import ZoneInfo
+from flask import current_app
+from PIL import Image, ImageOps
+from sqlalchemy import select, update
+from models import ProductImage
+from services.utils import download_image_from_google_cloud_storage, upload_image_variant_to_google_cloud_storage, remove_image_from_google_cloud_storage
+from exts import db
+from caching import invalidate_tags
+import exts
+
+# Variants generated for every product image: the column the path is saved in, the suffix of the file name,
+# the largest width and height, the Pillow format and the content type
+IMAGE_VARIANTS = [
+    ('thumbnail_path', 'thumbnail.webp', 400, 'WEBP', 'image/webp'),
+    ('thumbnail_avif_path', 'thumbnail.avif', 400, 'AVIF', 'image/avif'),
+    ('webp_path', 'large.webp', 1600, 'WEBP', 'image/webp'),
+]
+IMAGE_VARIANT_QUALITY = 80
+IMAGE_SPOOL_SIZE = 8 * 1024 * 1024 # Images up to 8 MiB are downloaded into memory, larger images into a temporary file
+
+# Services
+class ImageDerivativeService:
+    @staticmethod
+    def queue_derivatives(product_image_id):
+        # Ask the Celery worker to generate the variants of a product image, the variants are generated straight away
+        # if tasks are run eagerly, e.g. in testing. The listings show the uploaded image until the variants are ready
+        if current_app.config.get('CELERY_TASK_ALWAYS_EAGER'):
+            try:
+                ImageDerivativeService.generate_derivatives(product_image_id)
+            except Exception as e:
+                print(f"Failed to generate the variants of product image {product_image_id}: {str(e)}")
+            return
+
+        try:
+            exts.celery_client.send_task('tasks.image_derivatives.generate_image_derivatives', args=[product_image_id])
+        except Exception as e:
+            # The image has no variants yet, so the scheduled run will generate them
+            print(f"Failed to queue the variants of product image {product_image_id}: {str(e)}")
+
+    @staticmethod
+    def queue_missing_derivatives(limit=100):
+        # Queue the images without variants, e.g. images uploaded before the variants were added or whose task was lost.
+        # Images that can't be read are left out, they would be downloaded again on every run and fill the batch
+        product_image_ids = db.session.scalars(
+            select(ProductImage.id)
+            .where(ProductImage.thumbnail_path.is_(None), ProductImage.derivatives_failed_at.is_(None))
+            .order_by(ProductImage.id)
+            .limit(limit)
+        ).all()
+
+        for product_image_id in product_image_ids:
+            ImageDerivativeService.queue_derivatives(product_image_id)
+
+        return len(product_image_ids)
+
+    @staticmethod
+    def render_variants(image_file):
+        # Resize and convert the image to each variant, returns a list of (column, suffix, content type, file)
+        variants = []
+
+        with Image.open(image_file) as image:
+            # Turn photos the right way up, the variants don't keep the EXIF orientation
+            image = ImageOps.exif_transpose(image)
+
+            # Convert palette, greyscale and CMYK images to a mode both formats can store
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+
+            for column, suffix, size, image_format, content_type in IMAGE_VARIANTS:
+                # Keeps the aspect ratio and never makes the image bigger
+                variant = image.copy()
+                variant.thumbnail((size, size), Image.Resampling.LANCZOS)
+
+                variant_file = BytesIO()
+                variant.save(variant_file, format=image_format, quality=IMAGE_VARIANT_QUALITY)
+                variant_file.seek(0)
+
+                variants.append((column, suffix, content_type, variant_file))
+
+        return variants
+
+    @staticmethod
+    def generate_derivatives(product_image_id):
+        # Generate the variants of a product image and save their paths, returns True if the variants were generated,
+        # None if the image no longer exists and False if the uploaded file can't be read as an image.
+        # Storage errors are raised so the task is retried
+        product_image = db.session.get(ProductImage, product_image_id)
+
+        # The image was replaced or its product deleted after the task was queued
+        if not product_image:
+            return None
+
+        image_path, product_id = product_image.image_path, product_image.product_id
+        db.session.rollback() # End the read so no transaction is held open while the image is converted
+
+        with tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_SIZE) as image_file:
+            download_image_from_google_cloud_storage(image_path, image_file)
+            image_file.seek(0)
+
+            try:
+                variants = ImageDerivativeService.render_variants(image_file)
+            except (OSError, Image.DecompressionBombError) as e:
+                # Trying again won't help, record the failure so the image isn't queued again. The listings keep showing
+                # the uploaded image
+                print(f"Can't generate the variants of product image {product_image_id}: {str(e)}")
+
+                db.session.execute(
+                    update(ProductImage)
+                    .where(ProductImage.id == product_image_id, ProductImage.image_path == image_path)
+                    .values(derivatives_failed_at=datetime.now(tz=ZoneInfo("UTC")))
+                )
+                db.session.commit()
+
+                return False
+
+        variant_paths = {}
+        try:
+            for column, suffix, content_type, variant_file in variants:
+                variant_paths[column] = upload_image_variant_to_google_cloud_storage(variant_file, image_path, suffix, content_type)
+        except Exception:
+            ImageDerivativeService.remove_variants(variant_paths.values())
+            raise
+
+        # Only save the paths if the image hasn't been replaced or deleted while the variants were generated
+        updated = db.session.execute(
+            update(ProductImage)
+            .where(ProductImage.id == product_image_id, ProductImage.image_path == image_path)
+            .values(**variant_paths)
+        ).rowcount
+        db.session.commit()
+
+        if not updated:
+            ImageDerivativeService.remove_variants(variant_paths.values())
+            return None
+
+        # Clear the cache, every cached page showing the product's image
+        invalidate_tags(f'product:{product_id}')
+
+        return True
+
+    @staticmethod
+    def remove_variants(variant_paths):
+        # Remove variants that weren't saved, a variant left behind only wastes storage
+        for variant_path in variant_paths:
+            try:
+                remove_image_from_google_cloud_storage(variant_path)
+            except Exception as e:
+                print(f"Failed to remove image variant {variant_path}: {str(e)}")
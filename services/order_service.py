@@ -1,15 +1,19 @@
 from datetime import datetime
 from zoneinfo import ZoneInfo
 from marshmallow import ValidationError
-from models import Order, OrderItem, Cart, ProductImage, Product, User
+from sqlalchemy import delete, func, insert, update
+from sqlalchemy.orm import joinedload, selectinload
+from models import Order, OrderItem, Cart, CartProduct, Product, User
 from flask_jwt_extended import get_jwt_identity
 from schemas import OrderSchema, OrderItemSchema, OrderItemCombinedSchema, OrderAdminSchema, OrderItemCombinedAdminSchema
 import stripe
 from flask import current_app
-from services.utils import send_email, create_stripe_checkout_session, convert_utc_to_uk_time
-from services.product_service import ProductService, FeaturedProductService
-from services.user_service import UserService
-from exts import cache
+from services.utils import send_email, create_stripe_checkout_session, convert_utc_to_uk_time, get_first_product_image_paths, paginate_by_cursor
+from services.product_service import ProductService
+from services.statistic_service import StatisticService
+from services.stripe_sync_service import StripeSyncService, stripe_unit_amount
+from caching import cached, invalidate_tags
+from exts import db
 from dateutil.parser import parse
 
 # Define the schema instances
@@ -54,6 +58,9 @@ class OrderService:
             raise ValidationError('Cart is empty')
 
 
+        # Products waiting for the Stripe sync may not have a Stripe price yet, or their Stripe price may be out of date
+        pending_sync_product_ids = StripeSyncService.get_pending_product_ids([cart_item.product_id for cart_item in cart_items])
+
         # Create line items for Stripe checkout session
         line_items = []
         for cart_item in cart_items:
@@ -65,10 +72,21 @@ class OrderService:
             elif product.reserved_stock < cart_item.quantity:
                 raise ValidationError(f"{product.name} only has {cart_item.product.stock - cart_item.product.reserved_stock} available (reserved stock in use)")
             
-            line_items.append({
-                'price': cart_item.product.stripe_price_id, # Stripe price id
-                'quantity': cart_item.quantity
-            })
+            if product.stripe_price_id and product.id not in pending_sync_product_ids:
+                line_items.append({
+                    'price': cart_item.product.stripe_price_id, # Stripe price id
+                    'quantity': cart_item.quantity
+                })
+            else:
+                # Charge the current price with inline price data until the product is synced
+                line_items.append({
+                    'price_data': {
+                        'currency': 'gbp',
+                        'unit_amount': stripe_unit_amount(product.price), # Price in pence
+                        **({'product': product.stripe_product_id} if product.stripe_product_id else {'product_data': {'name': product.name}})
+                    },
+                    'quantity': cart_item.quantity
+                })
 
         # Lock the cart
         cart.locked = True
@@ -98,70 +116,85 @@ class OrderService:
         # Get the cart
         cart = Cart.query.filter_by(user_id=user).first()
 
-        # Get the cart items from the data
-        cart_items = Cart.query.get(cart.id).cart_products
+        # Check if the cart exists
+        if not cart:
+            raise ValidationError('Cart not found')
+
+        # Get the cart items along with their products in a single query
+        cart_items = CartProduct.query.filter_by(cart_id=cart.id).options(joinedload(CartProduct.product)).all()
 
         # Check if the cart is empty
         if not cart_items:
             raise ValidationError('Cart is empty')
 
-        # Create a new order
-        new_order = Order(
-            order_date = datetime.now(tz=ZoneInfo("UTC")), # Get the current date in the format YYYY-MM-DD
-            total_price = 0,
-            status = 'Processing', # Default status
-            full_name = valid_data['full_name'],
-            address_line_1 = valid_data['address_line_1'],
-            address_line_2 = valid_data['address_line_2'],
-            city = valid_data['city'],
-            postcode = valid_data['postcode'],
-            customer_email = valid_data['customer_email'],
-            stripe_session_id = valid_data['stripe_session_id'],
-            user_id = user,
-        )
-        new_order.save()
-
-        # Loop through cart items and create an order item for each
-        for cart_item in cart_items:
-            new_order_item = OrderItem(
-                quantity = cart_item.quantity,
-                name = cart_item.product.name,
-                price = cart_item.product.price,
-                product_id = cart_item.product_id,
-                order_id = new_order.id
+        # The order is created in a single transaction, so a failure part way through doesn't leave half an order behind
+        try:
+            # Create a new order
+            new_order = Order(
+                order_date = datetime.now(tz=ZoneInfo("UTC")), # Get the current date in the format YYYY-MM-DD
+                total_price = sum(cart_item.product.price * cart_item.quantity for cart_item in cart_items), # Total price of the cart items
+                status = 'Processing', # Default status
+                full_name = valid_data['full_name'],
+                address_line_1 = valid_data['address_line_1'],
+                address_line_2 = valid_data['address_line_2'],
+                city = valid_data['city'],
+                postcode = valid_data['postcode'],
+                customer_email = valid_data['customer_email'],
+                stripe_session_id = valid_data['stripe_session_id'],
+                user_id = user,
+            )
+            db.session.add(new_order)
+            db.session.flush() # Flush the order to get its id without committing
+
+            # Create an order item for each cart item with a single bulk insert
+            db.session.execute(insert(OrderItem), [
+                {
+                    'quantity': cart_item.quantity,
+                    'name': cart_item.product.name,
+                    'price': cart_item.product.price,
+                    'product_id': cart_item.product_id,
+                    'order_id': new_order.id
+                }
+                for cart_item in cart_items
+            ])
+
+            # Update the stock of every product in the cart with a single UPDATE ... FROM the cart products,
+            # the new stock is returned so the cache is only invalidated for what changed
+            updated_products = db.session.execute(
+                update(Product)
+                .where(Product.id == CartProduct.product_id, CartProduct.cart_id == cart.id)
+                .values(
+                    stock = Product.stock - CartProduct.quantity,
+                    reserved_stock = func.greatest(Product.reserved_stock - CartProduct.quantity, 0) # Ensure reserved stock doesn't go negative
+                )
+                .returning(Product.id, Product.category_id, Product.stock)
+                .execution_options(synchronize_session=False)
+            ).all()
+
+            # Delete the cart items with a single DELETE
+            db.session.execute(
+                delete(CartProduct)
+                .where(CartProduct.cart_id == cart.id)
+                .execution_options(synchronize_session=False)
             )
-            new_order_item.save()
-
-            # Delete the cart item
-            cart_item.delete()
-
-            # Update the product stock
-            product = Product.query.get(cart_item.product_id)
-
-            product.stock -= new_order_item.quantity
-            # product.reserved_stock -= new_order_item.quantity
-            product.reserved_stock = max(product.reserved_stock - new_order_item.quantity, 0) # Ensure reserved stock doesn't go negative
-            product.save()
 
-            # Update the total price of the order
-            new_order.total_price += new_order_item.price * new_order_item.quantity
+            # Unlock the cart
+            cart.locked = False
+            cart.locked_at = None
+            cart.product_added_at = None
 
-        # Save the updated order
-        new_order.save()
+            # Count the order in the dashboard statistics, this is done last as every order updates the same statistic rows
+            StatisticService.record_order_created(new_order)
 
-        # Unlock the cart
-        cart.locked = False
-        cart.locked_at = None
-        cart.product_added_at = None
-        cart.save()
+            # Commit the order, order items, stock changes and cart changes together
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
 
-        # Clear the cache for the products
-        cache.delete_memoized(ProductService.get_all_products) 
-        cache.delete_memoized(ProductService.get_all_admin_products)
-        cache.delete_memoized(FeaturedProductService.get_all_featured_products)
-        cache.delete_memoized(UserService.get_dashboard_data)
-        cache.delete_memoized(OrderService.get_all_customer_orders)
-        cache.delete_memoized(OrderService.get_all_of_a_users_orders)
+        # Clear the cache for the ordered products, the shop listings are only invalidated for products that sold out
+        ProductService.invalidate_stock_changes(updated_products)
+        invalidate_tags('dashboard', 'orders', f'user:{user}:orders')
 
         return new_order
     
@@ -174,7 +207,7 @@ class OrderService:
             raise ValidationError('User not found')
 
         # Get the orders for the user, order by order date in descending order, i.e. latest order first
-        query = Order.query.filter_by(user_id=user).order_by(Order.order_date.desc()) 
+        query = Order.query.filter_by(user_id=user).options(selectinload(Order.order_items)).order_by(Order.order_date.desc()) # Load the order items of the whole page in one query
         orders_query = query.paginate(page=page, per_page=per_page, error_out=False)
         orders = orders_query.items
 
@@ -182,26 +215,8 @@ class OrderService:
         if not orders:
             raise ValidationError('No orders found')
         
-        entire_order = []
-
-        # Get the order items for each order
-        for order in orders:
-            order_items = []
-
-            for order_item in order.order_items:
-
-                # Get the product image
-                product_image = ProductImage.query.filter_by(product_id=order_item.product_id).first()
-
-                if product_image:
-                    order_item.product_image = product_image.image_path                
-
-                order_items.append(order_item)
-
-            entire_order.append({
-                'order': order,
-                'order_items': order_items
-            })
+        # Attach the order items and their product images to each order
+        entire_order = OrderService.hydrate_orders(orders)
         
         # Serialize the data
         orders = order_item_combined_schema.dump(entire_order, many=True)
@@ -230,17 +245,8 @@ class OrderService:
         if not order:
             raise ValidationError('Order not found')
 
-        # Get the order items
-        order_items = []
-
-        for order_item in order.order_items:
-            # Get the product image
-            product_image = ProductImage.query.filter_by(product_id=order_item.product_id).first()
-
-            if product_image:
-                order_item.product_image = product_image.image_path
-            
-            order_items.append(order_item)
+        # Get the order items along with their product images
+        order_items = OrderService.hydrate_orders([order])[0]['order_items']
 
         # Get customer name and email if user exists
         if order.user:
@@ -278,7 +284,7 @@ class OrderService:
             return order       
 
     @staticmethod
-    @cache.memoize(timeout=86400) # Cache for 24 hours
+    @cached(timeout=86400, tags=lambda page, per_page, status: ['orders']) # Cache for 24 hours
     def get_all_customer_orders(page=1, per_page=10, status=None):
         print('Fetching customer orders')
         # Apply sorting
@@ -313,6 +319,42 @@ class OrderService:
             'current_page': orders_query.page,
             'total_orders': orders_query.total
         }
+
+    @staticmethod
+    @cached(timeout=86400, tags=lambda cursor, per_page, status, include_total: ['orders']) # Cache for 24 hours
+    def get_all_customer_orders_by_cursor(cursor=None, per_page=10, status=None, include_total=False):
+        print('Fetching customer orders by cursor')
+        query = Order.query
+
+        # Filter by status
+        if status in ['Processing', 'Shipped', 'Delivered']:
+            query = query.filter_by(status=status)
+
+        # Get the page after the cursor, latest orders first
+        orders, next_cursor = paginate_by_cursor(query, [Order.order_date, Order.id], cursor, per_page)
+
+        # Check if there are any orders
+        if not orders:
+            raise ValidationError('No orders found')
+        
+        # Serialize the data
+        orders = order_admin_schema.dump(orders, many=True)
+        
+        # Convert the order date to UK time
+        for order in orders:
+            if order['order_date']:
+                order["order_date"] = convert_utc_to_uk_time(parse(order['order_date'])).isoformat()
+
+        results = {
+            'orders': orders,
+            'next_cursor': next_cursor
+        }
+
+        # Only count the orders if asked to
+        if include_total:
+            results['total_orders'] = query.count()
+
+        return results
     
     @staticmethod
     def update_order_status(data, order_id):
@@ -357,19 +399,18 @@ class OrderService:
             # Update the order with the tracking URL
             order.tracking_url = valid_data.get('tracking_url')            
 
-        # Update the order status
+        # Update the order status, the dashboard statistics are committed with it
+        StatisticService.record_order_status_changed(order.status, order_status)
         order.status = order_status
         order.save()
 
         # Clear the cache
-        cache.delete_memoized(UserService.get_dashboard_data)
-        cache.delete_memoized(OrderService.get_all_customer_orders)
-        cache.delete_memoized(OrderService.get_all_of_a_users_orders)
+        invalidate_tags('dashboard', 'orders', f'user:{order.user_id}:orders')
 
         return order
 
     @staticmethod
-    @cache.memoize(timeout=86400) # Cache for 24 hours
+    @cached(timeout=86400, tags=lambda page, per_page, user_id: [f'user:{user_id}:orders']) # Cache for 24 hours
     def get_all_of_a_users_orders(page=1, per_page=6, user_id=None):
         print('Fetching user orders')
         # Check if the user id is provided
@@ -381,23 +422,40 @@ class OrderService:
             raise ValidationError('User not found')
 
         # Get the orders for the user, order by order date in descending order, i.e. latest order first
-        query = Order.query.filter_by(user_id=user_id).order_by(Order.order_date.desc()) 
+        query = Order.query.filter_by(user_id=user_id).options(selectinload(Order.order_items)).order_by(Order.order_date.desc()) # Load the order items of the whole page in one query
         orders_query = query.paginate(page=page, per_page=per_page, error_out=False)
         orders = orders_query.items        
         
+        # Attach the order items and their product images to each order
+        entire_order = OrderService.hydrate_orders(orders)
+        
+        # Serialize the data
+        orders = order_item_combined_schema.dump(entire_order, many=True)
+    
+        return {
+            'orders': orders,
+            'total_pages': orders_query.pages,
+            'current_page': orders_query.page,
+            'total_orders': orders_query.total
+        }
+
+    @staticmethod
+    def hydrate_orders(orders):
+        # Collect the product ids of every order item on the page
+        product_ids = {order_item.product_id for order in orders for order_item in order.order_items if order_item.product_id}
+
+        # Get the first image of every product in a single query rather than one query per order item
+        product_images = get_first_product_image_paths(product_ids)
+
         entire_order = []
 
-        # Get the order items for each order
+        # Attach the product image to each order item
         for order in orders:
             order_items = []
 
             for order_item in order.order_items:
-
-                # Get the product image
-                product_image = ProductImage.query.filter_by(product_id=order_item.product_id).first()
-
-                if product_image:
-                    order_item.product_image = product_image.image_path                
+                if order_item.product_id in product_images:
+                    order_item.product_image = product_images[order_item.product_id]
 
                 order_items.append(order_item)
 
@@ -405,16 +463,8 @@ class OrderService:
                 'order': order,
                 'order_items': order_items
             })
-        
-        # Serialize the data
-        orders = order_item_combined_schema.dump(entire_order, many=True)
-    
-        return {
-            'orders': orders,
-            'total_pages': orders_query.pages,
-            'current_page': orders_query.page,
-            'total_orders': orders_query.total
-        }
+
+        return entire_order
 
     @staticmethod
     def validate_stripe_session(session_id):
@@ -1,9 +1,15 @@
+from flask import current_app
 from marshmallow import ValidationError
 from models import Product, Category, FeaturedProduct, ProductImage
 from werkzeug.utils import secure_filename
 from schemas import ProductSchema, ProductImageSchema, FeaturedProductSchema, ProductShopSchema, ProductAdminSchema
-from services.utils import allowed_file, upload_image_to_google_cloud_storage, remove_image_from_google_cloud_storage, create_stripe_product_and_price, update_stripe_product_and_price, upload_image_to_stripe_product
-from exts import cache
+from services.utils import IMAGE_CONTENT_TYPES, allowed_file, upload_image_to_google_cloud_storage, remove_image_from_google_cloud_storage, generate_image_upload_url, get_uploaded_image, get_product_image_paths, first_product_image_subquery, paginate_by_cursor, normalise_search_query, product_search_tsquery, MIN_SEARCH_PREFIX_LENGTH, SUGGESTION_SIMILARITY_THRESHOLD, PRICE_FACET_BOUNDARIES, category_id_list, product_filter_conditions
+from services.stripe_sync_service import StripeSyncService
+from services.image_derivative_service import ImageDerivativeService
+from sqlalchemy import Float, Numeric, String, cast, func, literal, select, tuple_, union_all
+from sqlalchemy.dialects import postgresql
+from exts import db
+from caching import cached, invalidate_tags
 
 # Define the schema instances
 product_schema = ProductSchema()
@@ -42,26 +48,49 @@ class ProductService:
             category_id = valid_data['category_id']
         )
 
+        # The product and price objects are created in Stripe by the Stripe sync, the sync is requested in the same commit as the product
+        db.session.add(new_product)
+        db.session.flush()
+        StripeSyncService.request_product_sync([new_product.id])
         new_product.save()
+        StripeSyncService.queue_sync()
 
-        # Create the product and price objects in Stripe
-        create_stripe_product_and_price(new_product)
-
-        # Clear the cache
-        cache.delete_memoized(ProductService.get_all_products)
-        cache.delete_memoized(ProductService.get_all_admin_products)
+        # Clear the cache, only the listings the new product appears in. The shop listings including the out of stock
+        # products show it even without stock
+        invalidate_tags('admin_products')
+        ProductService.invalidate_product_listings([new_product.category_id])
 
         return new_product
 
     @staticmethod    
-    @cache.memoize(timeout=86400) # Cache the results for 24 hours
-    def get_all_products(page=1, per_page=9, category_id=None, sort_by=None):
+    @cached(
+        timeout=86400, # Cache the results for 24 hours
+        tags=lambda page, per_page, category_id, sort_by, min_price, max_price, in_stock_only: [f'category:{id}' for id in category_id_list(category_id)] or ['products'],
+        result_tags=lambda result: [f'product:{product["id"]}' for product in result['products']],
+        local=True # The shop listings are the hottest reads, so also kept in the in-process cache
+    )
+    def get_all_products(page=1, per_page=9, category_id=None, sort_by=None, min_price=None, max_price=None, in_stock_only=True):
         print('Fetching products')
-        query = Product.query.filter(Product.stock > 0) # Get all products with stock greater than 0
-        
-        # Check if a category id is provided
-        if category_id:
-            query = query.filter_by(category_id=category_id)
+        category_match, price_match = product_filter_conditions(category_id, min_price, max_price)
+
+        # Select only the columns needed for the shop listing, the category name is joined and the first image path
+        # is fetched with a correlated subquery so the page is loaded in a single query rather than 1 + 2N queries
+        query = (
+            Product.query
+            .join(Category, Product.category_id == Category.id)
+            .with_entities(
+                Product.id,
+                Product.name,
+                Product.price,
+                first_product_image_subquery().label('image_path'),
+                Category.name.label('category_name')
+            )
+            .filter(category_match, price_match) # Get the products in the categories and price range, if given
+        )
+
+        # Only show the products with stock greater than 0 unless the out of stock products are asked for
+        if in_stock_only:
+            query = query.filter(Product.stock > 0)
 
         # Apply sorting
         if sort_by == 'Name (A-Z)':
@@ -86,14 +115,13 @@ class ProductService:
         # Prepare the data to be serialized
         product_list = []
         
-        for product in products:        
-            image_path = product.product_images[0].image_path if product.product_images else None # Get the first image path if it exists
+        for product in products:
             product_data = {
                 'id': product.id,
                 'name': product.name,                
                 'price': product.price,                                
-                'image_path': image_path,
-                'category_name': product.category.name
+                'image_path': product.image_path,
+                'category_name': product.category_name
             }
             product_list.append(product_data)
         
@@ -108,7 +136,204 @@ class ProductService:
         }
     
     @staticmethod
-    @cache.memoize(timeout=86400) # Cache the results for 24 hours
+    @cached(
+        timeout=86400, # Cache the facets for 24 hours
+        tags=lambda category_id, min_price, max_price, in_stock_only: ['products'], # The category counts cover every category
+        local=True # Shown next to every shop listing, so also kept in the in-process cache
+    )
+    def get_product_facets(category_id=None, min_price=None, max_price=None, in_stock_only=True):
+        print('Fetching product facets')
+        category_match, price_match = product_filter_conditions(category_id, min_price, max_price)
+
+        # The products with the price range each is in and which of the filters it matches
+        products = (
+            select(
+                Product.category_id,
+                Category.name.label('category_name'),
+                func.width_bucket(Product.price, postgresql.array(PRICE_FACET_BOUNDARIES, type_=Numeric)).label('price_bucket'),
+                category_match.label('category_match'),
+                price_match.label('price_match'),
+                (Product.stock > 0).label('in_stock')
+            )
+            .join(Category, Product.category_id == Category.id)
+        )
+
+        if in_stock_only:
+            products = products.where(Product.stock > 0)
+
+        products = products.subquery()
+
+        # Count the products per category and per price range in one query with grouping sets. Like the search facets each
+        # count ignores its own filter, so the counts of the other categories and price ranges can be shown to pick from,
+        # the category rows have no price range and the price range rows have no category
+        rows = db.session.execute(
+            select(
+                products.c.category_id,
+                products.c.category_name,
+                products.c.price_bucket,
+                func.count().filter(products.c.price_match).label('category_count'),
+                func.count().filter(products.c.category_match).label('price_count'),
+                func.count().filter(products.c.category_match & products.c.price_match & products.c.in_stock).label('in_stock_count')
+            )
+            .group_by(func.grouping_sets(tuple_(products.c.category_id, products.c.category_name), products.c.price_bucket))
+        ).all()
+
+        category_rows = sorted([row for row in rows if row.category_id is not None], key=lambda row: row.category_name)
+        price_rows = sorted([row for row in rows if row.category_id is None], key=lambda row: row.price_bucket)
+        boundaries = [None, *PRICE_FACET_BOUNDARIES, None]
+
+        return {
+            'categories': [
+                {'category_id': row.category_id, 'category_name': row.category_name, 'product_count': row.category_count}
+                for row in category_rows if row.category_count
+            ],
+            'price_ranges': [
+                {'min_price': boundaries[row.price_bucket], 'max_price': boundaries[row.price_bucket + 1], 'product_count': row.price_count}
+                for row in price_rows if row.price_count
+            ],
+            # Every product is in one category, so the in stock products are counted by adding up the category rows
+            'in_stock_count': sum(row.in_stock_count for row in category_rows)
+        }
+
+    @staticmethod
+    def search_products(query, page=1, per_page=9, category_id=None):
+        # Normalise the search before the cached lookup, so 'Boots' and ' boots' share a cache entry
+        query = normalise_search_query(query)
+
+        # Check if a search query is provided
+        if not query:
+            raise ValidationError('No search query provided')
+
+        return ProductService.get_search_results(query, page, per_page, category_id)
+
+    @staticmethod
+    @cached(
+        timeout=3600, # Cache the results for 1 hour
+        tags=lambda query, page, per_page, category_id: ['product_search'],
+        result_tags=lambda result: [f'product:{product["id"]}' for product in result['products']] + [f'category:{facet["category_id"]}' for facet in result['facets']]
+    )
+    def get_search_results(query, page, per_page, category_id):
+        print('Searching products')
+        tsquery = product_search_tsquery(query)
+
+        # Products in stock matching every word of the search, found with the GIN index on the search vector and ranked so a
+        # match in the name ranks above a match in the description. The matches are read once and used for both the facets
+        # and the page, reading them is most of the time taken by a search
+        matches = (
+            select(Product.id, Product.category_id, func.ts_rank(Product.search_vector, tsquery).label('rank'))
+            .where(Product.search_vector.bool_op('@@')(tsquery), Product.stock > 0)
+            .cte('matches')
+        )
+
+        # The matches in each category, the facets ignore the category filter so the customer can switch category
+        facets = (
+            select(literal('facet').label('kind'), Category.id, Category.name, cast(func.count(), Float).label('value'))
+            .select_from(matches)
+            .join(Category, Category.id == matches.c.category_id)
+            .group_by(Category.id, Category.name)
+        )
+
+        # The ids of the products on the page, best matches first
+        page_ids = select(literal('product'), matches.c.id, literal(None, String), cast(matches.c.rank, Float)).order_by(matches.c.rank.desc(), matches.c.id.desc())
+        if category_id:
+            page_ids = page_ids.where(matches.c.category_id == category_id)
+        page_ids = page_ids.limit(per_page).offset((max(page, 1) - 1) * per_page)
+
+        rows = db.session.execute(union_all(facets, page_ids.subquery().select())).all()
+
+        facets = sorted(
+            [{'category_id': row.id, 'category_name': row.name, 'product_count': int(row.value)} for row in rows if row.kind == 'facet'],
+            key=lambda facet: (-facet['product_count'], facet['category_name'])
+        )
+        product_ids = [row.id for row in rows if row.kind == 'product']
+
+        # The total is taken from the facets rather than counted again
+        total_products = sum(facet['product_count'] for facet in facets if not category_id or facet['category_id'] == category_id)
+
+        # Load the products on the page by primary key, with the columns shown in the shop listing
+        products = (
+            Product.query
+            .join(Category, Product.category_id == Category.id)
+            .with_entities(
+                Product.id,
+                Product.name,
+                Product.price,
+                first_product_image_subquery().label('image_path'),
+                Category.name.label('category_name')
+            )
+            .filter(Product.id.in_(product_ids))
+            .all()
+        ) if product_ids else []
+
+        products = sorted(products, key=lambda product: product_ids.index(product.id))
+
+        return {
+            'products': product_shop_schema.dump([product._asdict() for product in products], many=True),
+            'facets': facets,
+            'total_pages': -(-total_products // per_page),
+            'current_page': page,
+            'total_products': total_products
+        }
+
+    @staticmethod
+    def autocomplete_products(query, limit=5):
+        query = normalise_search_query(query)
+
+        # Nothing typed yet
+        if not query:
+            return []
+
+        # At most 10 suggestions, only the ids and names fit in the search box dropdown
+        limit = max(1, min(limit, 10))
+
+        return ProductService.get_autocomplete_suggestions(query, limit)
+
+    @staticmethod
+    @cached(
+        timeout=3600, # Cache the suggestions for 1 hour
+        tags=lambda query, limit: ['product_search'], # Every typed search is cached separately
+        result_tags=lambda result: [f'product:{product["id"]}' for product in result],
+        local=True # Requested on every key press, so also kept in the in-process cache
+    )
+    def get_autocomplete_suggestions(query, limit):
+        print('Fetching search suggestions')
+        tsquery = product_search_tsquery(query)
+
+        # Only the names are returned, the products matching by name rank first
+        products = db.session.execute(
+            select(Product.id, Product.name)
+            .where(Product.search_vector.bool_op('@@')(tsquery), Product.stock > 0)
+            .order_by(func.ts_rank(Product.search_vector, tsquery).desc(), Product.id.desc())
+            .limit(limit)
+        ).all()
+
+        # Fewer products match the typed words than were asked for, the words may be misspelt. Fill up the suggestions by
+        # matching the search against the words of the product names by trigram similarity, so 'lether' still finds
+        # 'Leather'. The <% operator uses the trigram index on the names and the closest names come first, a trigram
+        # needs three letters
+        if len(products) < limit and len(query) >= MIN_SEARCH_PREFIX_LENGTH:
+            # The default threshold of 0.6 is too strict for a misspelt word, the setting lasts until the end of the transaction
+            db.session.execute(select(func.set_config('pg_trgm.word_similarity_threshold', str(SUGGESTION_SIMILARITY_THRESHOLD), True)))
+
+            products += db.session.execute(
+                select(Product.id, Product.name)
+                .where(
+                    literal(query).bool_op('<%')(Product.name),
+                    Product.stock > 0,
+                    Product.id.not_in([product.id for product in products]) # Already suggested by the prefix match
+                )
+                .order_by(func.word_similarity(query, Product.name).desc(), Product.name.asc())
+                .limit(limit - len(products))
+            ).all()
+
+        return [{'id': product.id, 'name': product.name} for product in products]
+
+    @staticmethod
+    @cached(
+        timeout=86400, # Cache the results for 24 hours
+        tags=lambda page, per_page, category_id: ['admin_products'],
+        result_tags=lambda result: [tag for product in result['products'] for tag in (f'product:{product["id"]}', f'product:{product["id"]}:stock')] # The admin listing also shows the stock
+    )
     def get_all_admin_products(page=1, per_page=10, category_id=None):
         print('Fetching admin products')
         query = Product.query.order_by(Product.id.desc()) # Get all products in descending order of id (latest products first)
@@ -134,6 +359,38 @@ class ProductService:
             'total_products': products_query.total
         }
 
+    @staticmethod
+    @cached(
+        timeout=86400, # Cache the results for 24 hours
+        tags=lambda cursor, per_page, category_id, include_total: ['admin_products'],
+        result_tags=lambda result: [tag for product in result['products'] for tag in (f'product:{product["id"]}', f'product:{product["id"]}:stock')] # The admin listing also shows the stock
+    )
+    def get_all_admin_products_by_cursor(cursor=None, per_page=10, category_id=None, include_total=False):
+        print('Fetching admin products by cursor')
+        query = Product.query
+
+        if category_id:
+            query = query.filter_by(category_id=category_id)
+
+        # Get the page after the cursor, latest products first
+        products, next_cursor = paginate_by_cursor(query, [Product.id], cursor, per_page)
+
+        # Check if there are any products
+        if not products:
+            raise ValidationError('No products found')
+        
+        # Serialize the data
+        results = {
+            'products': product_admin_schema.dump(products, many=True),
+            'next_cursor': next_cursor
+        }
+
+        # Only count the products if asked to
+        if include_total:
+            results['total_products'] = query.count()
+
+        return results
+
     @staticmethod
     def get_product(product_id):
         # Check if the product id is provided
@@ -180,9 +437,6 @@ class ProductService:
             if not category:
                 raise ValidationError('Category not found')
 
-        # Update the stripe product and price objects
-        update_stripe_product_and_price(product, valid_data)
-        
         if 'stock' in valid_data:
             # Check if the stock is a negative number
             if valid_data['stock'] < 0:
@@ -192,18 +446,40 @@ class ProductService:
             if product.reserved_stock > valid_data['stock']:
                 raise ValidationError('Stock cannot be less than the reserved stock')        
 
+        # Keep the old values to work out which listings the update affects
+        old_category_id = product.category_id
+        was_in_stock = product.stock > 0
+
         # Update product details
         # Loop through the data and update the product attributes using the key-value pairs in the data
         for key, value in valid_data.items():
             setattr(product, key, value) 
 
-        # Clear the cache
-        cache.delete_memoized(ProductService.get_all_products)
-        cache.delete_memoized(ProductService.get_all_admin_products)
-        cache.delete_memoized(FeaturedProductService.get_all_featured_products)
+        # Push the changes shown on Stripe to the Stripe product and price objects, the sync is requested in the same commit as the changes
+        stripe_changes = {'name', 'description', 'price'} & valid_data.keys()
+        if stripe_changes:
+            StripeSyncService.request_product_sync([product.id])
 
         product.save()
 
+        if stripe_changes:
+            StripeSyncService.queue_sync()
+
+        # Clear the cache, every cached page showing the product
+        invalidate_tags(f'product:{product.id}', f'product:{product.id}:stock')
+
+        # The product moves in or out of the listings, or its position in a sorted listing can change
+        if (
+            was_in_stock != (product.stock > 0)
+            or old_category_id != product.category_id
+            or 'name' in valid_data
+            or 'price' in valid_data
+        ):
+            ProductService.invalidate_product_listings({old_category_id, product.category_id})
+        elif 'description' in valid_data:
+            # Only the search matches the description
+            invalidate_tags('product_search')
+
         return product
        
     @staticmethod
@@ -221,19 +497,36 @@ class ProductService:
         # Get the product images
         product_images = ProductImage.query.filter_by(product_id=product_id).all()
 
-        # Loop through the product images and remove them from Google Cloud Storage
+        # Loop through the product images and remove them and their variants from Google Cloud Storage
         for product_image in product_images:
-            remove_image_from_google_cloud_storage(product_image.image_path)                
+            for image_path in get_product_image_paths(product_image):
+                remove_image_from_google_cloud_storage(image_path)
 
         # Delete the product
         product.delete()
 
         # Clear the cache
-        cache.delete_memoized(ProductService.get_all_products)
-        cache.delete_memoized(ProductService.get_all_admin_products)
-        cache.delete_memoized(FeaturedProductService.get_all_featured_products)
+        invalidate_tags('admin_products', f'product:{product.id}', f'product:{product.id}:stock')
+        ProductService.invalidate_product_listings([product.category_id])
 
         return product
+
+    @staticmethod
+    def invalidate_product_listings(category_ids):
+        # A product has been added to or removed from the shop listings, or moved within them.
+        # Only the unfiltered listing, the listings of the given categories, the featured products and the search results are invalidated
+        invalidate_tags('products', 'featured_products', 'product_search', *[f'category:{category_id}' for category_id in category_ids])
+
+    @staticmethod
+    def invalidate_stock_changes(products):
+        # Invalidate the cache after the stock of the given products (rows with id, category_id and stock) has gone down.
+        # Only the cached pages showing the stock of one of the products are invalidated, the shop listings don't show the stock
+        # so they only change for products that have sold out
+        invalidate_tags(*[f'product:{product.id}:stock' for product in products])
+
+        sold_out_category_ids = {product.category_id for product in products if product.stock <= 0}
+        if sold_out_category_ids:
+            ProductService.invalidate_product_listings(sold_out_category_ids)
     
 class FeaturedProductService:
     @staticmethod
@@ -265,37 +558,52 @@ class FeaturedProductService:
         new_featured_product.save()
 
         # Clear the cache
-        cache.delete_memoized(FeaturedProductService.get_all_featured_products)
+        invalidate_tags('featured_products')
 
         return new_featured_product
     
     @staticmethod
-    @cache.memoize(timeout=86400) # Cache the results for 24 hours
+    @cached(
+        timeout=86400, # Cache the results for 24 hours
+        tags=lambda: ['featured_products'],
+        result_tags=lambda result: [f'product:{product["id"]}' for product in result],
+        local=True # Read on every page view, so also kept in the in-process cache
+    )
     def get_all_featured_products():
         print('Fetching featured products')
-        featured_products = FeaturedProduct.query.all()
+        # Get the featured products along with their category name and first image path in a single query
+        featured_products = (
+            FeaturedProduct.query
+            .join(Product, FeaturedProduct.product_id == Product.id)
+            .join(Category, Product.category_id == Category.id)
+            .with_entities(
+                Product.id,
+                Product.name,
+                Product.price,
+                Product.stock,
+                first_product_image_subquery().label('image_path'),
+                Category.name.label('category_name')
+            )
+            .order_by(FeaturedProduct.id.asc())
+            .all()
+        )
 
         # Check if there are any featured products
         if not featured_products:
             raise ValidationError('No featured products found')
-        
-        # Get the products associated with the featured products
-        # List comprehension to add all products associated with each featured product to a list, similar to a for loop
-        products = [featured_product.product for featured_product in featured_products] 
 
          # Prepare the data to be serialized
         product_list = []
         
-        for product in products:
+        for product in featured_products:
             # If products stock is 0, dont add it to the list
             if product.stock > 0:
-                image_path = product.product_images[0].image_path if product.product_images else None # Get the first image path if it exists
                 product_data = {
                     'id': product.id,
                     'name': product.name,                
                     'price': product.price,                                
-                    'image_path': image_path,
-                    'category_name': product.category.name
+                    'image_path': product.image_path,
+                    'category_name': product.category_name
                 }            
 
                 product_list.append(product_data)
@@ -337,7 +645,7 @@ class FeaturedProductService:
         featured_product.delete()
 
         # Clear the cache
-        cache.delete_memoized(FeaturedProductService.get_all_featured_products)
+        invalidate_tags('featured_products')
 
         return featured_product
     
@@ -362,7 +670,8 @@ class ProductImageService:
 
         # if product_image exists, delete the image and create a new one
         if product_image:
-            remove_image_from_google_cloud_storage(product_image.image_path)
+            for image_path in get_product_image_paths(product_image):
+                remove_image_from_google_cloud_storage(image_path)
             product_image.delete()
         
         new_product_image = ProductImage(
@@ -370,7 +679,13 @@ class ProductImageService:
             product_id = valid_data['product_id']
         )
 
+        # Show the new image on the Stripe product
+        StripeSyncService.request_product_sync([new_product_image.product_id])
         new_product_image.save()
+        StripeSyncService.queue_sync()
+
+        # Generate the thumbnails and WebP/AVIF variants in the background
+        ImageDerivativeService.queue_derivatives(new_product_image.id)
 
         return new_product_image
 
@@ -400,9 +715,6 @@ class ProductImageService:
         # Upload the image file to Google Cloud Storage
         image_path = upload_image_to_google_cloud_storage(image_file)
 
-        # Upload the image file to Stripe product
-        upload_image_to_stripe_product(product, image_path)
-
         data = {
             'image_path': image_path,
             'product_id': product_id
@@ -411,14 +723,81 @@ class ProductImageService:
         # Create a new product image
         new_product_image = ProductImageService.create_product_image(data)
 
-        # Clear the cache
-        cache.delete_memoized(ProductImageService.get_product_image)
-        cache.delete_memoized(FeaturedProductService.get_all_featured_products)
+        # Clear the cache, every cached page showing the product's image
+        invalidate_tags(f'product:{product_id}')
 
         return new_product_image
     
     @staticmethod
-    @cache.memoize(timeout=86400) # Cache the results for 24 hours
+    def create_product_image_upload_url(data, product_id):
+        # Check signed URL uploads are enabled
+        if not current_app.config.get('GOOGLE_CLOUD_STORAGE_SIGNED_URL_UPLOADS'):
+            raise ValidationError('Signed URL uploads are not enabled')
+
+        # Check if data is provided
+        if not data or not data.get('filename') or not data.get('content_type'):
+            raise ValidationError('No filename or content type provided')
+
+        product = Product.query.get(product_id)
+
+        # Check if the product exists
+        if not product:
+            raise ValidationError('Product not found')
+
+        # Ensure the filename is secure
+        filename = secure_filename(data['filename'])
+
+        # Ensure the image file is an image
+        if not allowed_file(filename) or data['content_type'] not in IMAGE_CONTENT_TYPES:
+            raise ValidationError('Invalid image file')
+
+        # Create a signed URL for the browser to upload the image file to
+        upload_url, image_path = generate_image_upload_url(filename, data['content_type'])
+
+        return {
+            'upload_url': upload_url,
+            'image_path': image_path,
+            'content_type': data['content_type']
+        }
+
+    @staticmethod
+    def confirm_product_image_upload(data, product_id):
+        # Check signed URL uploads are enabled
+        if not current_app.config.get('GOOGLE_CLOUD_STORAGE_SIGNED_URL_UPLOADS'):
+            raise ValidationError('Signed URL uploads are not enabled')
+
+        # Check if data is provided
+        if not data or not data.get('image_path'):
+            raise ValidationError('No image path provided')
+
+        # Check the browser uploaded the image file to the bucket
+        blob = get_uploaded_image(data['image_path'])
+
+        if not blob:
+            raise ValidationError('Image file not uploaded')
+
+        # The content type is set by the browser, so check the uploaded file is an image
+        if blob.content_type not in IMAGE_CONTENT_TYPES:
+            remove_image_from_google_cloud_storage(data['image_path'])
+            raise ValidationError('Invalid image file')
+
+        # Create a new product image
+        new_product_image = ProductImageService.create_product_image({
+            'image_path': data['image_path'],
+            'product_id': product_id
+        })
+
+        # Clear the cache, every cached page showing the product's image
+        invalidate_tags(f'product:{product_id}')
+
+        return new_product_image
+
+    @staticmethod
+    @cached(
+        timeout=86400, # Cache the results for 24 hours
+        tags=lambda product_id: [f'product:{product_id}'],
+        local=True # Read for every product shown, so also kept in the in-process cache
+    )
     def get_product_image(product_id):
         print('Fetching product image')
         # Check if the product id is provided
@@ -460,6 +839,6 @@ class ProductImageService:
     #     product_image.delete()
 
     #     # Clear the cache
-    #     cache.delete_memoized(ProductImageService.get_product_image)
+    #     invalidate_tags(f'product:{product_image.product_id}')
 
     #     return product_image
@@ -0,0 +1,118 @@
+import random
+from sqlalchemy import delete, func, insert, select, text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from models import DashboardStatistic, Order, User
+from exts import db
+
+# Orders with these statuses count as ongoing
+ONGOING_ORDER_STATUSES = ['Processing', 'Shipped']
+
+# The user count is split over this many rows. Every anonymous visitor adding to their cart creates a guest user, so the
+# increments are spread over the rows rather than every guest request waiting for the lock on one row
+USER_COUNT_SHARDS = 16
+
+# Get the name of one of the rows the user count is split over, the total_users row holds the count of the last rebuild
+def users_shard_statistic(shard):
+    return f'total_users:{shard}'
+
+# Get the name of the statistic counting the orders placed in the month of the given date
+def orders_in_month_statistic(year, month):
+    return f'orders_in_month:{year}-{month:02d}'
+
+# Services
+class StatisticService:
+    @staticmethod
+    def increment(deltas):
+        # Add the deltas to the statistics with a single INSERT ... ON CONFLICT DO UPDATE, creating statistics that don't exist yet.
+        # This runs in the caller's transaction so the statistics are committed together with the change they count.
+        # The rows are sorted by name so concurrent transactions lock them in the same order and can't deadlock
+        rows = [{'name': name, 'value': value} for name, value in sorted(deltas.items()) if value]
+
+        if not rows:
+            return
+
+        statement = postgresql_insert(DashboardStatistic).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[DashboardStatistic.name],
+            set_={'value': DashboardStatistic.value + statement.excluded.value}
+        )
+
+        db.session.execute(statement)
+
+    @staticmethod
+    def record_users_created(count=1):
+        StatisticService.increment({users_shard_statistic(random.randrange(USER_COUNT_SHARDS)): count})
+
+    @staticmethod
+    def record_users_deleted(count=1):
+        StatisticService.increment({users_shard_statistic(random.randrange(USER_COUNT_SHARDS)): -count})
+
+    @staticmethod
+    def record_order_created(order):
+        StatisticService.increment({
+            'orders_overall': 1,
+            'ongoing_orders': 1 if order.status in ONGOING_ORDER_STATUSES else 0,
+            'total_revenue': order.total_price,
+            orders_in_month_statistic(order.order_date.year, order.order_date.month): 1
+        })
+
+    @staticmethod
+    def record_order_status_changed(old_status, new_status):
+        StatisticService.increment({
+            'ongoing_orders': (new_status in ONGOING_ORDER_STATUSES) - (old_status in ONGOING_ORDER_STATUSES)
+        })
+
+    @staticmethod
+    def get_dashboard_statistics(year):
+        # Read the totals and the monthly order counts of the year by primary key, this doesn't depend on the number of orders or users
+        user_names = ['total_users'] + [users_shard_statistic(shard) for shard in range(USER_COUNT_SHARDS)]
+        names = user_names + ['ongoing_orders', 'orders_overall', 'total_revenue'] + [orders_in_month_statistic(year, month) for month in range(1, 13)]
+
+        statistics = db.session.execute(
+            select(DashboardStatistic.name, DashboardStatistic.value).where(DashboardStatistic.name.in_(names))
+        ).all()
+
+        statistics = {name: value for name, value in statistics}
+
+        return {
+            'total_users': int(sum(statistics.get(name, 0) for name in user_names)),
+            'ongoing_orders': int(statistics.get('ongoing_orders', 0)),
+            'orders_overall': int(statistics.get('orders_overall', 0)),
+            'total_revenue': round(float(statistics.get('total_revenue', 0)), 2), # Round the total revenue to 2 decimal places
+            'graph_data': {month: int(statistics.get(orders_in_month_statistic(year, month), 0)) for month in range(1, 13)}
+        }
+
+    @staticmethod
+    def rebuild():
+        # Rebuild every statistic from the users and orders tables.
+        # The table lock waits for transactions that have already incremented a statistic to commit and makes new increments
+        # wait for the rebuild, so no increment is lost or counted twice
+        try:
+            db.session.execute(text('LOCK TABLE "Dashboard_Statistic" IN EXCLUSIVE MODE'))
+            db.session.execute(delete(DashboardStatistic))
+
+            totals = db.session.execute(
+                select(
+                    select(func.count(User.id)).scalar_subquery().label('total_users'),
+                    select(func.count(Order.id)).where(Order.status.in_(ONGOING_ORDER_STATUSES)).scalar_subquery().label('ongoing_orders'),
+                    select(func.count(Order.id)).scalar_subquery().label('orders_overall'),
+                    select(func.coalesce(func.sum(Order.total_price), 0)).scalar_subquery().label('total_revenue')
+                )
+            ).one()
+
+            # The monthly order counts, the months are taken in UTC
+            order_month = func.to_char(func.timezone('UTC', Order.order_date), 'YYYY-MM')
+            orders_per_month = db.session.execute(
+                select(order_month.label('month'), func.count(Order.id).label('order_count')).group_by(order_month)
+            ).all()
+
+            rows = [{'name': name, 'value': value} for name, value in totals._mapping.items()]
+            rows += [{'name': f'orders_in_month:{month}', 'value': order_count} for month, order_count in orders_per_month]
+
+            db.session.execute(insert(DashboardStatistic), rows)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        return {row['name']: row['value'] for row in rows}
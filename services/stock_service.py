@@ -0,0 +1,101 @@
+from marshmallow import ValidationError
+from sqlalchemy import Integer, column, delete, func, select, update, values
+from models import CartProduct, Product
+from exts import db
+
+# Services
+class StockService:
+    @staticmethod
+    def reserve_stock(product_id, quantity):
+        # Reserve the stock with a single conditional UPDATE, the row is only updated if enough unreserved stock is available.
+        # The check and the write happen in the database, so concurrent requests can't oversell a product
+        # and the row is only locked for the statement rather than for a read-modify-write in Python
+        reserved = db.session.execute(
+            update(Product)
+            .where(Product.id == product_id, Product.stock - Product.reserved_stock >= quantity)
+            .values(reserved_stock=Product.reserved_stock + quantity)
+            .returning(Product.id, Product.stock, Product.reserved_stock)
+            .execution_options(synchronize_session=False)
+        ).first()
+
+        # No row is returned if the product doesn't exist or doesn't have enough unreserved stock
+        if not reserved:
+            raise ValidationError('Product is out of stock.')
+
+        return reserved
+
+    @staticmethod
+    def release_stock(product_id, quantity):
+        # Release the reserved stock with a single UPDATE
+        released = db.session.execute(
+            update(Product)
+            .where(Product.id == product_id)
+            .values(reserved_stock=func.greatest(Product.reserved_stock - quantity, 0)) # Ensure reserved stock doesn't go negative
+            .returning(Product.id, Product.stock, Product.reserved_stock)
+            .execution_options(synchronize_session=False)
+        ).first()
+
+        return released
+
+    @staticmethod
+    def adjust_reserved_stock(product_id, quantity_difference):
+        # Reserve more stock if the quantity has gone up, release stock if it has gone down
+        if quantity_difference > 0:
+            return StockService.reserve_stock(product_id, quantity_difference)
+        elif quantity_difference < 0:
+            return StockService.release_stock(product_id, -quantity_difference)
+
+        return None
+
+    @staticmethod
+    def delete_cart_products_for_carts(cart_ids):
+        # Delete the cart products of the given carts (a list of ids or a select of ids). The deleted rows are returned by a
+        # DELETE ... RETURNING CTE and summed per product with a GROUP BY, so exactly the deleted quantities can be released
+        # however many carts there are
+        deleted_cart_products = (
+            delete(CartProduct)
+            .where(CartProduct.cart_id.in_(cart_ids))
+            .returning(CartProduct.product_id, CartProduct.quantity)
+            .cte('deleted_cart_products')
+        )
+
+        # The product id, the total quantity and the number of cart products deleted of each product
+        return db.session.execute(
+            select(
+                deleted_cart_products.c.product_id,
+                func.sum(deleted_cart_products.c.quantity).label('quantity'),
+                func.count().label('cart_products')
+            )
+            .group_by(deleted_cart_products.c.product_id)
+        ).all()
+
+    @staticmethod
+    def release_reserved_stock_quantities(quantities):
+        # Release the reserved stock of the products with a single UPDATE ... FROM (VALUES ...), the quantities are rows with
+        # a product_id and a quantity, e.g. returned by delete_cart_products_for_carts
+        if not quantities:
+            return 0, 0
+
+        released_stock = values(
+            column('product_id', Integer),
+            column('quantity', Integer),
+            name='released_stock'
+        ).data([(row.product_id, row.quantity) for row in quantities])
+
+        released = db.session.execute(
+            update(Product)
+            .where(Product.id == released_stock.c.product_id)
+            .values(reserved_stock=func.greatest(Product.reserved_stock - released_stock.c.quantity, 0)) # Ensure reserved stock doesn't go negative
+            .returning(Product.id, released_stock.c.quantity)
+            .execution_options(synchronize_session=False)
+        ).all()
+
+        # Return the number of products and the total quantity released
+        return len(released), sum(quantity for _, quantity in released)
+
+    @staticmethod
+    def release_reserved_stock_for_carts(cart_ids):
+        # Delete the cart products of the given carts and release their reserved stock
+        deleted = StockService.delete_cart_products_for_carts(cart_ids)
+
+        return StockService.release_reserved_stock_quantities(deleted)
\ No newline at end of file
@@ -0,0 +1,232 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from flask import current_app
+from sqlalchemy import delete, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from models import Product, ProductImage, StripeProductSync
+from exts import db
+import exts
+import stripe
+from instrumentation import instrument_external_call
+
+# Seconds a worker has to sync a product before another worker can claim it
+SYNC_LEASE = 60 * 5
+SYNC_RETRY_BACKOFF = 30 # Seconds before the first retry, doubled after each failed attempt
+SYNC_RETRY_BACKOFF_MAX = 60 * 60
+
+# Convert a price in pounds to pence for Stripe
+def stripe_unit_amount(price):
+    return int(round(price * 100))
+
+# Services
+class StripeSyncService:
+    @staticmethod
+    def request_product_sync(product_ids):
+        # Add the products to the outbox with a single INSERT ... ON CONFLICT DO UPDATE, a product already waiting is kept
+        # as one row with the latest request time. This runs in the caller's transaction so the sync is only requested if
+        # the product change is committed, and a committed change is never left without a sync
+        now = datetime.now(tz=ZoneInfo("UTC"))
+        rows = [{'product_id': product_id, 'requested_at': now, 'next_attempt_at': now, 'attempts': 0} for product_id in sorted(set(product_ids))]
+
+        if not rows:
+            return
+
+        statement = postgresql_insert(StripeProductSync).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[StripeProductSync.product_id],
+            set_={'requested_at': statement.excluded.requested_at, 'next_attempt_at': statement.excluded.next_attempt_at, 'attempts': 0, 'last_error': None}
+        )
+
+        db.session.execute(statement)
+
+    @staticmethod
+    def queue_sync():
+        # Ask the Celery worker to process the outbox now rather than at its next scheduled run,
+        # the outbox is processed straight away if tasks are run eagerly, e.g. in testing
+        if current_app.config.get('CELERY_TASK_ALWAYS_EAGER'):
+            StripeSyncService.process_pending()
+            return
+
+        try:
+            exts.celery_client.send_task('tasks.stripe_sync.process_stripe_sync_outbox')
+        except Exception as e:
+            # The change is already in the outbox, so the scheduled run will sync it
+            print(f"Failed to queue the Stripe sync: {str(e)}")
+
+    @staticmethod
+    def get_pending_product_ids(product_ids):
+        # Get the products whose latest change hasn't been pushed to Stripe yet
+        return set(db.session.scalars(select(StripeProductSync.product_id).where(StripeProductSync.product_id.in_(product_ids))))
+
+    @staticmethod
+    def claim_pending(limit):
+        # Claim the products that are due with a lease, SKIP LOCKED lets concurrent workers claim different products.
+        # The claim is committed before calling Stripe so no transaction is held open during the API calls
+        now = datetime.now(tz=ZoneInfo("UTC"))
+
+        claimable = (
+            select(StripeProductSync.product_id)
+            .where(
+                StripeProductSync.next_attempt_at <= now,
+                or_(StripeProductSync.locked_until.is_(None), StripeProductSync.locked_until < now)
+            )
+            .order_by(StripeProductSync.next_attempt_at)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+        )
+
+        claimed = db.session.execute(
+            update(StripeProductSync)
+            .where(StripeProductSync.product_id.in_(claimable.scalar_subquery()))
+            .values(locked_until=now + timedelta(seconds=SYNC_LEASE))
+            .returning(StripeProductSync.product_id, StripeProductSync.requested_at, StripeProductSync.attempts)
+            .execution_options(synchronize_session=False)
+        ).all()
+        db.session.commit()
+
+        return claimed
+
+    @staticmethod
+    @instrument_external_call('stripe')
+    def sync_product(product, requested_at):
+        # Push the current state of the product to Stripe. The sync works from the product's state rather than the changes made,
+        # so running it again is harmless. The creates use idempotency keys, so a retry after a failure part way through
+        # gets back the objects already created instead of duplicating them
+        fields = {'name': product.name, 'description': product.description}
+
+        # Show the latest product image on Stripe
+        product_image = ProductImage.query.filter_by(product_id=product.id).order_by(ProductImage.id.desc()).first()
+        if product_image:
+            fields['images'] = ["https://storage.googleapis.com/" + product_image.image_path]
+
+        if not product.stripe_product_id:
+            stripe_product = stripe.Product.create(
+                **fields,
+                metadata={
+                    'product_id': product.id # Track local product id in stripe
+                },
+                idempotency_key=f'product-{product.id}-create'
+            )
+
+            # Save the id straight away, so a failure later in the sync doesn't create a second Stripe product
+            product.stripe_product_id = stripe_product.id
+            db.session.commit()
+        else:
+            stripe.Product.modify(product.stripe_product_id, **fields)
+
+        # Stripe prices can't be changed, so a new price is created when the amount changes and the old one is set to inactive
+        unit_amount = stripe_unit_amount(product.price)
+        current_price = stripe.Price.retrieve(product.stripe_price_id) if product.stripe_price_id else None
+
+        if current_price is None or current_price.unit_amount != unit_amount or not current_price.active:
+            stripe_price = stripe.Price.create(
+                unit_amount=unit_amount, # Price in pence
+                currency='gbp', # Set currency to GBP
+                product=product.stripe_product_id,
+                idempotency_key=f'product-{product.id}-price-{unit_amount}-{requested_at.timestamp()}' # Unique to this change, the same amount can be set again later
+            )
+
+            product.stripe_price_id = stripe_price.id
+            db.session.commit()
+
+            if current_price is not None and current_price.active:
+                stripe.Price.modify(current_price.id, active=False)
+
+    @staticmethod
+    def process_pending(limit=100):
+        synced = 0
+        failed = 0
+
+        for product_id, requested_at, attempts in StripeSyncService.claim_pending(limit):
+            try:
+                product = db.session.get(Product, product_id)
+
+                # The row is deleted with the product, but the product may have been deleted after it was claimed
+                if product:
+                    StripeSyncService.sync_product(product, requested_at)
+
+                # Remove the product from the outbox, unless it was changed again during the sync, then it is released to be synced again
+                removed = db.session.execute(
+                    delete(StripeProductSync)
+                    .where(StripeProductSync.product_id == product_id, StripeProductSync.requested_at == requested_at)
+                ).rowcount
+
+                if not removed:
+                    db.session.execute(update(StripeProductSync).where(StripeProductSync.product_id == product_id).values(locked_until=None))
+
+                db.session.commit()
+                synced += 1
+            except Exception as e:
+                db.session.rollback()
+                print(f"Failed to sync product {product_id} to Stripe: {str(e)}")
+
+                # Release the claim and back off exponentially before the next attempt
+                delay = min(SYNC_RETRY_BACKOFF * 2 ** attempts, SYNC_RETRY_BACKOFF_MAX)
+                db.session.execute(
+                    update(StripeProductSync)
+                    .where(StripeProductSync.product_id == product_id)
+                    .values(
+                        locked_until=None,
+                        attempts=StripeProductSync.attempts + 1,
+                        next_attempt_at=datetime.now(tz=ZoneInfo("UTC")) + timedelta(seconds=delay),
+                        last_error=str(e)[:500]
+                    )
+                )
+                db.session.commit()
+                failed += 1
+
+        return {'synced': synced, 'failed': failed}
+
+    @staticmethod
+    @instrument_external_call('stripe')
+    def reconcile():
+        # Compare the local catalogue with Stripe and request a sync for every product that has drifted, e.g. a change made
+        # in the Stripe dashboard or a product created before the outbox. The Stripe catalogue is read with two paginated
+        # list calls rather than one call per product
+        stripe_products = {stripe_product.id: stripe_product for stripe_product in stripe.Product.list(limit=100).auto_paging_iter()}
+
+        active_prices = {}
+        for stripe_price in stripe.Price.list(active=True, limit=100).auto_paging_iter():
+            active_prices.setdefault(stripe_price.product, []).append(stripe_price)
+
+        products = db.session.execute(
+            select(Product.id, Product.name, Product.description, Product.price, Product.stripe_product_id, Product.stripe_price_id)
+        ).all()
+
+        # Products waiting to be synced are left alone, their sync may be creating a new price
+        pending_product_ids = set(db.session.scalars(select(StripeProductSync.product_id)))
+
+        drifted_product_ids = []
+        stale_prices = []
+
+        for product in products:
+            if product.id in pending_product_ids:
+                continue
+
+            stripe_product = stripe_products.get(product.stripe_product_id)
+            prices = active_prices.get(product.stripe_product_id, [])
+            current_price = next((price for price in prices if price.id == product.stripe_price_id), None)
+
+            if (
+                stripe_product is None
+                or stripe_product.name != product.name
+                or stripe_product.description != product.description
+                or current_price is None
+                or current_price.unit_amount != stripe_unit_amount(product.price)
+            ):
+                drifted_product_ids.append(product.id)
+            else:
+                # Old prices left active, e.g. by a sync that failed after creating the new price
+                stale_prices.extend(price for price in prices if price.id != product.stripe_price_id)
+
+        StripeSyncService.request_product_sync(drifted_product_ids)
+        db.session.commit()
+
+        for stripe_price in stale_prices:
+            stripe.Price.modify(stripe_price.id, active=False)
+
+        return {
+            'products_checked': len(products),
+            'products_drifted': len(drifted_product_ids),
+            'prices_deactivated': len(stale_prices)
+        }
@@ -1,15 +1,18 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
 from flask_jwt_extended import create_access_token, create_refresh_token, get_jwt_identity, set_access_cookies, set_refresh_cookies
-from sqlalchemy import extract
+from sqlalchemy import delete, select, tuple_, update
 from models import Product, User, Cart, Order
 from flask import current_app, make_response, jsonify
 from marshmallow import ValidationError
 from schemas import SignupSchema, LoginSchema, UserSchema, UserAdminSchema
 from werkzeug.security import generate_password_hash, check_password_hash
-from exts import db, cache
-from services.product_service import ProductService
-from services.utils import send_email, generate_verification_token, verify_token, send_contact_us_email, convert_utc_to_uk_time
+from exts import db
+from caching import cached, invalidate_tags
+from services.stock_service import StockService
+from services.statistic_service import StatisticService
+from decorators import get_user_claims, get_current_user_role
+from services.utils import paginate_by_cursor, send_email, generate_verification_token, verify_token, send_contact_us_email, convert_utc_to_uk_time
 from dateutil.parser import parse
 
 
@@ -70,6 +73,7 @@ class UserService:
             is_verified=False,
             verification_token=generate_verification_token(valid_data['email'])
         )
+        StatisticService.record_users_created() # Committed with the user
         new_user.save()
 
         # Create a cart for the user
@@ -92,6 +96,7 @@ class UserService:
         try:
             send_email(email_data)
         except Exception as e:
+            StatisticService.record_users_deleted()
             new_user.delete() # Delete the user if the email fails to send
             raise ValidationError('Failed to send verification email. Please try again later.')
 
@@ -99,8 +104,7 @@ class UserService:
         new_user.save()
 
         # Clear the cache
-        cache.delete_memoized(UserService.get_all_admin_users)
-        cache.delete_memoized(UserService.get_dashboard_data)
+        invalidate_tags('users', 'dashboard')
 
         return new_user
     
@@ -201,6 +205,7 @@ class UserService:
             role='guest',
             created_at=datetime.now(tz=ZoneInfo("UTC"))
         )
+        StatisticService.record_users_created() # Committed with the user
         new_user.save()
 
         # Create a cart for the user
@@ -211,15 +216,14 @@ class UserService:
         new_cart.save()
 
         # Create am access token for the guest user
-        access_token = create_access_token(identity=str(new_user.id), expires_delta=current_app.config.get('JWT_ACCESS_TOKEN_EXPIRES')) # Create an access token for the user with a 1 hour expiry
-        refresh_token = create_refresh_token(identity=str(new_user.id), expires_delta=current_app.config.get('JWT_REFRESH_TOKEN_EXPIRES')) # Create a refresh token for the user
+        access_token = create_access_token(identity=str(new_user.id), additional_claims=get_user_claims(new_user), expires_delta=current_app.config.get('JWT_ACCESS_TOKEN_EXPIRES')) # Create an access token for the user with a 1 hour expiry
+        refresh_token = create_refresh_token(identity=str(new_user.id), additional_claims=get_user_claims(new_user), expires_delta=current_app.config.get('JWT_REFRESH_TOKEN_EXPIRES')) # Create a refresh token for the user
 
         # Create a response
         response = make_response(jsonify({'message': 'Guest user created', 'access_token': access_token, 'refresh_token': refresh_token}))
 
         # Clear the cache
-        cache.delete_memoized(UserService.get_all_admin_users)
-        cache.delete_memoized(UserService.get_dashboard_data)
+        invalidate_tags('users', 'dashboard')
 
         return new_user.id, response
 
@@ -240,12 +244,12 @@ class UserService:
         if not user.is_verified:
             raise ValidationError('Email not verified')
 
-        access_token = create_access_token(identity=str(user.id), expires_delta=current_app.config.get('JWT_ACCESS_TOKEN_EXPIRES')) # Create an access token for the user with a 1 hour expiry
+        access_token = create_access_token(identity=str(user.id), additional_claims=get_user_claims(user), expires_delta=current_app.config.get('JWT_ACCESS_TOKEN_EXPIRES')) # Create an access token for the user with a 1 hour expiry
         
         if valid_data['remember_me'] == True:
-            refresh_token = create_refresh_token(identity=str(user.id), expires_delta=current_app.config.get('JWT_REFRESH_TOKEN_REMEMBER_ME_EXPIRES'))
+            refresh_token = create_refresh_token(identity=str(user.id), additional_claims=get_user_claims(user), expires_delta=current_app.config.get('JWT_REFRESH_TOKEN_REMEMBER_ME_EXPIRES'))
         else:
-            refresh_token = create_refresh_token(identity=str(user.id), expires_delta=current_app.config.get('JWT_REFRESH_TOKEN_EXPIRES')) 
+            refresh_token = create_refresh_token(identity=str(user.id), additional_claims=get_user_claims(user), expires_delta=current_app.config.get('JWT_REFRESH_TOKEN_EXPIRES')) 
         
         # Create a response
         response = make_response(jsonify({'message': 'Login successful'}))
@@ -267,11 +271,11 @@ class UserService:
             logged_in = True
 
             # Check if the user is an admin
-            user = User.query.get(current_user_id)
-            if user.role == 'admin':
+            role = get_current_user_role()
+            if role == 'admin':
                 is_admin = True
                 is_customer = False
-            elif user.role == 'customer':
+            elif role == 'customer':
                 is_customer = True
                 is_admin = False
             else:
@@ -289,7 +293,16 @@ class UserService:
     @staticmethod
     def refresh_token():
         current_user_id = get_jwt_identity()
-        new_access_token = create_access_token(identity=current_user_id, expires_delta=current_app.config.get('JWT_ACCESS_TOKEN_EXPIRES')) # Create a new access token
+
+        # Read the role from the database rather than the refresh token, so a role change or a deleted account takes
+        # effect on the next refresh rather than when the refresh token expires
+        user = User.query.get(current_user_id)
+
+        # Check if the user still exists
+        if not user:
+            raise ValidationError('User not found')
+
+        new_access_token = create_access_token(identity=current_user_id, additional_claims=get_user_claims(user), expires_delta=current_app.config.get('JWT_ACCESS_TOKEN_EXPIRES')) # Create a new access token
 
         response = make_response(jsonify({'message': 'Token refreshed'}))     
 
@@ -405,7 +418,7 @@ class UserService:
         user.save()
 
         # Clear the cache
-        cache.delete_memoized(UserService.get_all_admin_users)
+        invalidate_tags('users')
 
         return user
 
@@ -426,24 +439,21 @@ class UserService:
                     raise ValidationError('Cannot delete account with pending orders')
         
         # Check if the user has cart items, if so, remove the reserved stock
+        released_product_ids = []
         cart = Cart.query.filter_by(user_id=user.id).first()
         if cart:
             cart_products = cart.cart_products
 
             if cart_products:
                 for cart_product in cart_products:
-                    product = Product.query.get(cart_product.product_id)
-                    if product:
-                        # product.reserved_stock -= cart_product.quantity
-                        product.reserved_stock = max(product.reserved_stock - cart_product.quantity, 0) # Ensure stock doesn't go negative
-                        product.save()
+                    StockService.release_stock(cart_product.product_id, cart_product.quantity)
+                    released_product_ids.append(cart_product.product_id)
 
+        StatisticService.record_users_deleted() # Committed with the delete
         user.delete()
 
-        # Clear the cache
-        cache.delete_memoized(UserService.get_all_admin_users)
-        cache.delete_memoized(UserService.get_dashboard_data)
-        cache.delete_memoized(ProductService.get_all_products)
+        # Clear the cache, the reserved stock is shown on the cached pages of the released products
+        invalidate_tags('users', 'dashboard', *[f'product:{product_id}:stock' for product_id in released_product_ids])
 
         return user
         
@@ -489,7 +499,7 @@ class UserService:
         return user
     
     @staticmethod
-    @cache.memoize(timeout=86400) # Cache for 24 hours
+    @cached(timeout=86400, tags=lambda: ['dashboard']) # Cache for 24 hours
     def get_dashboard_data():
         print('Fetching dashboard data')
         # Get current user
@@ -500,83 +510,88 @@ class UserService:
         if not user:
             raise ValidationError('User not found')
         
-        # Get the total number of users
-        total_users = User.query.count()
+        # Read the maintained statistics rather than counting the users and orders, the graph shows the current year
+        current_year = datetime.now(tz=ZoneInfo("UTC")).year
 
-        # Get the total number of ongoing orders
-        ongoing_orders = Order.query.filter(Order.status.in_(['Processing', 'Shipped'])).count()
+        return StatisticService.get_dashboard_statistics(current_year)
+    
+    @staticmethod
+    def delete_old_guest_users(delete_guest_users_days, batch_size=1000):
+        expiration_date = datetime.now(tz=ZoneInfo("UTC")) - timedelta(days=delete_guest_users_days)
+
+        users_deleted = 0
+        quantity_released = 0
+        batches = 0
+
+        # Keyset pagination over (created_at, id), this matches the (role, created_at) index so each batch is an index range scan
+        # rather than loading every guest into memory and filtering by age in Python
+        last_created_at = None
+        last_id = None
+
+        while True:
+            query = (
+                select(User.id, User.created_at)
+                .where(User.role == 'guest', User.created_at < expiration_date)
+                .order_by(User.created_at, User.id)
+                .limit(batch_size)
+            )
 
-        # Get the total number of orders
-        orders_overall = Order.query.count()
+            if last_id is not None:
+                query = query.where(tuple_(User.created_at, User.id) > tuple_(last_created_at, last_id))
 
-        # Get the total revenue from all orders
-        total_revenue = Order.query.with_entities(Order.total_price).all()
-        total_revenue = sum(float(revenue[0]) for revenue in total_revenue)
-        total_revenue = round(total_revenue, 2) # Round the total revenue to 2 decimal places
+            guests = db.session.execute(query).all()
 
-        # Get the number of orders per month for the current year
-        current_year = datetime.now(tz=ZoneInfo("UTC")).year
-        orders_per_month = (
-            db.session.query(
-                extract('month', Order.order_date).label('month'),
-                db.func.count(Order.id).label('order_count')
-            )
-            .filter(extract('year', Order.order_date) == current_year)
-            .group_by('month')
-            .order_by('month')
-            .all()
-        )
+            if not guests:
+                break
 
-        orders_per_month_data = {month: 0 for month in range(1, 13)}
-        for month, order_count in orders_per_month:
-            orders_per_month_data[month] = order_count
+            guest_ids = [guest.id for guest in guests]
+            last_created_at, last_id = guests[-1].created_at, guests[-1].id
 
-        return {
-            'total_users': total_users,
-            'ongoing_orders': ongoing_orders,
-            'orders_overall': orders_overall,
-            'total_revenue': total_revenue,
-            'graph_data': orders_per_month_data
-        }
-    
-    # @staticmethod
-    # def delete_old_guest_users():
-    #     expiration_date = datetime.now(tz=ZoneInfo("UTC")) - timedelta(days=7)
-        
-    #     print("Deleting guest users")
+            try:
+                # Release the reserved stock of every cart product in the batch with a single aggregated UPDATE
+                _, quantity = StockService.release_reserved_stock_for_carts(select(Cart.id).where(Cart.user_id.in_(guest_ids)))
 
-    #     # Get all guest users that are older than expiration date
-    #     guest_users = User.query.filter(User.role == 'guest', User.created_at < expiration_date).all()
+                # Keep the guests orders, the order user_id foreign key doesn't cascade
+                db.session.execute(
+                    update(Order)
+                    .where(Order.user_id.in_(guest_ids))
+                    .values(user_id=None)
+                    .execution_options(synchronize_session=False)
+                )
 
-    #     if not guest_users:
-    #         raise ValidationError('No guest users, older than 7 days old, found')
+                # Delete the guests, the database cascades the delete to their carts and addresses
+                deleted = db.session.execute(
+                    delete(User)
+                    .where(User.id.in_(guest_ids))
+                    .execution_options(synchronize_session=False)
+                )
+                StatisticService.record_users_deleted(deleted.rowcount)
 
-    #     for guest_user in guest_users:
-    #         # Check if the guest user has any cart items, if so, remove the reserved stock
-    #         cart = Cart.query.filter_by(user_id=guest_user.id).first()
-    #         if cart:                
-    #             cart_products = cart.cart_products
+                # One transaction per batch
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
 
-    #             if cart_products:
-    #                 for cart_product in cart_products:
-    #                     product = Product.query.get(cart_product.product_id)
-    #                     if product:
-    #                         # product.reserved_stock -= cart_product.quantity
-    #                         product.reserved_stock = max(product.reserved_stock - cart_product.quantity, 0) # Ensure stock doesn't go negative
-    #                         product.save()
+            # A guest deleted concurrently, e.g. by an overlapping run, isn't counted
+            users_deleted += deleted.rowcount
+            quantity_released += quantity
+            batches += 1
 
-    #         guest_user.delete()
+            print(f"Deleted {deleted.rowcount} guest users, released {quantity} reserved stock")
 
-    #     # Clear the cache
-    #     cache.delete_memoized(UserService.get_all_admin_users)
-    #     cache.delete_memoized(UserService.get_dashboard_data)           
-    #     cache.delete_memoized(ProductService.get_all_products)
+            # The last batch was smaller than the batch size, there are no more expired guests
+            if len(guests) < batch_size:
+                break
 
-    #     return {'message': 'Old guest users deleted'}
-        
+        return {
+            'users_deleted': users_deleted,
+            'quantity_released': quantity_released,
+            'batches': batches
+        }
         
     @staticmethod
-    @cache.memoize(timeout=86400) # Cache for 24 hours
+    @cached(timeout=86400, tags=lambda page: ['users']) # Cache for 24 hours
     def get_all_admin_users(page):
         print('Fetching admin users')
         query = User.query.order_by(User.created_at.desc()) # Get all users ordered by the date they were created
@@ -598,6 +613,27 @@ class UserService:
             'total_users': users_query.total
         }
 
+    @staticmethod
+    @cached(timeout=86400, tags=lambda cursor, per_page, include_total: ['users']) # Cache for 24 hours
+    def get_all_admin_users_by_cursor(cursor=None, per_page=10, include_total=False):
+        print('Fetching admin users by cursor')
+        # Get the page after the cursor, ordered by the date the users were created
+        users, next_cursor = paginate_by_cursor(User.query, [User.created_at, User.id], cursor, per_page)
+
+        if not users:
+            raise ValidationError('No users found')
+
+        results = {
+            'users': user_admin_schema.dump(users, many=True),
+            'next_cursor': next_cursor
+        }
+
+        # Only count the users if asked to
+        if include_total:
+            results['total_users'] = User.query.count()
+
+        return results
+
     @staticmethod
     def get_user(user_id):
         # Check if the user id is provided
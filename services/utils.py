@@ -1,70 +1,306 @@
 from datetime import datetime, timedelta
+import base64
 import json
+import re
 import uuid
 from zoneinfo import ZoneInfo
 from flask import current_app
 from marshmallow import ValidationError
+from google.auth.credentials import AnonymousCredentials, Signing
 from google.cloud import storage
+import google.auth
+import google.auth.transport.requests
 from itsdangerous import URLSafeTimedSerializer
-from models import Cart, User
+from sqlalchemy import DateTime, and_, func, select, true, tuple_
+from models import Product, ProductImage
 import requests
 import stripe
+import exts
+from instrumentation import instrument_external_call
 
 
+# Content types of the image files that can be uploaded
+IMAGE_CONTENT_TYPES = {'image/png', 'image/jpeg'}
+
 # Check if the file is an image
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'png', 'jpg', 'jpeg'}
 
-# Upload an image file to Google Cloud Storage
-def upload_image_to_google_cloud_storage(image_file):
+# Path of the image shown in the listings, the thumbnail once it has been generated and the uploaded image until then
+def listing_image_path():
+    return func.coalesce(ProductImage.thumbnail_path, ProductImage.image_path)
+
+# Get the paths of an image and its variants in Google Cloud Storage
+def get_product_image_paths(product_image):
+    return [
+        image_path
+        for image_path in (product_image.image_path, product_image.thumbnail_path, product_image.thumbnail_avif_path, product_image.webp_path)
+        if image_path
+    ]
+
+# Build a correlated subquery that selects the first image path of a product,
+# this lets listings fetch the image in the same query as the product instead of lazy loading it per product
+def first_product_image_subquery():
+    return (
+        select(listing_image_path())
+        .where(ProductImage.product_id == Product.id)
+        .order_by(ProductImage.id.asc())
+        .limit(1)
+        .correlate(Product)
+        .scalar_subquery()
+    )
+
+# Get the first image path for each of the given products in a single query, returns a product id to image path map
+def get_first_product_image_paths(product_ids):
+    if not product_ids:
+        return {}
+
+    # DISTINCT ON keeps only the first image (lowest id) of each product
+    product_images = (
+        ProductImage.query
+        .with_entities(ProductImage.product_id, listing_image_path())
+        .filter(ProductImage.product_id.in_(product_ids))
+        .distinct(ProductImage.product_id)
+        .order_by(ProductImage.product_id, ProductImage.id.asc())
+        .all()
+    )
+
+    return {product_id: image_path for product_id, image_path in product_images}
+
+# Encode the sort key of the last row on a page as an opaque cursor
+def encode_cursor(values):
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+# Decode a cursor back into the values of the given sort columns
+def decode_cursor(cursor, columns):
     try:
-        # Set the Google Cloud Storage bucket name
-        bucket_name = current_app.config.get('GOOGLE_CLOUD_STORAGE_BUCKET_NAME')
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(columns):
+            raise ValueError('Cursor has the wrong number of values')
+        return [datetime.fromisoformat(value) if isinstance(column.type, DateTime) else int(value) for value, column in zip(values, columns)]
+    except (ValueError, TypeError):
+        raise ValidationError('Invalid cursor')
+
+# Keyset pagination, returns the rows after the cursor ordered by the given columns in descending order and the cursor of the
+# next page. The rows are found with a row value comparison on an index rather than an OFFSET scan, so deep pages are as fast as
+# the first, and no COUNT(*) is needed to know if there is another page
+def paginate_by_cursor(query, columns, cursor=None, per_page=10):
+    if cursor:
+        query = query.filter(tuple_(*columns) < tuple_(*decode_cursor(cursor, columns)))
+
+    # Fetch one extra row to know if there is a next page
+    items = query.order_by(*[column.desc() for column in columns]).limit(per_page + 1).all()
+    next_cursor = encode_cursor([getattr(items[per_page - 1], column.key) for column in columns]) if len(items) > per_page else None
+
+    return items[:per_page], next_cursor
+
+# Normalise a search so the same words typed with different case, spacing or punctuation share a cache entry
+def normalise_search_query(query):
+    return ' '.join(re.findall(r'\w+', (query or '').lower()))
+
+# Shortest last word matched as a prefix, a prefix of one or two letters matches most of the products
+MIN_SEARCH_PREFIX_LENGTH = 3
+
+# Lowest word similarity of a search and a product name for the name to be suggested, low enough to allow one or two
+# wrong letters in a word, e.g. 'lether' and 'leather' have a word similarity of 0.5
+SUGGESTION_SIMILARITY_THRESHOLD = 0.4
+
+# Build the tsquery of a normalised search, every word has to match and the last one is matched as a prefix so results
+# show while the customer is still typing, e.g. 'leather boo' becomes 'leather & boo:*'. Only word characters are left
+# after normalising so the search can't use tsquery operators
+def product_search_tsquery(query):
+    words = query.split()
+
+    if len(words[-1]) >= MIN_SEARCH_PREFIX_LENGTH:
+        words[-1] = f'{words[-1]}:*'
+
+    return func.to_tsquery('english', ' & '.join(words))
+
+# Price boundaries of the price range facets of the shop listing, the ranges are under 10, 10 to 25, ..., 250 and over
+PRICE_FACET_BOUNDARIES = [10, 25, 50, 100, 250]
+
+# The category filter of the shop listing is a category id or a list of category ids, get it as a list of ids
+def category_id_list(category_id):
+    if not category_id:
+        return []
+
+    return sorted(set(category_id)) if isinstance(category_id, (list, tuple)) else [category_id]
+
+# Build the category and price conditions of a filtered shop listing, a filter that isn't set matches every product.
+# The minimum price is inclusive and the maximum exclusive, so a price range facet can be used as the filter
+def product_filter_conditions(category_id=None, min_price=None, max_price=None):
+    if min_price is not None and max_price is not None and min_price >= max_price:
+        raise ValidationError('Minimum price must be less than the maximum price')
+
+    category_ids = category_id_list(category_id)
+    category_match = Product.category_id.in_(category_ids) if category_ids else true()
+
+    price_conditions = []
+    if min_price is not None:
+        price_conditions.append(Product.price >= min_price)
+    if max_price is not None:
+        price_conditions.append(Product.price < max_price)
+
+    price_match = and_(*price_conditions) if price_conditions else true()
+
+    return category_match, price_match
+
+# A Google Cloud Storage client for the process, created on first use and reused by every upload so its
+# authorised session and connections are kept
+storage_client = None
+
+# The credentials of the storage client, also used to sign the upload URLs
+storage_credentials = None
+
+# Get the application default credentials for Google Cloud Storage, e.g. the service account of the Cloud Run service
+def get_storage_credentials():
+    global storage_credentials
+
+    if storage_credentials is None:
+        storage_credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/devstorage.read_write'])
+
+    return storage_credentials
 
-        if not bucket_name:
-            raise ValidationError('Google Cloud Storage bucket name not found')
+# Get the Google Cloud Storage client, a local emulator is used if an API endpoint is set
+def get_storage_client():
+    global storage_client
 
-        # Intialise a Google Cloud Storage client
-        client = storage.Client()
+    if storage_client is None:
+        api_endpoint = current_app.config.get('GOOGLE_CLOUD_STORAGE_API_ENDPOINT')
 
+        if api_endpoint:
+            storage_client = storage.Client(project='emulator', credentials=AnonymousCredentials(), client_options={'api_endpoint': api_endpoint})
+        else:
+            storage_client = storage.Client(credentials=get_storage_credentials())
+
+    return storage_client
+
+# Get the Google Cloud Storage bucket for the images
+def get_storage_bucket():
+    # Set the Google Cloud Storage bucket name
+    bucket_name = current_app.config.get('GOOGLE_CLOUD_STORAGE_BUCKET_NAME')
+
+    if not bucket_name:
+        raise ValidationError('Google Cloud Storage bucket name not found')
+
+    return get_storage_client().bucket(bucket_name)
+
+# Upload an image file to Google Cloud Storage
+@instrument_external_call('gcs')
+def upload_image_to_google_cloud_storage(image_file):
+    try:
         # Get the bucket
-        bucket = client.bucket(bucket_name)
+        bucket = get_storage_bucket()
 
         # Create a unique filename for the image file
         image_file.filename = f"{uuid.uuid4().hex}-{image_file.filename}"
 
-        # Create a blob object
-        blob = bucket.blob(image_file.filename)
+        # Create a blob object, setting a chunk size makes the upload resumable and sent a chunk at a time
+        blob = bucket.blob(image_file.filename, chunk_size=current_app.config.get('GOOGLE_CLOUD_STORAGE_UPLOAD_CHUNK_SIZE'))
 
-        # Upload the image file to Google Cloud Storage
-        blob.upload_from_string(image_file.read(), content_type=image_file.content_type)
+        # Stream the image file to Google Cloud Storage, only one chunk of the file is held in memory at a time
+        blob.upload_from_file(image_file.stream, content_type=image_file.content_type)
 
         # Get the image path
-        image_path = f'{bucket_name}/{blob.name}'
+        image_path = f'{bucket.name}/{blob.name}'
 
         return image_path
     except Exception as e:
         print(f"Error uploading image to Google Cloud Storage: {str(e)}")
         raise ValidationError(f'Error uploading image to Google Cloud Storage: {str(e)}')
 
-# Remove an image file from Google Cloud Storage
-def remove_image_from_google_cloud_storage(image_path):
+# Create a signed URL the browser uploads an image file to, the file goes straight to the bucket rather than through the API
+@instrument_external_call('gcs')
+def generate_image_upload_url(filename, content_type):
     try:
-        # Set the Google Cloud Storage bucket name
-        bucket_name = current_app.config.get('GOOGLE_CLOUD_STORAGE_BUCKET_NAME')
+        bucket = get_storage_bucket()
 
-        # Check if the bucket name exists
-        if not bucket_name:
-            raise ValidationError('Google Cloud Storage bucket name not found')
+        # Create a unique filename for the image file
+        blob = bucket.blob(f"{uuid.uuid4().hex}-{filename}")
+
+        signing = {}
+        api_endpoint = current_app.config.get('GOOGLE_CLOUD_STORAGE_API_ENDPOINT')
+        if api_endpoint:
+            signing['api_access_endpoint'] = api_endpoint
+
+        # Credentials without a private key, e.g. on Cloud Run, sign the URL with the IAM API using their access token
+        credentials = get_storage_credentials()
+        if not isinstance(credentials, Signing):
+            if not credentials.valid:
+                credentials.refresh(google.auth.transport.requests.Request())
+
+            signing['service_account_email'] = credentials.service_account_email
+            signing['access_token'] = credentials.token
+
+        upload_url = blob.generate_signed_url(
+            version='v4',
+            expiration=timedelta(seconds=current_app.config.get('GOOGLE_CLOUD_STORAGE_SIGNED_URL_EXPIRATION')),
+            method='PUT',
+            content_type=content_type, # The browser has to upload the file with this content type
+            **signing
+        )
 
-        # Intialise a Google Cloud Storage client
-        client = storage.Client()
+        return upload_url, f'{bucket.name}/{blob.name}'
+    except Exception as e:
+        print(f"Error creating Google Cloud Storage upload URL: {str(e)}")
+        raise ValidationError(f'Error creating Google Cloud Storage upload URL: {str(e)}')
 
+# Get an image file uploaded to Google Cloud Storage, None if the file hasn't been uploaded
+@instrument_external_call('gcs')
+def get_uploaded_image(image_path):
+    try:
+        bucket = get_storage_bucket()
+
+        # Check the image path is in the bucket
+        if not image_path.startswith(f'{bucket.name}/'):
+            return None
+
+        return bucket.get_blob(image_path[len(bucket.name) + 1:])
+    except Exception as e:
+        print(f"Error getting image from Google Cloud Storage: {str(e)}")
+        raise ValidationError(f'Error getting image from Google Cloud Storage: {str(e)}')
+
+# Download an image file from Google Cloud Storage into a file object
+@instrument_external_call('gcs')
+def download_image_from_google_cloud_storage(image_path, file):
+    try:
+        bucket = get_storage_bucket()
+
+        # Get the image path without the bucket name
+        blob = bucket.blob(image_path.split(f'{bucket.name}/', 1)[1])
+
+        blob.download_to_file(file)
+    except Exception as e:
+        print(f"Error downloading image from Google Cloud Storage: {str(e)}")
+        raise ValidationError(f'Error downloading image from Google Cloud Storage: {str(e)}')
+
+# Upload a variant of an image to Google Cloud Storage, stored next to the image with the suffix in place of its extension
+@instrument_external_call('gcs')
+def upload_image_variant_to_google_cloud_storage(image_file, image_path, suffix, content_type):
+    try:
+        bucket = get_storage_bucket()
+
+        # e.g. bucket/abc-shoe.jpg becomes abc-shoe-thumbnail.webp
+        name = image_path.split(f'{bucket.name}/', 1)[1].rsplit('.', 1)[0]
+        blob = bucket.blob(f'{name}-{suffix}', chunk_size=current_app.config.get('GOOGLE_CLOUD_STORAGE_UPLOAD_CHUNK_SIZE'))
+
+        blob.upload_from_file(image_file, content_type=content_type)
+
+        return f'{bucket.name}/{blob.name}'
+    except Exception as e:
+        print(f"Error uploading image variant to Google Cloud Storage: {str(e)}")
+        raise ValidationError(f'Error uploading image variant to Google Cloud Storage: {str(e)}')
+
+# Remove an image file from Google Cloud Storage
+@instrument_external_call('gcs')
+def remove_image_from_google_cloud_storage(image_path):
+    try:
         # Get the bucket
-        bucket = client.bucket(bucket_name)
+        bucket = get_storage_bucket()
 
         # Get the image path without the bucket name
-        image_path = image_path.split(f'{bucket_name}/')[1]
+        image_path = image_path.split(f'{bucket.name}/')[1]
 
         # Get the blob
         blob = bucket.blob(image_path)
@@ -75,13 +311,49 @@ def remove_image_from_google_cloud_storage(image_path):
         print(f"Error removing image from Google Cloud Storage: {str(e)}")
         raise ValidationError(f'Error removing image from Google Cloud Storage: {str(e)}')
 
+# A pooled session for the Mailgun API, connections are kept alive and reused by every email the process sends
+mailgun_session = requests.Session()
+
+# Raised when Mailgun doesn't accept an email, retryable is false when sending the same email again won't help
+class EmailDeliveryError(Exception):
+    def __init__(self, message, retryable):
+        super().__init__(message)
+        self.retryable = retryable
+
+# Post an email to the Mailgun messages API, this is run by the email task on the Celery worker
+@instrument_external_call('mailgun')
+def deliver_email(message):
+    url = f"{current_app.config.get('MAILGUN_API_BASE_URL')}/{current_app.config.get('MAILGUN_DOMAIN_NAME')}/messages"
+    auth = ("api", current_app.config.get('MAILGUN_API_KEY'))
+
+    try:
+        response = mailgun_session.post(url, auth=auth, data=message, timeout=current_app.config.get('MAILGUN_TIMEOUT'))
+    except requests.RequestException as e:
+        raise EmailDeliveryError(f"Failed to reach Mailgun: {str(e)}", retryable=True)
+
+    # Print the response status code and text for debugging
+    print(f"Response Status Code: {response.status_code}")
+    print(f"Response Text: {response.text}")
+
+    if response.status_code != 200:
+        # Rate limiting and server errors are temporary, any other error is a problem with the email itself
+        raise EmailDeliveryError(f"Failed to send email: {response.text}", retryable=response.status_code == 429 or response.status_code >= 500)
+
+    return response.json()
+
+# Queue an email for the Celery worker so the request doesn't wait on Mailgun,
+# the email is sent straight away if tasks are run eagerly, e.g. in testing
+def queue_email(message):
+    if current_app.config.get('CELERY_TASK_ALWAYS_EAGER'):
+        deliver_email(message)
+    else:
+        exts.celery_client.send_task('tasks.email_delivery.send_email', args=[message])
+
 def send_email(data):
     try:
-        print("Sending email")
+        print("Queueing email")
 
-        url = f"https://api.mailgun.net/v3/{current_app.config.get('MAILGUN_DOMAIN_NAME')}/messages"
-        auth = ("api", current_app.config.get('MAILGUN_API_KEY'))
-        data = {
+        message = {
             "from": f"{current_app.config.get('MAILGUN_SENDER_EMAIL')}",
             "to": f"{data['to_name']} <{data['to_email']}>",
             "subject": data['subject'],
@@ -89,43 +361,27 @@ def send_email(data):
             'h:X-Mailgun-Variables': json.dumps({"button_link": data["button_link"]})
         }
 
-        response = requests.post(url, auth=auth, data=data)
-
-        # Print the response status code and text for debugging
-        print(f"Response Status Code: {response.status_code}")
-        print(f"Response Text: {response.text}")
-
-        if response.status_code != 200:
-            raise Exception(f"Failed to send email: {response.text}")
+        queue_email(message)
 
-        return response.json()
+        return {'message': 'Email queued'}
     except Exception as e:
         print(f"Error sending email: {str(e)}")
         raise ValidationError(f"Error sending email")
 
 def send_contact_us_email(data):
     try:
-        print("Sending contact us email")
+        print("Queueing contact us email")
         
-        url = f"https://api.mailgun.net/v3/{current_app.config.get('MAILGUN_DOMAIN_NAME')}/messages"
-        auth = ("api", current_app.config.get('MAILGUN_API_KEY'))
-        data = {
+        message = {
             "from": f"{data['from_name']} <{data['from_email']}>",
             "to": f"{current_app.config.get('CONTACT_US_EMAIL')}",
             "subject": f"Contact us: {data['subject']}",
             "text": data['message']
         }
 
-        response = requests.post(url, auth=auth, data=data)
+        queue_email(message)
 
-        # Print the response status code and text for debugging
-        print(f"Response Status Code: {response.status_code}")
-        print(f"Response Text: {response.text}")
-
-        if response.status_code != 200:
-            raise Exception(f"Failed to send email: {response.text}")
-        
-        return response.json()
+        return {'message': 'Email queued'}
     except Exception as e:
         print(f"Error sending contact email: {str(e)}")
         raise ValidationError(f"Error sending email")
@@ -153,94 +409,6 @@ def verify_token(token, expiration=3600):
     
     return email
 
-# Create stripe product and price objects
-def create_stripe_product_and_price(new_product):
-    try:
-        # Create product in stripe
-        stripe_product = stripe.Product.create(
-            name=new_product.name,
-            description=new_product.description,
-            metadata={
-                'product_id': new_product.id # Track local product id in stripe
-            }
-        )
-
-        # Create price in stripe
-        stripe_price = stripe.Price.create(
-            unit_amount=int(new_product.price * 100), # Convert price to pence
-            currency='gbp', # Set currency to GBP
-            product=stripe_product.id
-        )
-
-        # Update the product with the stripe product and price ids
-        new_product.stripe_product_id = stripe_product.id
-        new_product.stripe_price_id = stripe_price.id
-
-        new_product.save()
-    except Exception as e:
-        new_product.delete()
-        print(f"Failed to create product in Stripe: {str(e)}")
-        raise ValidationError(f"Failed to create product in Stripe: {str(e)}")
-
-def update_stripe_product_and_price(product, valid_data):
-    # Check if name is provided, if so, update the stripe product
-    if 'name' in valid_data:
-        try:
-            stripe.Product.modify(
-                product.stripe_product_id,
-                name=valid_data['name']                    
-            )
-        except Exception as e:
-            print(f"Failed to update product name in Stripe: {str(e)}")
-            raise ValidationError(f"Failed to update product name in Stripe: {str(e)}")
-
-    # Check if description is provided, if so, update the stripe product
-    if 'description' in valid_data:
-        try:
-            stripe.Product.modify(
-                product.stripe_product_id,
-                description=valid_data['description']                    
-            )
-        except Exception as e:
-            print(f"Failed to update product description in Stripe: {str(e)}")
-            raise ValidationError(f"Failed to update product description in Stripe: {str(e)}")
-
-    # Check if price is provided, if so, update the stripe price
-    if 'price' in valid_data:
-        try:
-            # Set the price to inactive in stripe
-            stripe.Price.modify(
-                product.stripe_price_id,
-                active=False # Set the price to inactive
-            )
-
-            # Create a new price in stripe
-            stripe_price = stripe.Price.create(
-                unit_amount=int(valid_data['price'] * 100), # Convert price to pence
-                currency='gbp', # Set currency to GBP
-                product=product.stripe_product_id
-            )
-
-            # Update the product with the new stripe price id
-            product.stripe_price_id = stripe_price.id
-
-        except Exception as e:
-            print(f"Failed to update price in Stripe: {str(e)}")
-            raise ValidationError(f"Failed to update price in Stripe: {str(e)}")
-        
-# Upload image to stripe product
-def upload_image_to_stripe_product(product, image_path):
-    try :
-        stripe.Product.modify(
-            product.stripe_product_id,
-            images=["https://storage.googleapis.com/" + image_path]
-        )
-    except Exception as e:
-        print(f"Failed to upload image to Stripe product: {str(e)}")
-        # Remove the image from Google Cloud Storage if the upload fails
-        remove_image_from_google_cloud_storage(image_path)
-        raise ValidationError(f"Failed to upload image to Stripe product: {str(e)}")
-
 # Convert utc time to local time
 def convert_utc_to_uk_time(utc_time):
     # Convert the UTC time to GMT
@@ -248,6 +416,7 @@ def convert_utc_to_uk_time(utc_time):
     return gmt_time
 
 # Create a stripe checkout session
+@instrument_external_call('stripe')
 def create_stripe_checkout_session(user, valid_data, line_items):
     try:
         session = stripe.checkout.Session.create(
@@ -276,75 +445,17 @@ def create_stripe_checkout_session(user, valid_data, line_items):
         print(f"Failed to create Stripe checkout session: {str(e)}")
         raise ValidationError(f"Failed to create Stripe checkout session")
 
-# Stripe webhook handler
-def stripe_webhook_handler(payload, sig_header):
+# Verify the signature of a Stripe webhook and return the event. Only the signature is checked here,
+# the event is stored and handled later by the webhook service
+def verify_stripe_webhook(payload, sig_header):
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, stripe.webhook_secret
-        )
-    except ValueError as e:
-        # Invalid payload
-        return {'An unexpected error with Stripe occured, please try again later.'}, 400
+        stripe.WebhookSignature.verify_header(payload, sig_header, stripe.webhook_secret)
     except stripe.error.SignatureVerificationError as e:
         # Invalid signature
-        return {'An error occured with Stripe, please try again later.': str(e)}, 400
-    
-    try:
-        # Handle the event
-        if event['type'] == 'checkout.session.completed':
-            session = event['data']['object'] # Contains a stripe checkout session            
-            customer_email = session['customer_details']['email']
-
-            # Extract the metadata, which contains the user id and address details
-            metadata = session['metadata']
-            user_id = metadata['user_id']
-            full_name = metadata['full_name']
-            address_line_1 = metadata['address_line_1']
-            address_line_2 = metadata['address_line_2']
-            city = metadata['city']
-            postcode = metadata['postcode']
-            stripe_session_id = session['id']
-            
-            # Create a new order
-            data = {
-                'user_id': user_id,
-                'full_name': full_name,
-                'address_line_1': address_line_1,
-                'address_line_2': address_line_2,
-                'city': city,
-                'postcode': postcode,
-                'customer_email': customer_email,
-                'stripe_session_id': stripe_session_id
-            }
-
-            # Extract the stripe customer id
-            stripe_customer_id = session['customer']
-
-            user = User.query.get(user_id)
-
-            if user:
-                user.stripe_customer_id = stripe_customer_id
-                user.save()
-
-            return data
-        # # If the session is not completed
-        elif event['type'] == 'checkout.session.expired':
-            session = event['data']['object']
-            metadata = session['metadata']
+        raise ValidationError('Invalid Stripe signature')
 
-            # Unlock the cart
-            user_id = metadata['user_id']
-            user_cart = Cart.query.filter_by(user_id=user_id).first()
-            if user_cart:
-                user_cart.locked = False
-                user_cart.locked_at = None
-                user_cart.save()
-                print(f"Unlocked cart {user_cart.id}")
-
-            return {'message': 'Payment failed'}, 400
-    
-    except Exception as e:
-        print(f"Stipe webhook handler: {str(e)}")
-        return {'message': 'An error occured with Stripe, please try again later.'}, 400
-
-    return None # Return None if the event type is not recognised
\ No newline at end of file
+    try:
+        return json.loads(payload)
+    except ValueError:
+        # Invalid payload
+        raise ValidationError('Invalid Stripe payload')
\ No newline at end of file
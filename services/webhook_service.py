@@ -0,0 +1,165 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from flask import current_app
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from models import Cart, StripeWebhookEvent, User
+from services.order_service import OrderService
+from services.utils import verify_stripe_webhook
+from exts import db
+import exts
+
+WEBHOOK_RETRY_BACKOFF = 30 # Seconds before the first retry, doubled after each failed attempt
+WEBHOOK_RETRY_BACKOFF_MAX = 60 * 60
+WEBHOOK_MAX_ATTEMPTS = 10 # Events still failing after this many attempts are left for an admin to look at
+WEBHOOK_RETENTION = timedelta(days=30) # Stripe redelivers events for up to 3 days, processed events are kept well past that to deduplicate them
+
+# Services
+class WebhookService:
+    @staticmethod
+    def receive_event(payload, sig_header):
+        # Verify the event and store it in the inbox, the event is handled after Stripe has been answered.
+        # INSERT ... ON CONFLICT DO NOTHING stores a redelivered event once, so it is only handled once
+        event = verify_stripe_webhook(payload, sig_header)
+        now = datetime.now(tz=ZoneInfo("UTC"))
+
+        inserted = db.session.execute(
+            postgresql_insert(StripeWebhookEvent)
+            .values(id=event['id'], type=event['type'], payload=event, received_at=now, next_attempt_at=now, attempts=0)
+            .on_conflict_do_nothing(index_elements=[StripeWebhookEvent.id])
+            .returning(StripeWebhookEvent.id)
+        ).scalar()
+        db.session.commit()
+
+        if inserted:
+            WebhookService.queue_event(event['id'])
+        else:
+            print(f"Stripe event {event['id']} already received")
+
+        return {'message': 'Webhook received'}
+
+    @staticmethod
+    def queue_event(event_id):
+        # Ask the Celery worker to handle the event, the event is handled straight away if tasks are run eagerly, e.g. in testing
+        if current_app.config.get('CELERY_TASK_ALWAYS_EAGER'):
+            WebhookService.process_event(event_id)
+            return
+
+        try:
+            exts.celery_client.send_task('tasks.stripe_webhooks.process_stripe_event', args=[event_id])
+        except Exception as e:
+            # The event is already in the inbox, so the scheduled run will handle it
+            print(f"Failed to queue Stripe event {event_id}: {str(e)}")
+
+    @staticmethod
+    def process_event(event_id):
+        # Lock the event while it is handled, SKIP LOCKED leaves an event being handled by another worker alone
+        event = db.session.execute(
+            select(StripeWebhookEvent)
+            .where(StripeWebhookEvent.id == event_id, StripeWebhookEvent.processed_at.is_(None))
+            .with_for_update(skip_locked=True)
+        ).scalar_one_or_none()
+
+        # The event has already been handled or is being handled
+        if event is None:
+            db.session.rollback()
+            return None
+
+        try:
+            # The event is marked as processed in the same commit as the changes it makes, so it is handled exactly once.
+            # Handlers make their changes in a single commit, or leave the commit to this method
+            event.processed_at = datetime.now(tz=ZoneInfo("UTC"))
+
+            handler = EVENT_HANDLERS.get(event.type)
+            if handler:
+                handler(event.payload['data']['object'])
+
+            # Commit the changes of handlers that leave the commit to this method
+            if db.session.new or db.session.dirty or db.session.deleted:
+                db.session.commit()
+
+            return True
+        except Exception as e:
+            db.session.rollback()
+            print(f"Failed to process Stripe event {event_id}: {str(e)}")
+
+            # Back off exponentially before the next attempt
+            db.session.execute(
+                update(StripeWebhookEvent)
+                .where(StripeWebhookEvent.id == event_id)
+                .values(
+                    attempts=StripeWebhookEvent.attempts + 1,
+                    next_attempt_at=datetime.now(tz=ZoneInfo("UTC")) + timedelta(seconds=min(WEBHOOK_RETRY_BACKOFF * 2 ** event.attempts, WEBHOOK_RETRY_BACKOFF_MAX)),
+                    last_error=str(e)[:500]
+                )
+            )
+            db.session.commit()
+
+            return False
+
+    @staticmethod
+    def process_pending(limit=100):
+        # Handle the events that are due, e.g. events whose task was lost or that failed and have backed off
+        event_ids = db.session.scalars(
+            select(StripeWebhookEvent.id)
+            .where(
+                StripeWebhookEvent.processed_at.is_(None),
+                StripeWebhookEvent.next_attempt_at <= datetime.now(tz=ZoneInfo("UTC")),
+                StripeWebhookEvent.attempts < WEBHOOK_MAX_ATTEMPTS
+            )
+            .order_by(StripeWebhookEvent.next_attempt_at)
+            .limit(limit)
+        ).all()
+        db.session.rollback() # End the read so each event is handled in its own transaction
+
+        results = [WebhookService.process_event(event_id) for event_id in event_ids]
+
+        return {'processed': results.count(True), 'failed': results.count(False)}
+
+    @staticmethod
+    def purge_processed_events():
+        # Delete the processed events that are too old to be redelivered
+        deleted = db.session.execute(
+            delete(StripeWebhookEvent)
+            .where(StripeWebhookEvent.processed_at < datetime.now(tz=ZoneInfo("UTC")) - WEBHOOK_RETENTION)
+        ).rowcount
+        db.session.commit()
+
+        return deleted
+
+    @staticmethod
+    def handle_checkout_session_completed(session):
+        # Extract the metadata, which contains the user id and address details
+        metadata = session['metadata']
+
+        # Save the stripe customer id, this is committed with the order
+        user = db.session.get(User, int(metadata['user_id']))
+        if user:
+            user.stripe_customer_id = session['customer']
+
+        # Create a new order
+        OrderService.create_order({
+            'user_id': metadata['user_id'],
+            'full_name': metadata['full_name'],
+            'address_line_1': metadata['address_line_1'],
+            'address_line_2': metadata['address_line_2'],
+            'city': metadata['city'],
+            'postcode': metadata['postcode'],
+            'customer_email': session['customer_details']['email'],
+            'stripe_session_id': session['id']
+        })
+
+    @staticmethod
+    def handle_checkout_session_expired(session):
+        # Unlock the cart, the payment wasn't completed
+        user_cart = Cart.query.filter_by(user_id=session['metadata']['user_id']).first()
+        if user_cart:
+            user_cart.locked = False
+            user_cart.locked_at = None
+            print(f"Unlocked cart {user_cart.id}")
+
+# Handlers of the Stripe event types, other event types are marked as processed without doing anything
+EVENT_HANDLERS = {
+    'checkout.session.completed': WebhookService.handle_checkout_session_completed,
+    'checkout.session.expired': WebhookService.handle_checkout_session_expired,
+}
@@ -0,0 +1,31 @@
+from celery_worker import celery, flask_app
+import os
+import random
+from services.utils import deliver_email, EmailDeliveryError
+
+# Determine the environment
+email_max_retries = int(os.getenv('EMAIL_MAX_RETRIES', 8)) # Default to 8 retries, around 2 hours with the default backoff
+email_retry_backoff = int(os.getenv('EMAIL_RETRY_BACKOFF', 30)) # Default to 30 seconds before the first retry, doubled after each retry
+email_retry_backoff_max = int(os.getenv('EMAIL_RETRY_BACKOFF_MAX', 60 * 60)) # Default to at most 1 hour between retries
+
+# acks_late keeps the email on the queue until it has been sent, so it isn't lost if the worker dies while sending it
+@celery.task(name="tasks.email_delivery.send_email", bind=True, acks_late=True, max_retries=email_max_retries)
+def send_email(self, message):
+    with flask_app.app_context():
+        try:
+            deliver_email(message)
+
+            print(f"send_email: sent '{message['subject']}' to {message['to']}")
+        except EmailDeliveryError as e:
+            # Sending the same email again won't help, e.g. the address is invalid
+            if not e.retryable:
+                print(f"send_email: dropped '{message['subject']}' to {message['to']}: {str(e)}")
+                return
+
+            # Back off exponentially with jitter, so the queued emails don't all retry at once after a Mailgun outage
+            countdown = min(email_retry_backoff * 2 ** self.request.retries, email_retry_backoff_max)
+            countdown = random.uniform(countdown / 2, countdown)
+
+            print(f"send_email: retrying '{message['subject']}' to {message['to']} in {countdown:.0f} seconds: {str(e)}")
+
+            raise self.retry(exc=e, countdown=countdown)
@@ -0,0 +1,38 @@
+from celery_worker import celery, flask_app
+import os
+import random
+from marshmallow import ValidationError
+from services.image_derivative_service import ImageDerivativeService
+
+# Determine the environment
+image_derivatives_max_retries = int(os.getenv('IMAGE_DERIVATIVES_MAX_RETRIES', 5)) # Default to 5 retries, the scheduled run picks up images still without variants
+image_derivatives_retry_backoff = int(os.getenv('IMAGE_DERIVATIVES_RETRY_BACKOFF', 30)) # Default to 30 seconds before the first retry, doubled after each retry
+image_derivatives_batch_size = int(os.getenv('IMAGE_DERIVATIVES_BATCH_SIZE', 100)) # Default to 100 images per scheduled run
+
+# Generate the thumbnails and WebP/AVIF variants of a product image, queued after the image is uploaded.
+# acks_late keeps the task on the queue until the variants are saved, so it isn't lost if the worker dies part way through
+@celery.task(name="tasks.image_derivatives.generate_image_derivatives", bind=True, acks_late=True, max_retries=image_derivatives_max_retries)
+def generate_image_derivatives(self, product_image_id):
+    with flask_app.app_context():
+        try:
+            result = ImageDerivativeService.generate_derivatives(product_image_id)
+
+            if result:
+                print(f"generate_image_derivatives: generated the variants of product image {product_image_id}")
+        except ValidationError as e:
+            # Google Cloud Storage couldn't be reached, back off exponentially with jitter
+            countdown = image_derivatives_retry_backoff * 2 ** self.request.retries
+            countdown = random.uniform(countdown / 2, countdown)
+
+            print(f"generate_image_derivatives: retrying product image {product_image_id} in {countdown:.0f} seconds: {str(e)}")
+
+            raise self.retry(exc=e, countdown=countdown)
+
+# Queue the images still without variants, e.g. images uploaded before the variants were added or whose task was lost
+@celery.task(name="tasks.image_derivatives.generate_missing_image_derivatives")
+def generate_missing_image_derivatives():
+    with flask_app.app_context():
+        queued = ImageDerivativeService.queue_missing_derivatives(image_derivatives_batch_size)
+
+        if queued:
+            print(f"generate_missing_image_derivatives: queued {queued} product images")
@@ -0,0 +1,30 @@
+from celery_worker import celery, flask_app, redis_client
+from caching import invalidate_tags
+from services.statistic_service import StatisticService
+
+# Lock expiration
+LOCK_EXPIRATION = 60 * 30  # 30 minutes
+
+@celery.task(name="tasks.statistics_reconcile.reconcile_dashboard_statistics")
+def reconcile_dashboard_statistics():
+    with flask_app.app_context():
+        lock_key = "lock:dashboard_statistics"
+
+        # Try to acquire the lock
+        if not redis_client.set(lock_key, "1", nx=True, ex=LOCK_EXPIRATION):
+            print("reconcile_dashboard_statistics task is already running.")
+            return
+
+        try:
+            # Rebuild the dashboard statistics from the users and orders tables, correcting any drift in the maintained counters
+            statistics = StatisticService.rebuild()
+
+            print(f"reconcile_dashboard_statistics: rebuilt {len(statistics)} statistics")
+
+            # Clear the cache
+            invalidate_tags('dashboard')
+
+        finally:
+            # Release the lock
+            redis_client.delete(lock_key)
+            print("Lock released for reconcile_dashboard_statistics task.")
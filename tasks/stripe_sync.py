@@ -0,0 +1,43 @@
+from celery_worker import celery, flask_app, redis_client
+import os
+from services.stripe_sync_service import StripeSyncService
+
+# Lock expiration
+LOCK_EXPIRATION = 60 * 30  # 30 minutes
+
+# Determine the environment
+stripe_sync_batch_size = int(os.getenv('STRIPE_SYNC_BATCH_SIZE', 100)) # Default to 100 products per run
+
+# Process the Stripe sync outbox, queued after each product change and scheduled to pick up retries.
+# Concurrent runs claim different products, so no lock is needed
+@celery.task(name="tasks.stripe_sync.process_stripe_sync_outbox")
+def process_stripe_sync_outbox():
+    with flask_app.app_context():
+        result = StripeSyncService.process_pending(stripe_sync_batch_size)
+
+        if result['synced'] or result['failed']:
+            print(f"process_stripe_sync_outbox: synced {result['synced']} products, {result['failed']} failed")
+
+@celery.task(name="tasks.stripe_sync.reconcile_stripe_catalog")
+def reconcile_stripe_catalog():
+    with flask_app.app_context():
+        lock_key = "lock:stripe_catalog"
+
+        # Try to acquire the lock
+        if not redis_client.set(lock_key, "1", nx=True, ex=LOCK_EXPIRATION):
+            print("reconcile_stripe_catalog task is already running.")
+            return
+
+        try:
+            # Request a sync for every product that has drifted from Stripe, then push them
+            result = StripeSyncService.reconcile()
+
+            print(f"reconcile_stripe_catalog: checked {result['products_checked']} products, {result['products_drifted']} drifted, deactivated {result['prices_deactivated']} stale prices")
+
+            if result['products_drifted']:
+                process_stripe_sync_outbox.delay()
+
+        finally:
+            # Release the lock
+            redis_client.delete(lock_key)
+            print("Lock released for reconcile_stripe_catalog task.")
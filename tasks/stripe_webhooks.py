@@ -0,0 +1,30 @@
+from celery_worker import celery, flask_app
+import os
+from services.webhook_service import WebhookService
+
+# Determine the environment
+stripe_webhook_batch_size = int(os.getenv('STRIPE_WEBHOOK_BATCH_SIZE', 100)) # Default to 100 events per run
+
+# Handle a Stripe event, queued by the webhook route after the event is stored.
+# A failed event is backed off in the inbox and picked up by the scheduled run, so the task isn't retried by Celery
+@celery.task(name="tasks.stripe_webhooks.process_stripe_event", acks_late=True)
+def process_stripe_event(event_id):
+    with flask_app.app_context():
+        WebhookService.process_event(event_id)
+
+# Handle the events whose task was lost or that are due to be retried.
+# Concurrent runs skip the events locked by each other, so no lock is needed
+@celery.task(name="tasks.stripe_webhooks.process_pending_stripe_events")
+def process_pending_stripe_events():
+    with flask_app.app_context():
+        result = WebhookService.process_pending(stripe_webhook_batch_size)
+
+        if result['processed'] or result['failed']:
+            print(f"process_pending_stripe_events: processed {result['processed']} events, {result['failed']} failed")
+
+@celery.task(name="tasks.stripe_webhooks.purge_processed_stripe_events")
+def purge_processed_stripe_events():
+    with flask_app.app_context():
+        deleted = WebhookService.purge_processed_events()
+
+        print(f"purge_processed_stripe_events: deleted {deleted} events")
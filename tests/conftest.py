@@ -1,5 +1,4 @@
 import io
-from flask_jwt_extended import get_jwt_identity
 import pytest
 from main import create_app
 from config import Test
@@ -7,8 +6,15 @@ from exts import db, limiter, cache
 from werkzeug.security import generate_password_hash
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from models import User, Cart
+from models import User, Cart, Order
 from sqlalchemy.orm import scoped_session, sessionmaker
+from tests.fake_services import FakeGCS, FakeMailgun, FakeStripe
+import rsa
+from google.cloud import storage
+from google.oauth2 import service_account
+import services.utils
+from tests.utils import build_checkout_session, build_stripe_event, post_stripe_event
+import stripe
 
 # Create a fixture to create an instance of the app
 @pytest.fixture(scope='session') # This fixture will be called only once for the session
@@ -44,8 +50,9 @@ def db_session(test_app):
     # Begin a transaction
     transaction = connection.begin()
 
-    # Create a new session factory bound to the connection
-    session_factory = sessionmaker(bind=connection)
+    # Create a new session factory bound to the connection, commits and rollbacks made by the code under test
+    # are run against a savepoint so they stay inside the transaction
+    session_factory = sessionmaker(bind=connection, join_transaction_mode='create_savepoint')
     session = scoped_session(session_factory)
 
     # Override the default db session
@@ -74,6 +81,67 @@ def missing_data():
 def clear_cache():
     cache.clear()
 
+# Fake Service Fixtures
+
+# Start a fake Mailgun server and point the app at it
+@pytest.fixture
+def fake_mailgun(test_app, monkeypatch):
+    server = FakeMailgun()
+    server.start()
+
+    monkeypatch.setitem(test_app.config, 'MAILGUN_API_BASE_URL', server.url)
+    monkeypatch.setitem(test_app.config, 'MAILGUN_DOMAIN_NAME', 'mg.test.com')
+    monkeypatch.setitem(test_app.config, 'MAILGUN_API_KEY', 'test-api-key')
+    monkeypatch.setitem(test_app.config, 'CONTACT_US_EMAIL', 'contact@test.com')
+
+    yield server
+
+    server.stop()
+
+# Private key of the fake service account, the Google Cloud Storage client signs upload URLs with it
+@pytest.fixture(scope='session')
+def service_account_private_key():
+    _, private_key = rsa.newkeys(2048)
+
+    return private_key.save_pkcs1().decode()
+
+# Start a fake Google Cloud Storage server and give the app a storage client for it
+@pytest.fixture
+def fake_gcs(test_app, monkeypatch, service_account_private_key):
+    server = FakeGCS()
+    server.start()
+
+    credentials = service_account.Credentials.from_service_account_info({
+        'type': 'service_account',
+        'project_id': 'test',
+        'private_key': service_account_private_key,
+        'client_email': 'uploader@test.iam.gserviceaccount.com',
+        'token_uri': f'{server.url}/token'
+    }, scopes=['https://www.googleapis.com/auth/devstorage.read_write'])
+
+    monkeypatch.setattr(services.utils, 'storage_credentials', credentials)
+    monkeypatch.setattr(services.utils, 'storage_client', storage.Client(project='test', credentials=credentials, client_options={'api_endpoint': server.url}))
+    monkeypatch.setitem(test_app.config, 'GOOGLE_CLOUD_STORAGE_BUCKET_NAME', 'test-bucket')
+    monkeypatch.setitem(test_app.config, 'GOOGLE_CLOUD_STORAGE_API_ENDPOINT', server.url)
+    monkeypatch.setitem(test_app.config, 'GOOGLE_CLOUD_STORAGE_UPLOAD_CHUNK_SIZE', 256 * 1024)
+
+    yield server
+
+    server.stop()
+
+# Start a fake Stripe server and point the Stripe library at it
+@pytest.fixture
+def fake_stripe(monkeypatch):
+    server = FakeStripe()
+    server.start()
+
+    monkeypatch.setattr(stripe, 'api_base', server.url)
+    monkeypatch.setattr(stripe, 'api_key', 'sk_test_fake')
+
+    yield server
+
+    server.stop()
+
 # Auth Fixtures
 
 # Create a fixture to create a test user
@@ -256,7 +324,7 @@ def get_all_test_users(test_client, test_admin_login):
 # Product Fixtures
 
 @pytest.fixture()
-def create_test_product(test_client, mocker, create_test_category, test_admin_login):
+def create_test_product(test_client, mocker, fake_stripe, create_test_category, test_admin_login):
     product_data = {
         'name': 'Test Product',
         'description': 'Test Product Description',
@@ -265,39 +333,31 @@ def create_test_product(test_client, mocker, create_test_category, test_admin_lo
         'category_id': create_test_category.json['id']
     }
 
-    # Mock the create_stripe_product_and_price function
-    mocked_create_stripe_product_and_price = mocker.patch('services.product_service.create_stripe_product_and_price', return_value={'Stripe product created successfully'})
-
     response = test_client.post('/product/admin', json=product_data)
 
     assert response.status_code == 201
 
-    # Assert that the create_stripe_product_and_price function was called
-    mocked_create_stripe_product_and_price.assert_called_once()
-
     # Create a test image file
     test_image = io.BytesIO(b'Fake Image data')
     data = {
         'image': (test_image, 'test_image.jpg')
     }
 
-    # Mock the upload_image_to_google_cloud_storage, remove_image_from_google_cloud_storage, upload_image_to_stripe_product function
+    # Mock the upload_image_to_google_cloud_storage, remove_image_from_google_cloud_storage function
     mocked_upload_image_to_google_cloud_storage = mocker.patch('services.product_service.upload_image_to_google_cloud_storage', return_value='test_image.jpg')
-    mocked_upload_image_to_stripe_product = mocker.patch('services.product_service.upload_image_to_stripe_product', return_value={'message': 'Image uploaded successfully'})
     mocked_remove_image_from_google_cloud_storage = mocker.patch('services.product_service.remove_image_from_google_cloud_storage', return_value={'message': 'Image removed successfully'})
 
     imageResponse = test_client.post(f'/product/admin/product-image/{response.json['product_id']}', content_type='multipart/form-data', data=data)
 
     assert imageResponse.status_code == 201
 
-    # Assert that the upload_image_to_google_cloud_storage, upload_image_to_stripe_product functions were called
+    # Assert that the upload_image_to_google_cloud_storage function was called
     mocked_upload_image_to_google_cloud_storage.assert_called_once()
-    mocked_upload_image_to_stripe_product.assert_called_once()
 
     return response, mocked_remove_image_from_google_cloud_storage
 
 @pytest.fixture()
-def create_four_test_products(test_client, mocker, create_test_category, test_admin_login):
+def create_four_test_products(test_client, mocker, fake_stripe, create_test_category, test_admin_login):
     products = []
 
     for i in range(4):
@@ -321,18 +381,16 @@ def create_four_test_products(test_client, mocker, create_test_category, test_ad
             'image': (test_image, f'test_image_{i}.jpg')
         }
 
-        # Mock the upload_image_to_google_cloud_storage, remove_image_from_google_cloud_storage, upload_image_to_stripe_product function
+        # Mock the upload_image_to_google_cloud_storage, remove_image_from_google_cloud_storage function
         mocked_upload_image_to_google_cloud_storage = mocker.patch('services.product_service.upload_image_to_google_cloud_storage', return_value=f'test_image_{i}.jpg')
-        mocked_upload_image_to_stripe_product = mocker.patch('services.product_service.upload_image_to_stripe_product', return_value={'message': 'Image uploaded successfully'})
         mocked_remove_image_from_google_cloud_storage = mocker.patch('services.product_service.remove_image_from_google_cloud_storage', return_value={'message': 'Image removed successfully'})
 
         imageResponse = test_client.post(f'/product/admin/product-image/{response.json['product_id']}', content_type='multipart/form-data', data=data)
 
         assert imageResponse.status_code == 201
 
-        # Assert that the upload_image_to_google_cloud_storage, upload_image_to_stripe_product functions were called
+        # Assert that the upload_image_to_google_cloud_storage function was called
         mocked_upload_image_to_google_cloud_storage.assert_called_once()
-        mocked_upload_image_to_stripe_product.assert_called_once()
 
     return products, mocked_remove_image_from_google_cloud_storage
 
@@ -389,23 +447,12 @@ def get_all_test_products_in_cart(test_client, add_test_product_to_cart):
 
 # Order Fixtures
 @pytest.fixture()
-def create_test_order(test_client, mocker, add_test_product_to_cart, test_admin_login):
-    order_data = {
-        'user_id': get_jwt_identity(),
-        'full_name': 'John Doe',
-        'address_line_1': '123 Test Street',
-        'address_line_2': 'Test Area',
-        'city': 'Test City',
-        'postcode': 'TE1 1ST',
-        'customer_email': 'test@test.com',
-        'stripe_session_id': 'test_session_id'
-    }
-    
-    # Mock the stripe_webhook_handler function
-    mocked_stripe_webhook_handler = mocker.patch('api.order.stripe_webhook_handler', return_value=order_data)
+def create_test_order(test_client, test_create_users, add_test_product_to_cart, test_admin_login):
+    admin = test_create_users[0]
 
-    response = test_client.post('/order/webhook')
+    # Send the completed checkout session of the admin's cart to the webhook, the order is created from the event
+    response = post_stripe_event(test_client, build_stripe_event('checkout.session.completed', build_checkout_session(admin.id)))
 
     assert response.status_code == 200
 
-    return response
\ No newline at end of file
+    return Order.query.filter_by(stripe_session_id='test_session_id').one()
\ No newline at end of file
@@ -0,0 +1,291 @@
+import base64
+import hashlib
+import itertools
+import json
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+import google_crc32c
+
+# Local fake servers standing in for the third party APIs, the app talks to them over HTTP as it would in production.
+# Status codes added to failures are returned for the next requests, e.g. [500] fails the next request with a server error
+class FakeServer:
+    def __init__(self):
+        self.requests = []
+        self.failures = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Handle a request, returning the status code, the JSON body of the response (None for no body, bytes for a raw body)
+    # and optionally the response headers
+    def handle(self, method, path, query, body, headers):
+        raise NotImplementedError
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.dispatch('GET')
+
+            def do_POST(self):
+                self.dispatch('POST')
+
+            def do_PUT(self):
+                self.dispatch('PUT')
+
+            def do_DELETE(self):
+                self.dispatch('DELETE')
+
+            def dispatch(self, method):
+                url = urlsplit(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+                with fake.lock:
+                    fake.requests.append((method, url.path))
+
+                    if fake.failures:
+                        status, response, headers = fake.failures.pop(0), {'error': {'type': 'api_error', 'message': 'Fake failure'}}, {}
+                    else:
+                        status, response, *headers = fake.handle(method, url.path, query, body, self.headers)
+                        headers = headers[0] if headers else {}
+
+                data = response if isinstance(response, bytes) else json.dumps(response).encode() if response is not None else b''
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                if response is not None and not isinstance(response, bytes):
+                    self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass # Keep the test output quiet
+
+        return Handler
+
+# Fake Mailgun messages API, records the emails it accepts
+class FakeMailgun(FakeServer):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    @property
+    def url(self):
+        return f'{self.base_url}/v3'
+
+    def handle(self, method, path, query, body, headers):
+        # Only the messages endpoint is supported, /v3/<domain>/messages
+        parts = path.strip('/').split('/')
+        if method != 'POST' or len(parts) != 3 or parts[2] != 'messages':
+            return 404, {'message': 'Not found'}
+
+        # Mailgun uses basic auth with the username api
+        auth = headers.get('Authorization', '')
+        if not auth.startswith('Basic ') or not base64.b64decode(auth[6:]).decode().startswith('api:'):
+            return 401, {'message': 'Forbidden'}
+
+        message = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        self.messages.append({'domain': parts[1], **message})
+
+        return 200, {'id': f'<{uuid.uuid4().hex}@{parts[1]}>', 'message': 'Queued. Thank you.'}
+
+# Fake Stripe API, keeps the products and prices in memory and replays requests sent with a used idempotency key.
+# Only the product and price endpoints used by the Stripe sync and creating checkout sessions are supported
+class FakeStripe(FakeServer):
+    def __init__(self):
+        super().__init__()
+        self.objects = {'products': {}, 'prices': {}}
+        self.checkout_sessions = []
+        self.idempotent_responses = {}
+        self.ids = itertools.count(1)
+
+    @property
+    def url(self):
+        return self.base_url
+
+    # Parse a form encoded Stripe request, e.g. metadata[product_id]=1 and images[0]=url
+    @staticmethod
+    def parse_form(body):
+        params = {}
+
+        for key, values in parse_qs(body, keep_blank_values=True).items():
+            if '[' in key:
+                name, field = key[:-1].split('[', 1)
+                if field.isdigit():
+                    params.setdefault(name, []).append(values[0])
+                else:
+                    params.setdefault(name, {})[field] = values[0]
+            else:
+                params[key] = values[0]
+
+        return params
+
+    def handle(self, method, path, query, body, headers):
+        if not headers.get('Authorization', '').startswith('Bearer '):
+            return 401, {'error': {'type': 'invalid_request_error', 'message': 'No API key provided'}}
+
+        parts = path.strip('/').split('/')
+
+        # Create a checkout session, /v1/checkout/sessions
+        if method == 'POST' and parts == ['v1', 'checkout', 'sessions']:
+            params = self.parse_form(body.decode())
+            session_id = f'cs_test_{next(self.ids)}'
+            self.checkout_sessions.append(params)
+
+            return 200, {'id': session_id, 'object': 'checkout.session', 'url': f'https://checkout.stripe.com/c/pay/{session_id}', 'metadata': params.get('metadata', {})}
+
+        if len(parts) < 2 or parts[0] != 'v1' or parts[1] not in self.objects:
+            return 404, {'error': {'type': 'invalid_request_error', 'message': 'Unrecognized request URL'}}
+
+        # Requests with a used idempotency key get the original response
+        idempotency_key = headers.get('Idempotency-Key')
+        if method == 'POST' and idempotency_key in self.idempotent_responses:
+            return self.idempotent_responses[idempotency_key]
+
+        response = self.handle_object(method, parts[1], parts[2] if len(parts) > 2 else None, query, self.parse_form(body.decode()))
+
+        if method == 'POST' and idempotency_key:
+            self.idempotent_responses[idempotency_key] = response
+
+        return response
+
+    def handle_object(self, method, collection, object_id, query, params):
+        objects = self.objects[collection]
+
+        # List the objects, paginated with starting_after
+        if method == 'GET' and object_id is None:
+            items = [item for item in objects.values() if 'active' not in query or str(item['active']).lower() == query['active'].lower()]
+            if 'starting_after' in query:
+                items = items[[item['id'] for item in items].index(query['starting_after']) + 1:]
+            limit = int(query.get('limit', 10))
+            return 200, {'object': 'list', 'url': f'/v1/{collection}', 'data': items[:limit], 'has_more': len(items) > limit}
+
+        # Create an object
+        if method == 'POST' and object_id is None:
+            if collection == 'products':
+                item = {'id': f'prod_{next(self.ids)}', 'object': 'product', 'active': True, 'description': None, 'images': [], 'metadata': {}}
+            else:
+                item = {'id': f'price_{next(self.ids)}', 'object': 'price', 'active': True, 'currency': 'gbp'}
+                params['unit_amount'] = int(params['unit_amount'])
+
+            objects[item['id']] = item
+        elif object_id in objects:
+            item = objects[object_id]
+        else:
+            return 404, {'error': {'type': 'invalid_request_error', 'message': f'No such {collection[:-1]}: {object_id}'}}
+
+        # Update the object
+        if method == 'POST':
+            if 'active' in params:
+                params['active'] = params['active'] == 'true'
+            item.update(params)
+
+        return 200, item
+
+# Fake Google Cloud Storage JSON API, keeps the uploaded objects in memory. Supports resumable uploads sent in chunks,
+# uploads to signed URLs, getting, downloading and deleting objects, and the OAuth token endpoint used by service account credentials
+class FakeGCS(FakeServer):
+    def __init__(self):
+        super().__init__()
+        self.objects = {}
+        self.uploads = {}
+        self.chunks = [] # Size of each chunk of the resumable uploads
+
+    @property
+    def url(self):
+        return self.base_url
+
+    @staticmethod
+    def object_resource(bucket, name, item):
+        return {
+            'kind': 'storage#object',
+            'id': f'{bucket}/{name}/1',
+            'bucket': bucket,
+            'name': name,
+            'generation': '1',
+            'size': str(len(item['data'])),
+            'contentType': item['content_type'],
+            'crc32c': base64.b64encode(google_crc32c.value(item['data']).to_bytes(4, 'big')).decode(),
+            'md5Hash': base64.b64encode(hashlib.md5(item['data']).digest()).decode()
+        }
+
+    def handle(self, method, path, query, body, headers):
+        # Token for service account credentials
+        if path == '/token':
+            return 200, {'access_token': 'test-access-token', 'expires_in': 3600, 'token_type': 'Bearer'}
+
+        parts = [unquote(part) for part in path.strip('/').split('/')]
+
+        # Start a resumable upload, /upload/storage/v1/b/<bucket>/o
+        if method == 'POST' and parts[:3] == ['upload', 'storage', 'v1'] and query.get('uploadType') == 'resumable':
+            metadata = json.loads(body)
+            upload_id = uuid.uuid4().hex
+            self.uploads[upload_id] = {'bucket': parts[4], 'name': metadata['name'], 'content_type': headers.get('X-Upload-Content-Type'), 'data': b''}
+
+            return 200, {}, {'Location': f'{self.base_url}/upload/storage/v1/b/{parts[4]}/o?uploadType=resumable&upload_id={upload_id}'}
+
+        # Upload a chunk, the last chunk has the total size in its Content-Range, e.g. bytes 0-262143/*
+        if method == 'PUT' and query.get('upload_id') in self.uploads:
+            upload = self.uploads[query['upload_id']]
+            upload['data'] += body
+            self.chunks.append(len(body))
+
+            if headers.get('Content-Range', '').endswith('/*'):
+                return 308, None, {'Range': f"bytes=0-{len(upload['data']) - 1}"}
+
+            del self.uploads[query['upload_id']]
+            self.objects[(upload['bucket'], upload['name'])] = upload
+
+            return 200, self.object_resource(upload['bucket'], upload['name'], upload)
+
+        # Get, download or delete an object, /storage/v1/b/<bucket>/o/<name> or /download/storage/v1/b/<bucket>/o/<name>?alt=media
+        if parts and parts[0] == 'download':
+            parts = parts[1:]
+
+        if parts[:3] == ['storage', 'v1', 'b'] and len(parts) == 6:
+            key = (parts[3], parts[5])
+            if key not in self.objects:
+                return 404, {'error': {'code': 404, 'message': 'No such object'}}
+
+            if method == 'GET' and query.get('alt') == 'media':
+                item = self.objects[key]
+                resource = self.object_resource(*key, item)
+                return 200, item['data'], {'Content-Type': item['content_type'], 'X-Goog-Hash': f"crc32c={resource['crc32c']},md5={resource['md5Hash']}"}
+
+            if method == 'DELETE':
+                del self.objects[key]
+                return 204, None
+
+            return 200, self.object_resource(*key, self.objects[key])
+
+        # Upload to a signed URL, /<bucket>/<name>
+        if method == 'PUT' and len(parts) == 2:
+            if 'X-Goog-Signature' not in query:
+                return 403, {'error': {'code': 403, 'message': 'Missing signature'}}
+
+            signed_at = datetime.strptime(query['X-Goog-Date'], '%Y%m%dT%H%M%SZ').replace(tzinfo=timezone.utc)
+            if datetime.now(tz=timezone.utc) > signed_at + timedelta(seconds=int(query['X-Goog-Expires'])):
+                return 400, {'error': {'code': 400, 'message': 'Signed URL expired'}}
+
+            self.objects[(parts[0], parts[1])] = {'bucket': parts[0], 'name': parts[1], 'content_type': headers.get('Content-Type'), 'data': body}
+
+            return 200, None
+
+        return 404, {'error': {'code': 404, 'message': 'Not found'}}
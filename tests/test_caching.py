@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+import pytest
+import caching
+from exts import db, cache
+from models import Category, Product
+from caching import cached, invalidate_tags, should_refresh_early
+from services.category_service import CategoryService
+from services.product_service import ProductService
+from tests.utils import capture_queries
+
+# Test only one caller runs the function when many callers miss the same key at once
+@pytest.mark.parametrize('callers', [2, 8])
+
+def test_cached_single_flight(test_app, callers):
+    calls = []
+
+    @cached(timeout=60)
+    def slow_function(value):
+        calls.append(value)
+        time.sleep(0.2)
+        return value * 2
+
+    results = []
+    start_barrier = threading.Barrier(callers)
+
+    def caller():
+        with test_app.app_context():
+            start_barrier.wait()
+            results.append(slow_function(21))
+
+    threads = [threading.Thread(target=caller) for _ in range(callers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [21]
+    assert results == [42] * callers
+
+# Test a slow recompute only makes the callers of its own key wait, and the recompute claims are removed once done
+def test_cached_local_recomputes(test_app):
+    slow_started = threading.Event()
+    release_slow = threading.Event()
+
+    @cached(timeout=60)
+    def search(query):
+        if query == 'slow':
+            slow_started.set()
+            release_slow.wait(5)
+
+        return query.upper()
+
+    def slow_caller():
+        with test_app.app_context():
+            search('slow')
+
+    thread = threading.Thread(target=slow_caller)
+    thread.start()
+    slow_started.wait(5)
+
+    # The other keys are computed straight away while the slow key is being recomputed
+    started = time.time()
+    for i in range(100):
+        assert search(f'query {i}') == f'QUERY {i}'
+
+    assert time.time() - started < 1
+    assert list(caching._local_recomputes) == [search.cache_key('slow')]
+
+    release_slow.set()
+    thread.join()
+
+    assert caching._local_recomputes == {}
+
+# Test the stale value is served while another caller holds the recompute lock
+@pytest.mark.parametrize('locked', [True, False])
+
+def test_cached_serves_stale_value_while_locked(create_test_category, locked):
+    db.session.add(Product(name='Test Product', description='Test Description', price=10.00, stock=10, category_id=create_test_category.json['id']))
+    db.session.flush()
+
+    stale_products = ProductService.get_all_products()
+
+    # A new product is added to the listing
+    db.session.add(Product(name='New Product', description='Test Description', price=10.00, stock=10, category_id=create_test_category.json['id']))
+    db.session.flush()
+    invalidate_tags('products')
+
+    # Another process is recomputing the listing
+    if locked:
+        cache.add(f'lock:{ProductService.get_all_products.cache_key()}', 1)
+
+    with capture_queries() as queries:
+        products = ProductService.get_all_products()
+
+    if locked:
+        assert products == stale_products
+        assert len(queries) == 0
+    else:
+        assert products['total_products'] == 2
+        assert len(queries) > 0
+
+# Test the probability of an early refresh grows as the expiry gets closer
+@pytest.mark.parametrize('seconds_to_expiry, random_value, expected_refresh', [
+    (60, 0.5, False), # Far from expiring
+    (1, 0.0, False), # Close to expiring but unlucky
+    (1, 0.99, True), # Close to expiring and chosen to refresh
+    (-1, 0.0, True) # Already expired
+])
+
+def test_should_refresh_early(mocker, seconds_to_expiry, random_value, expected_refresh):
+    mocker.patch('caching.random.random', return_value=random_value)
+
+    entry = {'delta': 1, 'expires_at': time.time() + seconds_to_expiry}
+
+    assert should_refresh_early(entry, beta=1.0) == expected_refresh
+
+# Enable the in-process cache with a mocked Redis client, the invalidation subscriber isn't started
+@pytest.fixture
+def local_cache_enabled(test_app, monkeypatch, mocker):
+    monkeypatch.setitem(test_app.config, 'CACHE_LOCAL_ENABLED', True)
+    monkeypatch.setattr(caching, '_local_cache_pid', None) # Start each test with a new local cache
+    mocker.patch('caching.start_invalidation_subscriber')
+    return mocker.patch('exts.redis_client')
+
+# Test catalogue reads are served from the in-process cache and invalidated through pub/sub messages
+@pytest.mark.parametrize('invalidated_by_other_process', [False, True])
+
+def test_local_cache(create_test_category, local_cache_enabled, mocker, invalidated_by_other_process):
+    CategoryService.get_all_categories()
+
+    # A second read doesn't touch Redis or the database
+    cache_get = mocker.spy(cache, 'get')
+    cache_get_many = mocker.spy(cache, 'get_many')
+
+    with capture_queries() as queries:
+        categories = CategoryService.get_all_categories()
+
+    assert categories[0]['name'] == 'Test Category'
+    assert cache_get.call_count == 0
+    assert cache_get_many.call_count == 0
+    assert len(queries) == 0
+
+    db.session.add(Category(name='New Category'))
+    db.session.flush()
+
+    if invalidated_by_other_process:
+        # Another process replaces the token in Redis and publishes the tag
+        cache.set(caching.tag_key('categories'), 'new-generation', timeout=0)
+        caching.handle_invalidation_message(caching._local_cache, {'data': json.dumps(['categories'])})
+    else:
+        invalidate_tags('categories')
+
+        # The invalidation is published to the other processes
+        local_cache_enabled.publish.assert_called_once_with(caching.INVALIDATION_CHANNEL, json.dumps(['categories']))
+
+    assert len(CategoryService.get_all_categories()) == 2
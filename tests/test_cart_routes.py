@@ -1,4 +1,9 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 import pytest
+from exts import db
+from models import Cart, CartProduct, Category, Product
+from services.cart_service import CartService
 from tests.utils import auth_customer_verification
 
 # Fixtures
@@ -40,6 +45,31 @@ def test_add_product_to_cart(request, test_client, create_test_product, create_c
 
     assert response.status_code == expected_status_code
 
+# Test updating the quantity of a product in the cart only reserves stock that is available
+@pytest.mark.parametrize('quantity, expected_status_code, expected_reserved_stock', [
+    (8, 200, 10), # Success Case: Reserves the remaining stock
+    (9, 400, 6), # Failure Case: Not enough unreserved stock, nothing extra is reserved
+])
+
+def test_update_product_in_cart_reserves_stock(test_client, create_test_product, quantity, expected_status_code, expected_reserved_stock):
+    product_id = create_test_product[0].json['product_id']
+
+    # Reserve some of the stock of the product for another cart
+    product = Product.query.get(product_id)
+    product.reserved_stock = 2
+    db.session.flush()
+
+    # Add the product to the cart, reserving 4 more
+    response = test_client.post(f'/cart/{product_id}', json={'quantity': 4})
+    assert response.status_code == 200
+
+    response = test_client.put(f'/cart/{response.json["id"]}', json={'quantity': quantity})
+
+    assert response.status_code == expected_status_code
+
+    db.session.refresh(product)
+    assert product.reserved_stock == expected_reserved_stock
+
 # Test the update product quantity in cart route
 @pytest.mark.parametrize('update_cart_product_data, expected_status_code, auth_required', [
     ("valid_cart_product_data", 200, True), # Success Case
@@ -72,4 +102,53 @@ def test_delete_product_in_cart(request, test_client, get_all_test_products_in_c
 
     response = test_client.delete(f'/cart/{cart_product_id}')
 
-    assert response.status_code == expected_status_code
\ No newline at end of file
+    assert response.status_code == expected_status_code
+
+# Test the abandoned cart cleanup unlocks expired carts and releases the stock of stale carts
+def test_cleanup_abandoned_carts(test_create_users):
+    admin, customer = test_create_users
+    now = datetime.now(tz=ZoneInfo("UTC"))
+
+    category = Category(name='Test Category')
+    db.session.add(category)
+    db.session.flush()
+
+    product = Product(name='Test Product', description='Test Description', price=10.00, stock=10, reserved_stock=5, category_id=category.id)
+    db.session.add(product)
+    db.session.flush()
+
+    # The admin's cart is stale, the customer's cart was locked for checkout too long ago but had a product added recently
+    stale_cart = Cart.query.filter_by(user_id=admin.id).first()
+    stale_cart.product_added_at = now - timedelta(hours=2)
+
+    locked_cart = Cart.query.filter_by(user_id=customer.id).first()
+    locked_cart.locked = True
+    locked_cart.locked_at = now - timedelta(hours=25)
+    locked_cart.product_added_at = now - timedelta(minutes=10)
+
+    db.session.add(CartProduct(quantity=3, product_id=product.id, cart_id=stale_cart.id))
+    db.session.add(CartProduct(quantity=2, product_id=product.id, cart_id=locked_cart.id))
+    db.session.flush()
+
+    phases = CartService.cleanup_abandoned_carts(cart_unlock_time_hours=24, reserved_stock_cleanup_hours=1)
+    phases = {phase['phase']: phase for phase in phases}
+
+    assert phases['unlock_carts']['rows'] == 1
+    assert phases['delete_cart_products']['rows'] == 1
+    assert phases['release_reserved_stock']['rows'] == 1
+    assert phases['release_reserved_stock']['quantity'] == 3
+    assert phases['reset_stale_carts']['rows'] == 1
+
+    db.session.refresh(product)
+    db.session.refresh(stale_cart)
+    db.session.refresh(locked_cart)
+
+    # Only the stale cart's stock is released
+    assert product.reserved_stock == 2
+    assert CartProduct.query.filter_by(cart_id=stale_cart.id).count() == 0
+    assert stale_cart.product_added_at is None
+
+    # The locked cart is unlocked but keeps its products
+    assert locked_cart.locked is False
+    assert locked_cart.locked_at is None
+    assert CartProduct.query.filter_by(cart_id=locked_cart.id).count() == 1
@@ -1,5 +1,7 @@
 import pytest
-from tests.utils import auth_admin_verification, auth_customer_verification
+from exts import db
+from models import Category
+from tests.utils import auth_admin_verification, auth_customer_verification, get_all_cursor_pages
 
 # Fixtures
 
@@ -139,3 +141,23 @@ def test_delete_category(request, test_client, expected_status_code, auth_requir
     response = test_client.delete(f'/category/admin/{category_id}')
 
     assert response.status_code == expected_status_code
+
+# Test the admin categories route with cursor pagination returns every category once, latest first
+@pytest.mark.parametrize('category_count, expected_pages', [
+    (3, 1),
+    (10, 1),
+    (21, 3)
+])
+
+def test_get_all_admin_categories_by_cursor(test_client, test_admin_login, category_count, expected_pages):
+    for i in range(category_count):
+        db.session.add(Category(name=f'Test Category {i}'))
+    db.session.flush()
+
+    categories, pages = get_all_cursor_pages(test_client, '/category/admin', 'categories')
+    category_ids = [category['id'] for category in categories]
+
+    assert pages == expected_pages
+    assert len(category_ids) == category_count
+    assert category_ids == sorted(category_ids, reverse=True)
+
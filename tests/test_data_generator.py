@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import func, select
+from exts import db
+from models import User, Address, Cart, CartProduct, Category, Product, ProductImage, FeaturedProduct, Order, OrderItem, DashboardStatistic
+from benchmarks.data_generator import SCALES, generate_data
+
+# Test the generator fills every table with consistent, skewed data
+@pytest.mark.parametrize('seed', [
+    0,
+    1
+])
+
+def test_generate_data(test_app, seed):
+    counts = generate_data(seed=seed, **SCALES['small'])
+
+    for model in (User, Address, Cart, CartProduct, Category, Product, ProductImage, FeaturedProduct, Order, OrderItem):
+        assert db.session.scalar(select(func.count()).select_from(model)) >= counts[model.__tablename__] > 0
+
+    # Every user has a cart and guests have no email
+    assert counts['Cart'] == counts['User'] == SCALES['small']['users']
+    assert db.session.scalar(select(func.count()).select_from(User).where(User.role == 'guest', User.email.isnot(None))) == 0
+
+    # The reserved stock of each product is the quantity held by the carts
+    reserved = db.session.execute(
+        select(Product.id, Product.reserved_stock, func.coalesce(func.sum(CartProduct.quantity), 0)).outerjoin(CartProduct).group_by(Product.id)
+    ).all()
+    assert all(reserved_stock == cart_quantity for _, reserved_stock, cart_quantity in reserved)
+    assert db.session.scalar(select(func.count()).select_from(Product).where(Product.stock < Product.reserved_stock)) == 0
+
+    # The order totals add up to their items
+    mismatched = db.session.scalar(
+        select(func.count()).select_from(
+            select(Order.id).join(OrderItem).group_by(Order.id).having(func.abs(Order.total_price - func.sum(OrderItem.price * OrderItem.quantity)) > 0.05).subquery()
+        )
+    )
+    assert mismatched == 0
+
+    # A tenth of the products make up most of the sales, and a few users place many orders
+    sales = db.session.scalars(select(func.sum(OrderItem.quantity)).group_by(OrderItem.product_id).order_by(func.sum(OrderItem.quantity).desc())).all()
+    assert sum(sales[:SCALES['small']['products'] // 10]) > sum(sales) / 2
+
+    orders_per_user = db.session.scalars(select(func.count(Order.id)).group_by(Order.user_id).order_by(func.count(Order.id).desc())).all()
+    assert orders_per_user[0] >= 10 * orders_per_user[len(orders_per_user) // 2]
+
+    # The dashboard statistics are rebuilt from the generated orders
+    assert db.session.get(DashboardStatistic, 'orders_overall').value == db.session.scalar(select(func.count()).select_from(Order))
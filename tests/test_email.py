@@ -0,0 +1,75 @@
+import ssl
+import pytest
+import exts
+from config import celery_connection_options
+from services.utils import deliver_email, EmailDeliveryError
+
+# Test emails are posted to Mailgun and failures are marked as retryable only when sending again could succeed
+@pytest.mark.parametrize('failures, retryable', [
+    ([], None), # Success Case
+    ([500], True), # Failure Case: Mailgun server error
+    ([429], True), # Failure Case: Rate limited by Mailgun
+    ([400], False) # Failure Case: Invalid email
+])
+
+def test_deliver_email(fake_mailgun, failures, retryable):
+    fake_mailgun.failures.extend(failures)
+
+    message = {'from': 'shop@test.com', 'to': 'Jane Doe <customer@test.com>', 'subject': 'Test Subject', 'text': 'Test Message'}
+
+    if retryable is None:
+        response = deliver_email(message)
+
+        assert 'id' in response
+        assert fake_mailgun.messages == [{'domain': 'mg.test.com', **message}]
+    else:
+        with pytest.raises(EmailDeliveryError) as error:
+            deliver_email(message)
+
+        assert error.value.retryable == retryable
+        assert fake_mailgun.messages == []
+
+# Test the password reset email is queued for the Celery worker, or sent straight away when tasks are run eagerly
+@pytest.mark.parametrize('eager, failures, expected_status_code', [
+    (False, [], 200), # Success Case: Queued for the worker
+    (True, [], 200), # Success Case: Sent in the request
+    (False, [500], 200), # Success Case: Mailgun is down but the email is queued and retried by the worker
+    (True, [500], 400) # Failure Case: Mailgun is down and the email is sent in the request
+])
+
+def test_password_reset_email_queued(test_app, test_client, test_create_users, fake_mailgun, monkeypatch, mocker, eager, failures, expected_status_code):
+    monkeypatch.setitem(test_app.config, 'CELERY_TASK_ALWAYS_EAGER', eager)
+    mocked_send_task = mocker.patch.object(exts.celery_client, 'send_task')
+    fake_mailgun.failures.extend(failures)
+
+    response = test_client.post('/user/reset-password', json={'email': 'customer@test.com'})
+
+    assert response.status_code == expected_status_code
+
+    if eager:
+        mocked_send_task.assert_not_called()
+        assert [message['to'] for message in fake_mailgun.messages] == (['Jane Doe <customer@test.com>'] if expected_status_code == 200 else [])
+    else:
+        # The request doesn't contact Mailgun
+        mocked_send_task.assert_called_once()
+        assert mocked_send_task.call_args.args[0] == 'tasks.email_delivery.send_email'
+        assert mocked_send_task.call_args.kwargs['args'][0]['to'] == 'Jane Doe <customer@test.com>'
+        assert fake_mailgun.messages == []
+
+# Test the Celery worker and the app's Celery client connect to the broker over SSL when it is required
+@pytest.mark.parametrize('redis_ssl_required, expected_ssl', [
+    ('True', True), # SSL broker, e.g. upstash
+    ('False', False) # Local broker
+])
+
+def test_celery_connection_options(monkeypatch, redis_ssl_required, expected_ssl):
+    monkeypatch.setenv('REDIS_SSL_REQUIRED', redis_ssl_required)
+
+    options = celery_connection_options({'CELERY_BROKER_URL': 'rediss://broker:6379/0', 'CELERY_RESULT_BACKEND': 'rediss://broker:6379/0'})
+
+    assert options['broker_url'] == options['result_backend'] == 'rediss://broker:6379/0'
+
+    if expected_ssl:
+        assert options['broker_use_ssl'] == options['redis_backend_use_ssl'] == {'ssl_cert_reqs': ssl.CERT_REQUIRED}
+    else:
+        assert 'broker_use_ssl' not in options and 'redis_backend_use_ssl' not in options
@@ -0,0 +1,190 @@
+import io
+import os
+import re
+import subprocess
+import sys
+import pytest
+from sqlalchemy import NullPool, create_engine, text
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+import metrics
+from config import database_engine_options
+from metrics import InstrumentedQueuePool
+from prometheus_client import REGISTRY
+from tests.utils import capture_queries
+
+# Test the connection pool settings of each role and their environment variable overrides
+@pytest.mark.parametrize('role, default_pool_class, environment, expected_options', [
+    ('backend', 'queue', {}, {'pool_size': 5, 'max_overflow': 5, 'pool_timeout': 30, 'pool_recycle': 1800}), # Gunicorn defaults
+    ('celery', 'queue', {}, {'pool_size': 2, 'max_overflow': 2, 'pool_timeout': 30, 'pool_recycle': 1800}), # Celery worker defaults
+    ('beat', 'queue', {'DB_POOL_RECYCLE': '600'}, {'pool_size': 1, 'max_overflow': 0, 'pool_timeout': 30, 'pool_recycle': 600}), # Setting shared by every role
+    ('celery', 'queue', {'DB_POOL_SIZE': '10', 'DB_POOL_SIZE_CELERY': '4'}, {'pool_size': 4, 'max_overflow': 2, 'pool_timeout': 30, 'pool_recycle': 1800}), # Role specific setting
+    ('backend', 'queue', {'DB_POOL_CLASS': 'null'}, None), # NullPool, a connection per checkout
+    ('backend', 'null', {}, None), # Production default, pgbouncer pools the connections
+    ('backend', 'null', {'DB_POOL_CLASS': 'queue'}, {'pool_size': 5, 'max_overflow': 5, 'pool_timeout': 30, 'pool_recycle': 1800}) # Pooled in production
+])
+
+def test_database_engine_options(monkeypatch, role, default_pool_class, environment, expected_options):
+    for name, value in environment.items():
+        monkeypatch.setenv(name, value)
+
+    options = database_engine_options(role, default_pool_class)
+
+    if expected_options is None:
+        assert options == {'poolclass': NullPool}
+    else:
+        assert options == {'poolclass': InstrumentedQueuePool, 'pool_pre_ping': True, **expected_options}
+
+# Test the pool records the checkout latency, the connections it opens and the checkouts that wait for a connection
+def test_instrumented_queue_pool(test_app):
+    engine = create_engine(test_app.config['SQLALCHEMY_DATABASE_URI'], poolclass=InstrumentedQueuePool, pool_size=1, max_overflow=0, pool_timeout=0.1)
+
+    def sample(name):
+        return REGISTRY.get_sample_value(name) or 0
+
+    checkouts = sample('db_pool_checkout_seconds_count')
+    opened = sample('db_pool_connections_opened_total')
+    waits = sample('db_pool_checkout_waits_total')
+    timeouts = sample('db_pool_checkout_timeouts_total')
+
+    try:
+        # The second checkout reuses the connection opened by the first
+        for _ in range(2):
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+
+        assert sample('db_pool_checkout_seconds_count') == checkouts + 2
+        assert sample('db_pool_connections_opened_total') == opened + 1
+
+        # Every connection is in use, so the checkout waits and times out
+        with engine.connect():
+            checked_out = sum(pool.checkedout() for pool in metrics.pools) # Including the connection of the test session
+
+            assert sample('db_pool_checked_out') == checked_out
+            assert sample('db_pool_max_connections') == sum(pool.size() + pool.max_overflow for pool in metrics.pools)
+
+            with pytest.raises(PoolTimeoutError):
+                engine.connect()
+
+        assert sample('db_pool_checkout_waits_total') == waits + 1
+        assert sample('db_pool_checkout_timeouts_total') == timeouts + 1
+
+        # The connection has been returned to the pool
+        assert sample('db_pool_checked_out') == checked_out - 1
+    finally:
+        engine.dispose()
+
+    assert engine.pool in metrics.pools
+
+# Test the metrics of every process of a role are added up, as with the Gunicorn workers or Celery worker processes
+def test_multiprocess_metrics(tmp_path, monkeypatch):
+    pids = []
+
+    for _ in range(2):
+        process = subprocess.run(
+            [sys.executable, '-c', 'import os, metrics; metrics.pool_connections_opened.inc(); metrics.pool_size.set(5); print(os.getpid())'],
+            env={**os.environ, 'PROMETHEUS_MULTIPROC_DIR': str(tmp_path)}, cwd=os.path.dirname(os.path.dirname(__file__)), capture_output=True, text=True, check=True
+        )
+        pids.append(int(process.stdout))
+
+    monkeypatch.setenv('PROMETHEUS_MULTIPROC_DIR', str(tmp_path))
+
+    body, _ = metrics.render_metrics()
+    assert {'db_pool_connections_opened_total 2.0', 'db_pool_size 10.0'} <= set(body.decode().splitlines())
+
+    # The gauges of an exited process are removed, the counters keep its increments
+    metrics.mark_process_dead(pids[0])
+
+    body, _ = metrics.render_metrics()
+    assert {'db_pool_connections_opened_total 2.0', 'db_pool_size 5.0'} <= set(body.decode().splitlines())
+
+# Test the metrics endpoint is only available to Prometheus with the metrics token
+@pytest.mark.parametrize('metrics_token, authorization, expected_status_code', [
+    ('metrics_test', 'Bearer metrics_test', 200), # Success Case
+    ('metrics_test', 'Bearer wrong', 401), # Unauthorised Case: Wrong token
+    ('metrics_test', None, 401), # Unauthorised Case: No token
+    (None, 'Bearer metrics_test', 404) # Failure Case: Metrics disabled
+])
+
+def test_metrics_route(test_app, test_client, monkeypatch, metrics_token, authorization, expected_status_code):
+    monkeypatch.setitem(test_app.config, 'METRICS_TOKEN', metrics_token)
+
+    response = test_client.get('/metrics', headers={'Authorization': authorization} if authorization else {})
+
+    assert response.status_code == expected_status_code
+
+    if expected_status_code == 200:
+        assert response.mimetype == 'text/plain'
+        assert '# TYPE db_pool_checkout_seconds histogram' in response.text
+        assert 'db_pool_checkout_seconds_bucket{le="+Inf"}' in response.text
+
+# Parse a Server-Timing header into a metric name to parameters map
+def parse_server_timing(header):
+    return {
+        name: dict(re.findall(r';(\w+)="?([^;"]*)"?', parameters))
+        for name, parameters in re.findall(r'(\w+)((?:;\w+=(?:"[^"]*"|[^;,]*))*)', header)
+    }
+
+# Test each request reports its queries, cache hits and misses and total time in the Server-Timing header and the metrics
+def test_server_timing(test_app, test_client, create_test_product, monkeypatch):
+    monkeypatch.setitem(test_app.config, 'METRICS_TOKEN', 'metrics_test')
+
+    with capture_queries() as queries:
+        response = test_client.get('/product/')
+
+    server_timing = parse_server_timing(response.headers['Server-Timing'])
+
+    assert server_timing['db']['desc'] == f'{len(queries)} queries'
+    assert server_timing['cache']['desc'] == '0 hits, 1 misses'
+    assert float(server_timing['total']['dur']) >= float(server_timing['db']['dur'])
+
+    # The listing is cached, so the second request doesn't query the database
+    server_timing = parse_server_timing(test_client.get('/product/').headers['Server-Timing'])
+
+    assert server_timing['db']['desc'] == '0 queries'
+    assert server_timing['cache']['desc'] == '1 hits, 0 misses'
+
+    rendered = test_client.get('/metrics', headers={'Authorization': 'Bearer metrics_test'}).text
+
+    assert re.search(r'^http_requests_total\{endpoint="/product/",method="GET",status="200"\} [1-9]', rendered, re.MULTILINE)
+    assert re.search(r'^http_request_db_queries_count\{endpoint="/product/",method="GET"\} [1-9]', rendered, re.MULTILINE)
+    assert re.search(r'^cache_requests_total\{function="[\w.]*get_all_products",result="hit"\} [1-9]', rendered, re.MULTILINE)
+
+# Test the Server-Timing header is only sent when enabled, it is off by default in production
+def test_server_timing_disabled(test_app, test_client, create_test_category, monkeypatch):
+    monkeypatch.setitem(test_app.config, 'SERVER_TIMING_ENABLED', False)
+
+    response = test_client.get(f"/category/{create_test_category.json['id']}")
+
+    assert response.status_code == 200
+    assert 'Server-Timing' not in response.headers
+
+# Test the time spent calling Google Cloud Storage is reported separately
+def test_server_timing_external_call(test_client, fake_gcs, fake_stripe, create_test_category, test_admin_login):
+    product_id = test_client.post('/product/admin', json={'name': 'Test Product', 'description': 'Test Description', 'price': 10.00, 'stock': 10, 'category_id': create_test_category.json['id']}).json['product_id']
+
+    response = test_client.post(f'/product/admin/product-image/{product_id}', data={'image': (io.BytesIO(b'Fake Image data'), 'test_image.jpg', 'image/jpeg')})
+
+    server_timing = parse_server_timing(response.headers['Server-Timing'])
+
+    assert float(server_timing['gcs']['dur']) > 0
+    assert float(server_timing['gcs']['dur']) <= float(server_timing['total']['dur'])
+
+# Test requests slower than the threshold are logged
+@pytest.mark.parametrize('slow_request_threshold, expected_logged', [
+    (0.001, True), # Every request takes longer than a microsecond
+    (60 * 1000, False), # Faster than the threshold
+    (0, False) # Slow request log disabled
+])
+
+def test_slow_request_log(test_app, test_client, create_test_category, monkeypatch, capsys, slow_request_threshold, expected_logged):
+    monkeypatch.setitem(test_app.config, 'SLOW_REQUEST_THRESHOLD_MS', slow_request_threshold)
+    capsys.readouterr()
+
+    test_client.get(f"/category/{create_test_category.json['id']}")
+
+    logged = [line for line in capsys.readouterr().out.splitlines() if line.startswith('Slow request:')]
+
+    assert bool(logged) == expected_logged
+
+    if expected_logged:
+        assert re.match(rf"Slow request: GET /category/{create_test_category.json['id']} \d+ took \d+ms, \d+ queries in \d+ms", logged[0])
@@ -1,7 +1,12 @@
-from flask_jwt_extended import get_jwt_identity
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 import pytest
 from pytest_mock import mocker
-from tests.utils import auth_admin_verification, auth_customer_verification
+from exts import db
+from models import Cart, CartProduct, Category, Product, ProductImage, Order, OrderItem, StripeWebhookEvent, User
+from services.webhook_service import WebhookService
+from tests.utils import auth_admin_verification, auth_customer_verification, capture_queries, count_commits, get_all_cursor_pages, build_checkout_session, build_stripe_event, post_stripe_event
+import exts
 
 # Fixtures
 
@@ -19,19 +24,6 @@ def valid_create_checkout_session_data():
         'postcode': 'TE1 1ST',
     }
 
-@pytest.fixture
-def valid_order_data():
-    return {
-        'user_id': get_jwt_identity(),
-        'full_name': 'John Doe',
-        'address_line_1': '123 Test Street',
-        'address_line_2': 'Test Area',
-        'city': 'Test City',
-        'postcode': 'TE1 1ST',
-        'customer_email': 'test@test.com',
-        'stripe_session_id': 'test_session_id',
-    }
-
 @pytest.fixture
 def valid_update_order_data():
     return {
@@ -57,6 +49,57 @@ def test_get_all_orders(request, test_client, expected_status_code, auth_require
 
     assert response.status_code == expected_status_code
 
+# Test the get all orders route runs a fixed number of queries regardless of how many orders and order items are on the page
+@pytest.mark.parametrize('order_count', [1, 3, 6])
+
+def test_get_all_orders_query_count(test_client, test_create_users, test_customer_login, order_count):
+    customer = test_create_users[1]
+
+    # Create the products and their images directly in the database
+    category = Category(name='Test Category')
+    db.session.add(category)
+    db.session.flush()
+
+    products = []
+    for i in range(5):
+        product = Product(name=f'Test Product {i}', description='Test Description', price=10.00, stock=10, category_id=category.id)
+        db.session.add(product)
+        db.session.flush()
+
+        db.session.add(ProductImage(image_path=f'test_image_{i}.jpg', product_id=product.id))
+        products.append(product)
+
+    # Create the orders, each with an order item for every product
+    for i in range(order_count):
+        order = Order(
+            order_date=datetime.now(tz=ZoneInfo("UTC")),
+            total_price=50.00,
+            status='Processing',
+            full_name='Jane Doe',
+            address_line_1='123 Test Street',
+            city='Test City',
+            postcode='TE1 1ST',
+            customer_email='customer@test.com',
+            stripe_session_id=f'test_session_id_{i}',
+            user_id=customer.id
+        )
+        db.session.add(order)
+        db.session.flush()
+
+        for product in products:
+            db.session.add(OrderItem(quantity=1, name=product.name, price=product.price, product_id=product.id, order_id=order.id))
+    db.session.flush()
+
+    with capture_queries() as queries:
+        response = test_client.get('/order/')
+
+    assert response.status_code == 200
+    assert len(response.json['orders']) == order_count
+    assert {order_item['product_image'] for order_item in response.json['orders'][0]['order_items']} == {f'test_image_{i}.jpg' for i in range(5)}
+
+    # The page of orders, the total count, the order items and the product images, the role is read from the token
+    assert len(queries) == 4
+
 # Test the get stripe checkout session route
 @pytest.mark.parametrize('create_order_data, expected_status_code, auth_required', [
     ("valid_create_checkout_session_data", 200, True), # Success Case
@@ -77,26 +120,131 @@ def test_get_stripe_checkout_session(request, test_client, add_test_product_to_c
     if (expected_status_code == 200):
         mocked_create_stripe_checkout_session.assert_called_once()
 
-# Test create order route
-@pytest.mark.parametrize('create_order_data, expected_status_code, auth_required', [
-    ("valid_order_data", 200, True), # Success Case
-    # ("missing_data", 400, True) # Failure Case: Missing Data
+# Test create order route, the order is created from the checkout.session.completed event sent to the webhook
+@pytest.mark.parametrize('signature_valid, deliveries, expected_status_code, expected_orders', [
+    (True, 1, 200, 1), # Success Case
+    (True, 3, 200, 1), # Success Case: Event redelivered by Stripe, the order is only created once
+    (False, 1, 400, 0) # Failure Case: Invalid signature
 ])
 
-def test_create_order(request, test_client, mocker, add_test_product_to_cart, create_order_data, expected_status_code, auth_required):
-    order_data = request.getfixturevalue(create_order_data)
+def test_create_order(test_client, test_create_users, add_test_product_to_cart, signature_valid, deliveries, expected_status_code, expected_orders):
+    admin = test_create_users[0]
+    event = build_stripe_event('checkout.session.completed', build_checkout_session(admin.id))
 
-    auth_customer_verification(test_client, auth_required, request)
+    for _ in range(deliveries):
+        response = post_stripe_event(test_client, event, secret='whsec_test' if signature_valid else 'whsec_wrong')
 
-    mocked_stripe_webhook_handler = mocker.patch('api.order.stripe_webhook_handler', return_value=order_data)
+        assert response.status_code == expected_status_code
 
-    response = test_client.post('/order/webhook')
+    assert Order.query.filter_by(stripe_session_id='test_session_id').count() == expected_orders
+    assert StripeWebhookEvent.query.count() == expected_orders
 
-    assert response.status_code == expected_status_code
+    if expected_orders:
+        assert db.session.get(StripeWebhookEvent, event['id']).processed_at is not None
+        assert db.session.get(User, admin.id).stripe_customer_id == 'cus_test'
+
+# Test the webhook only stores the event when tasks are queued for the worker, and the worker creates the order once
+def test_create_order_queued(test_app, test_client, test_create_users, add_test_product_to_cart, monkeypatch, mocker):
+    monkeypatch.setitem(test_app.config, 'CELERY_TASK_ALWAYS_EAGER', False)
+    mocked_send_task = mocker.patch.object(exts.celery_client, 'send_task')
+
+    event = build_stripe_event('checkout.session.completed', build_checkout_session(test_create_users[0].id))
+
+    response = post_stripe_event(test_client, event)
+
+    assert response.status_code == 200
+    mocked_send_task.assert_called_once_with('tasks.stripe_webhooks.process_stripe_event', args=[event['id']])
+    assert Order.query.count() == 0
+
+    # The worker handles the event, handling it again does nothing
+    assert WebhookService.process_event(event['id']) is True
+    assert WebhookService.process_event(event['id']) is None
+    assert WebhookService.process_pending() == {'processed': 0, 'failed': 0}
+    assert Order.query.count() == 1
+
+# Test a failed event is backed off in the inbox and created once it succeeds
+def test_create_order_retried(test_client, test_create_users, add_test_product_to_cart, mocker):
+    event = build_stripe_event('checkout.session.completed', build_checkout_session(test_create_users[0].id))
+
+    mocker.patch('services.webhook_service.OrderService.create_order', side_effect=Exception('Database unavailable'))
+    response = post_stripe_event(test_client, event)
+    mocker.stopall()
+
+    assert response.status_code == 200
+
+    stored_event = db.session.get(StripeWebhookEvent, event['id'])
+    assert stored_event.processed_at is None
+    assert stored_event.attempts == 1
+    assert stored_event.last_error == 'Database unavailable'
+    assert Order.query.count() == 0
+
+    # The event isn't retried until the backoff is over
+    assert WebhookService.process_pending() == {'processed': 0, 'failed': 0}
+
+    stored_event.next_attempt_at = datetime.now(tz=ZoneInfo("UTC")) - timedelta(seconds=1)
+    db.session.commit()
+
+    assert WebhookService.process_pending() == {'processed': 1, 'failed': 0}
+    assert Order.query.count() == 1
+
+# Test the expired checkout session event unlocks the cart
+def test_checkout_session_expired(test_client, test_create_users):
+    customer = test_create_users[1]
+    cart = Cart.query.filter_by(user_id=customer.id).first()
+    cart.locked = True
+    cart.locked_at = datetime.now(tz=ZoneInfo("UTC"))
+    db.session.commit()
+
+    response = post_stripe_event(test_client, build_stripe_event('checkout.session.expired', build_checkout_session(customer.id)))
+
+    assert response.status_code == 200
+
+    db.session.refresh(cart)
+    assert cart.locked is False
+    assert cart.locked_at is None
+
+# Test create order creates the order, updates the stock, empties the cart and marks the event as processed in a single commit
+@pytest.mark.parametrize('cart_size', [1, 5])
+
+def test_create_order_single_transaction(test_client, test_create_users, cart_size):
+    customer = test_create_users[1]
+    cart = Cart.query.filter_by(user_id=customer.id).first()
+
+    # Create the products and add them to the customer's cart
+    category = Category(name='Test Category')
+    db.session.add(category)
+    db.session.flush()
+
+    products = []
+    for i in range(cart_size):
+        product = Product(name=f'Test Product {i}', description='Test Description', price=10.00, stock=10, reserved_stock=2, category_id=category.id)
+        db.session.add(product)
+        db.session.flush()
+
+        db.session.add(CartProduct(quantity=2, product_id=product.id, cart_id=cart.id))
+        products.append(product)
+    db.session.flush()
+
+    event = build_stripe_event('checkout.session.completed', build_checkout_session(customer.id))
+
+    with count_commits() as commits:
+        response = post_stripe_event(test_client, event)
+
+    assert response.status_code == 200
+    assert len(commits) == 2 # One to store the event, one for the order
+
+    # Check the order items, stock and cart were all updated
+    order = Order.query.filter_by(stripe_session_id='test_session_id').one()
+    assert len(order.order_items) == cart_size
+    assert float(order.total_price) == 20.00 * cart_size
+    assert CartProduct.query.filter_by(cart_id=cart.id).count() == 0
+    assert db.session.get(StripeWebhookEvent, event['id']).processed_at is not None
+
+    for product in products:
+        db.session.refresh(product)
+        assert product.stock == 8
+        assert product.reserved_stock == 0
 
-    if (expected_status_code == 200):
-        mocked_stripe_webhook_handler.assert_called_once()
-        
 # Test the get all customer orders route (Admin)
 @pytest.mark.parametrize('expected_status_code, auth_required', [
     (200, True), # Success Case
@@ -120,7 +268,7 @@ def test_get_all_customer_orders(request, test_client, expected_status_code, aut
 ])
 
 def test_get_order(request, test_client, create_test_order, expected_status_code, auth_required):
-    order_id = create_test_order.json['id']
+    order_id = create_test_order.id
 
     auth_admin_verification(test_client, auth_required, request)
 
@@ -136,7 +284,7 @@ def test_get_order(request, test_client, create_test_order, expected_status_code
 ])
 
 def test_update_order(request, test_client, mocker, create_test_order, update_order_data, expected_status_code, auth_required):
-    order_id = create_test_order.json['id']
+    order_id = create_test_order.id
 
     order_data = request.getfixturevalue(update_order_data)
 
@@ -182,4 +330,43 @@ def test_check_stripe_session_status(request, test_client, expected_status_code,
 
     response = test_client.get(f'/order/stripe_session_status?session_id=test_session_id')
 
-    assert response.status_code == expected_status_code
\ No newline at end of file
+    assert response.status_code == expected_status_code
+
+# Test the admin orders route with cursor pagination returns every order once, latest first, including orders placed at the same time
+@pytest.mark.parametrize('order_count, status, expected_count', [
+    (5, None, 5),
+    (23, None, 23),
+    (23, 'Shipped', 11) # Every other order is shipped
+])
+
+def test_get_all_customer_orders_by_cursor(test_client, test_create_users, test_admin_login, order_count, status, expected_count):
+    now = datetime.now(tz=ZoneInfo("UTC"))
+
+    for i in range(order_count):
+        db.session.add(Order(
+            order_date=now - timedelta(days=i // 3), # Three orders share each order date
+            total_price=50.00,
+            status='Shipped' if i % 2 else 'Processing',
+            full_name='Jane Doe',
+            address_line_1='123 Test Street',
+            city='Test City',
+            postcode='TE1 1ST',
+            customer_email='customer@test.com',
+            stripe_session_id=f'test_session_id_{i}',
+            user_id=test_create_users[1].id
+        ))
+    db.session.flush()
+
+    url = f'/order/admin?status={status}' if status else '/order/admin'
+    orders, pages = get_all_cursor_pages(test_client, url, 'orders')
+
+    assert len(orders) == expected_count
+    assert len({order['id'] for order in orders}) == expected_count
+    assert pages == (expected_count + 9) // 10
+
+    # Ordered by order date then id, latest first
+    assert [(order['order_date'], order['id']) for order in orders] == sorted(((order['order_date'], order['id']) for order in orders), reverse=True)
+
+    if status:
+        assert {order['status'] for order in orders} == {status}
+
@@ -1,6 +1,16 @@
 import io
 import pytest
-from tests.utils import auth_admin_verification, auth_customer_verification
+import requests
+from google.auth import compute_engine
+from PIL import Image
+from sqlalchemy import update
+from exts import db
+from models import Category, Product, ProductImage
+from services.category_service import CategoryService
+from services.image_derivative_service import ImageDerivativeService
+from services.product_service import ProductService
+from services.utils import generate_image_upload_url
+from tests.utils import auth_admin_verification, auth_customer_verification, capture_queries, get_all_cursor_pages
 
 # Fixtures
 
@@ -41,6 +51,298 @@ def test_get_all_products(request, test_client, expected_status_code, auth_requi
 
     assert response.status_code == expected_status_code
 
+# Test the get all products route runs a fixed number of queries regardless of how many products are on the page
+@pytest.mark.parametrize('product_count', [1, 4, 9])
+
+def test_get_all_products_query_count(test_client, create_test_category, product_count):
+    category_id = create_test_category.json['id']
+
+    # Create the products and their images directly in the database
+    for i in range(product_count):
+        product = Product(name=f'Test Product {i}', description='Test Description', price=10.00, stock=10, category_id=category_id)
+        db.session.add(product)
+        db.session.flush()
+
+        db.session.add(ProductImage(image_path=f'test_image_{i}.jpg', product_id=product.id))
+    db.session.flush()
+
+    with capture_queries() as queries:
+        response = test_client.get('/product/')
+
+    assert response.status_code == 200
+    assert len(response.json['products']) == product_count
+    assert response.json['products'][0]['image_path'] == f'test_image_{product_count - 1}.jpg'
+    assert response.json['products'][0]['category_name'] == 'Test Category'
+
+    # One query for the page and one for the total count
+    assert len(queries) == 2
+
+# Test the admin products route with cursor pagination returns every product once, latest first
+@pytest.mark.parametrize('product_count, expected_pages', [
+    (1, 1),
+    (10, 1),
+    (25, 3)
+])
+
+def test_get_all_admin_products_by_cursor(test_client, create_test_category, test_admin_login, product_count, expected_pages):
+    for i in range(product_count):
+        db.session.add(Product(name=f'Test Product {i}', description='Test Description', price=10.00, stock=10, category_id=create_test_category.json['id']))
+    db.session.flush()
+
+    products, pages = get_all_cursor_pages(test_client, '/product/admin', 'products')
+    product_ids = [product['id'] for product in products]
+
+    assert pages == expected_pages
+    assert len(product_ids) == product_count
+    assert product_ids == sorted(product_ids, reverse=True)
+
+    # The total is only counted if asked for
+    response = test_client.get('/product/admin?cursor=&include_total=true')
+    assert response.json['total_products'] == product_count
+    assert 'total_products' not in test_client.get('/product/admin?cursor=').json
+
+    # An invalid cursor is rejected
+    assert test_client.get('/product/admin?cursor=not-a-cursor').status_code == 400
+
+# Test a stock change only invalidates the cached listings it affects
+@pytest.mark.parametrize('quantity_sold, shop_listing_invalidated', [
+    (3, False), # The product is still in stock, the shop listings don't change
+    (10, True) # The product sold out, the unfiltered listing and its category's listing change
+])
+
+def test_stock_change_cache_invalidation(test_client, quantity_sold, shop_listing_invalidated):
+    categories = [Category(name='Category A'), Category(name='Category B')]
+    db.session.add_all(categories)
+    db.session.flush()
+
+    products = [Product(name=f'Test Product {i}', description='Test Description', price=10.00, stock=10, category_id=category.id) for i, category in enumerate(categories)]
+    db.session.add_all(products)
+    db.session.flush()
+
+    sold_product, other_product = products
+
+    # Warm the cache
+    ProductService.get_all_products()
+    ProductService.get_all_products(category_id=sold_product.category_id)
+    ProductService.get_all_products(category_id=other_product.category_id)
+    ProductService.get_all_admin_products()
+
+    # Sell some of the first product
+    updated_products = db.session.execute(
+        update(Product)
+        .where(Product.id == sold_product.id)
+        .values(stock=Product.stock - quantity_sold)
+        .returning(Product.id, Product.category_id, Product.stock)
+    ).all()
+    ProductService.invalidate_stock_changes(updated_products)
+
+    # Check which listings are fetched from the database again
+    def is_invalidated(fetch):
+        with capture_queries() as queries:
+            fetch()
+        return len(queries) > 0
+
+    assert is_invalidated(lambda: ProductService.get_all_products()) == shop_listing_invalidated
+    assert is_invalidated(lambda: ProductService.get_all_products(category_id=sold_product.category_id)) == shop_listing_invalidated
+    assert is_invalidated(lambda: ProductService.get_all_products(category_id=other_product.category_id)) is False
+
+    # The admin listing shows the stock, so it is always invalidated
+    assert is_invalidated(lambda: ProductService.get_all_admin_products()) is True
+
+# Fixture with products to filter, across three categories and the price ranges
+@pytest.fixture
+def filter_test_products(db_session):
+    categories = {name: Category(name=name) for name in ('Footwear', 'Bags', 'Accessories')}
+    db.session.add_all(categories.values())
+    db.session.flush()
+
+    products = {
+        name: Product(name=name, description='Test Description', price=price, stock=stock, category_id=categories[category].id)
+        for name, price, stock, category in [
+            ('Running Shoes', 45.00, 10, 'Footwear'),
+            ('Walking Boots', 120.00, 10, 'Footwear'),
+            ('Sandals', 20.00, 0, 'Footwear'), # Out of stock
+            ('Backpack', 60.00, 10, 'Bags'),
+            ('Tote', 8.00, 10, 'Bags'),
+            ('Belt', 15.00, 10, 'Accessories'),
+        ]
+    }
+    db.session.add_all(products.values())
+    db.session.flush()
+
+    return {'products': products, 'category_ids': {name: category.id for name, category in categories.items()}}
+
+# Test the shop listing filters by categories, price range and stock, and counts the products per category and price range
+@pytest.mark.parametrize('filters, expected_names, expected_categories, expected_price_ranges, expected_in_stock_count, expected_status_code', [
+    (
+        {}, ['Backpack', 'Belt', 'Running Shoes', 'Tote', 'Walking Boots'], {'Accessories': 1, 'Bags': 2, 'Footwear': 2},
+        [(None, 10, 1), (10, 25, 1), (25, 50, 1), (50, 100, 1), (100, 250, 1)], 5, 200
+    ), # Success Case: No filters
+    (
+        {'category_id': ['Footwear', 'Bags'], 'min_price': 25, 'max_price': 100}, ['Backpack', 'Running Shoes'], {'Bags': 1, 'Footwear': 1},
+        [(None, 10, 1), (25, 50, 1), (50, 100, 1), (100, 250, 1)], 2, 200
+    ), # Success Case: The category counts ignore the category filter and the price range counts ignore the price filter
+    (
+        {'category_id': ['Footwear'], 'in_stock_only': 'false'}, ['Running Shoes', 'Sandals', 'Walking Boots'], {'Accessories': 1, 'Bags': 2, 'Footwear': 3},
+        [(10, 25, 1), (25, 50, 1), (100, 250, 1)], 2, 200
+    ), # Success Case: Including the out of stock products
+    ({'min_price': 100, 'max_price': 50}, None, None, None, None, 400) # Failure Case: Invalid price range
+])
+
+def test_get_all_products_filters(test_client, filter_test_products, filters, expected_names, expected_categories, expected_price_ranges, expected_in_stock_count, expected_status_code):
+    category_ids = [filter_test_products['category_ids'][name] for name in filters.get('category_id', [])]
+    query_string = {**filters, 'category_id': category_ids, 'sort_by': 'Name (A-Z)', 'include_facets': 'true'}
+
+    response = test_client.get('/product/', query_string=query_string)
+
+    assert response.status_code == expected_status_code
+
+    if expected_status_code == 200:
+        assert [product['name'] for product in response.json['products']] == expected_names
+        assert response.json['total_products'] == len(expected_names)
+
+        facets = response.json['facets']
+        assert {facet['category_name']: facet['product_count'] for facet in facets['categories']} == expected_categories
+        assert [(facet['min_price'], facet['max_price'], facet['product_count']) for facet in facets['price_ranges']] == expected_price_ranges
+        assert facets['in_stock_count'] == expected_in_stock_count
+
+# Test the facets are counted in one query, cached per filter and invalidated when a product changes listing
+def test_product_facets_cache(fake_stripe, filter_test_products):
+    category_ids = filter_test_products['category_ids']
+
+    with capture_queries() as queries:
+        facets = ProductService.get_product_facets(category_id=category_ids['Bags'])
+
+    assert len(queries) == 1
+
+    # Paging through the listing reuses the cached facets of its filter, another filter has its own
+    with capture_queries() as queries:
+        assert ProductService.get_product_facets(category_id=category_ids['Bags']) == facets
+        ProductService.get_product_facets(category_id=category_ids['Bags'], max_price=50)
+
+    assert len(queries) == 1
+
+    # The tote sold out
+    ProductService.update_product({'stock': 0}, filter_test_products['products']['Tote'].id)
+
+    facets = ProductService.get_product_facets(category_id=category_ids['Bags'])
+
+    assert {facet['category_name']: facet['product_count'] for facet in facets['categories']} == {'Accessories': 1, 'Bags': 1, 'Footwear': 2}
+    assert facets['in_stock_count'] == 1
+
+# Fixture with products to search, across two categories
+@pytest.fixture
+def search_test_products(db_session):
+    footwear, bags = Category(name='Footwear'), Category(name='Bags')
+    db.session.add_all([footwear, bags])
+    db.session.flush()
+
+    products = {
+        name: Product(name=name, description=description, price=10.00, stock=stock, category_id=category.id)
+        for name, description, stock, category in [
+            ('Running Shoes', 'Light shoes with a leather trim', 10, footwear),
+            ('Leather Walking Boots', 'Waterproof boots for hiking', 10, footwear),
+            ('Leather Backpack', 'A backpack for every day', 10, bags),
+            ('Canvas Tote', 'A cotton bag', 10, bags),
+            ('Leather Gloves', 'Warm gloves', 0, footwear), # Out of stock
+        ]
+    }
+    db.session.add_all(products.values())
+    db.session.flush()
+
+    return {'products': products, 'footwear_id': footwear.id, 'bags_id': bags.id}
+
+# Test the product search route ranks the matches, matches the last word as a prefix and counts the matches per category
+@pytest.mark.parametrize('query, category, expected_names, expected_facets, expected_status_code', [
+    ('leather', None, ['Leather Backpack', 'Leather Walking Boots', 'Running Shoes'], {'Footwear': 2, 'Bags': 1}, 200), # Matches in the name rank above matches in the description
+    ('LEATH', None, ['Leather Backpack', 'Leather Walking Boots', 'Running Shoes'], {'Footwear': 2, 'Bags': 1}, 200), # Prefix match
+    ('hiking boots', None, ['Leather Walking Boots'], {'Footwear': 1}, 200), # Every word has to match
+    ('leather', 'bags', ['Leather Backpack'], {'Footwear': 2, 'Bags': 1}, 200), # The facets ignore the category filter
+    ('gloves', None, [], {}, 200), # Out of stock products aren't shown
+    ('  !! ', None, None, None, 400) # Failure Case: No search query
+])
+
+def test_search_products(test_client, search_test_products, query, category, expected_names, expected_facets, expected_status_code):
+    category_id = search_test_products[f'{category}_id'] if category else None
+
+    response = test_client.get('/product/search', query_string={'q': query, **({'category_id': category_id} if category_id else {})})
+
+    assert response.status_code == expected_status_code
+
+    if expected_status_code == 200:
+        assert [product['name'] for product in response.json['products']] == expected_names
+        assert {facet['category_name']: facet['product_count'] for facet in response.json['facets']} == expected_facets
+        assert response.json['total_products'] == len(expected_names)
+
+# Test the cached search results are invalidated when a product starts or stops matching
+@pytest.mark.parametrize('update_data, expected_names', [
+    ({'description': 'Sturdy boots'}, ['Leather Walking Boots', 'Canvas Tote']), # The description now matches
+    ({'stock': 0}, []), # The product sold out
+])
+
+def test_search_cache_invalidation(fake_stripe, search_test_products, update_data, expected_names):
+    products = search_test_products['products']
+
+    # Warm the cache
+    ProductService.search_products('boots')
+
+    ProductService.update_product(update_data, products['Canvas Tote' if 'description' in update_data else 'Leather Walking Boots'].id)
+
+    assert [product['name'] for product in ProductService.search_products('boots')['products']] == expected_names
+
+# Test the suggest route suggests product names for a partly typed search, tolerating typos, cached per search
+@pytest.mark.parametrize('query, limit, expected_names', [
+    ('Leather bac', 5, ['Leather Backpack', 'Leather Walking Boots']), # The prefix matches first, then the closest names fill up the suggestions
+    ('lea', 5, ['Leather Backpack', 'Leather Walking Boots', 'Running Shoes']), # Matches in the name rank above matches in the description
+    ('lea', 1, ['Leather Backpack']), # Only the top suggestions
+    ('lether', 5, ['Leather Backpack', 'Leather Walking Boots']), # Misspelt word matched by trigram similarity, out of stock products aren't suggested
+    ('canvs', 5, ['Canvas Tote']),
+    ('le', 5, []), # Too short to match as a prefix or by trigram similarity
+    ('', 5, [])
+])
+
+def test_autocomplete_products(test_client, search_test_products, query, limit, expected_names):
+    response = test_client.get('/product/suggest', query_string={'q': query, 'limit': limit})
+
+    assert response.status_code == 200
+    assert [suggestion['name'] for suggestion in response.json] == expected_names
+    assert all(suggestion.keys() == {'id', 'name'} for suggestion in response.json)
+
+    # The same search is served from the cache, also by the search autocomplete route
+    with capture_queries() as queries:
+        assert test_client.get('/product/suggest', query_string={'q': query, 'limit': limit}).json == response.json
+        assert test_client.get('/product/search/autocomplete', query_string={'q': query, 'limit': limit}).json == response.json
+
+    assert len(queries) == 0
+
+# Test the cached typo tolerant suggestions are invalidated when a product is renamed, sells out, is added or is deleted
+@pytest.mark.parametrize('change, expected_names', [
+    ('rename', ['Leather Backpack', 'Leather Tote', 'Leather Walking Boots']),
+    ('sell_out', ['Leather Backpack']),
+    ('create', ['Leather Backpack', 'Leather Belt', 'Leather Walking Boots']),
+    ('delete', ['Leather Walking Boots']),
+    ('delete_category', ['Leather Walking Boots']) # The category's products are deleted with it
+])
+
+def test_autocomplete_cache_invalidation(fake_stripe, search_test_products, change, expected_names):
+    products = search_test_products['products']
+
+    # Warm the cache
+    ProductService.autocomplete_products('lether')
+
+    if change == 'rename':
+        ProductService.update_product({'name': 'Leather Tote'}, products['Canvas Tote'].id)
+    elif change == 'sell_out':
+        ProductService.update_product({'stock': 0}, products['Leather Walking Boots'].id)
+    elif change == 'create':
+        ProductService.create_product({'name': 'Leather Belt', 'description': 'A belt', 'price': 10.00, 'stock': 10, 'category_id': search_test_products['bags_id']})
+    elif change == 'delete':
+        ProductService.delete_product(products['Leather Backpack'].id)
+    else:
+        CategoryService.delete_category(search_test_products['bags_id'])
+
+    assert [suggestion['name'] for suggestion in ProductService.autocomplete_products('lether')] == expected_names
+
 # Test the get product by id route
 @pytest.mark.parametrize('expected_status_code, auth_required', [
     (200, False), # Success Case
@@ -70,7 +372,7 @@ def test_get_product(request, test_client, expected_status_code, auth_required):
     ('valid_product_data', 403, True) # Failure Case: User not an admin
 ])
 
-def test_create_product(request, test_client, mocker, create_product_data, expected_status_code, auth_required):
+def test_create_product(request, test_client, fake_stripe, create_product_data, expected_status_code, auth_required):
     product_data = request.getfixturevalue(create_product_data)
 
     if (expected_status_code != 403):
@@ -80,16 +382,18 @@ def test_create_product(request, test_client, mocker, create_product_data, expec
         # Set the authentication cookies for a non-admin user
         auth_customer_verification(test_client, auth_required, request)
     
-    # Mock the create_stripe_product_and_price function
-    mocked_create_stripe_product_and_price = mocker.patch('services.product_service.create_stripe_product_and_price', return_value={'message': 'Product created successfully'})
-
     response = test_client.post('/product/admin', json=product_data)
 
     assert response.status_code == expected_status_code
 
     if (expected_status_code == 201):
-        # Assert that the create_stripe_product_and_price function was called
-        mocked_create_stripe_product_and_price.assert_called_once()
+        # Assert that the product was synced to Stripe
+        product = db.session.get(Product, response.json['product_id'])
+
+        assert fake_stripe.objects['products'][product.stripe_product_id]['name'] == 'Test Product'
+        assert fake_stripe.objects['prices'][product.stripe_price_id]['unit_amount'] == 1000
+    else:
+        assert fake_stripe.requests == []
 
 # Test the update product route (Admin)
 @pytest.mark.parametrize('update_product_data, expected_status_code, auth_required', [
@@ -99,7 +403,7 @@ def test_create_product(request, test_client, mocker, create_product_data, expec
     ('valid_update_product_data', 403, True) # Failure Case: User not an admin
 ])
 
-def test_update_product(request, test_client, mocker, create_test_product, update_product_data, expected_status_code, auth_required):
+def test_update_product(request, test_client, fake_stripe, create_test_product, update_product_data, expected_status_code, auth_required):
     product_data = request.getfixturevalue(update_product_data)
 
     product_id = create_test_product[0].json['product_id']
@@ -111,16 +415,21 @@ def test_update_product(request, test_client, mocker, create_test_product, updat
         # Set the authentication cookies for a non-admin user
         auth_customer_verification(test_client, auth_required, request)
     
-    # Mock the update_stripe_product function
-    mocked_update_stripe_product_and_price = mocker.patch('services.product_service.update_stripe_product_and_price', return_value={'message': 'Product updated successfully'})
+    original_price_id = db.session.get(Product, product_id).stripe_price_id
 
     response = test_client.put(f'/product/admin/{product_id}', json=product_data)
 
     assert response.status_code == expected_status_code
 
+    product = db.session.get(Product, product_id)
+
     if (expected_status_code == 200):
-        # Assert that the update_stripe_product function was called
-        mocked_update_stripe_product_and_price.assert_called_once()
+        # Assert that the Stripe product was updated and the old price replaced with the new one
+        assert fake_stripe.objects['products'][product.stripe_product_id]['name'] == 'Updated Product'
+        assert fake_stripe.objects['prices'][product.stripe_price_id]['unit_amount'] == 2000
+        assert fake_stripe.objects['prices'][original_price_id]['active'] is False
+    else:
+        assert product.stripe_price_id == original_price_id
 
 # Test the delete product route (Admin)
 @pytest.mark.parametrize('expected_status_code, auth_required', [
@@ -316,4 +625,174 @@ def test_upload_product_image(request, test_client, create_test_product, expecte
 
     assert response.status_code == expected_status_code
 
-    assert response.status_code == expected_status_code
\ No newline at end of file
+    assert response.status_code == expected_status_code
+
+# Test the product image is streamed to Google Cloud Storage in chunks rather than read into memory in one go
+@pytest.mark.parametrize('image_size, expected_chunks', [
+    (1024, 1), # Small image, a single chunk
+    (700 * 1024, 3) # Large image, sent in 256 KiB chunks
+])
+
+def test_upload_product_image_streamed(test_client, fake_gcs, fake_stripe, valid_product_data, test_admin_login, image_size, expected_chunks):
+    product_id = test_client.post('/product/admin', json=valid_product_data).json['product_id']
+    image_data = bytes(range(256)) * (image_size // 256)
+
+    response = test_client.post(f'/product/admin/product-image/{product_id}', data={'image': (io.BytesIO(image_data), 'test_image.jpg', 'image/jpeg')})
+
+    assert response.status_code == 201
+
+    image_path = ProductImage.query.filter_by(product_id=product_id).one().image_path
+    bucket_name, name = image_path.split('/', 1)
+
+    assert fake_gcs.objects[(bucket_name, name)]['data'] == image_data
+    assert fake_gcs.objects[(bucket_name, name)]['content_type'] == 'image/jpeg'
+    assert len(fake_gcs.chunks) == expected_chunks
+    assert max(fake_gcs.chunks) <= 256 * 1024
+
+# Test the browser can upload a product image straight to the bucket with a signed URL
+@pytest.mark.parametrize('signed_uploads, uploaded_content_type, image_path, expected_url_status_code, expected_confirm_status_code', [
+    (True, 'image/png', None, 200, 201), # Success Case
+    (True, None, None, 200, 400), # Failure Case: Image not uploaded to the signed URL
+    (True, 'text/html', None, 200, 400), # Failure Case: Uploaded file isn't an image
+    (True, 'image/png', 'other-bucket/test_image.png', 200, 400), # Failure Case: Image path outside the bucket
+    (False, None, None, 400, 400) # Failure Case: Signed URL uploads not enabled
+])
+
+def test_product_image_signed_upload(test_app, test_client, fake_gcs, fake_stripe, valid_product_data, test_admin_login, monkeypatch, signed_uploads, uploaded_content_type, image_path, expected_url_status_code, expected_confirm_status_code):
+    monkeypatch.setitem(test_app.config, 'GOOGLE_CLOUD_STORAGE_SIGNED_URL_UPLOADS', signed_uploads)
+    product_id = test_client.post('/product/admin', json=valid_product_data).json['product_id']
+
+    response = test_client.post(f'/product/admin/product-image/{product_id}/upload-url', json={'filename': 'test image.png', 'content_type': 'image/png'})
+
+    assert response.status_code == expected_url_status_code
+
+    if response.status_code == 200:
+        assert response.json['upload_url'].startswith(f'{fake_gcs.url}/test-bucket/')
+        assert response.json['image_path'].endswith('-test_image.png')
+
+        # Upload the image like the browser would, the API isn't involved
+        if uploaded_content_type:
+            upload_response = requests.put(response.json['upload_url'], data=b'Fake Image data', headers={'Content-Type': uploaded_content_type})
+            assert upload_response.status_code == 200
+
+        image_path = image_path or response.json['image_path']
+
+    response = test_client.post(f'/product/admin/product-image/{product_id}/confirm', json={'image_path': image_path or 'test-bucket/test_image.png'})
+
+    assert response.status_code == expected_confirm_status_code
+
+    product_image = ProductImage.query.filter_by(product_id=product_id).first()
+
+    if expected_confirm_status_code == 201:
+        assert product_image.image_path == image_path
+    else:
+        assert product_image is None
+
+        # An uploaded file that isn't an image is removed from the bucket
+        if uploaded_content_type == 'text/html':
+            assert fake_gcs.objects == {}
+
+# Test credentials without a private key, e.g. on Cloud Run, sign the upload URL with the IAM API using their access token
+def test_image_upload_url_signed_with_access_token(test_app, fake_gcs, monkeypatch, mocker):
+    credentials = compute_engine.Credentials(service_account_email='uploader@test.iam.gserviceaccount.com')
+    refresh = mocker.patch.object(credentials, 'refresh', side_effect=lambda request: setattr(credentials, 'token', 'access-token'))
+    monkeypatch.setattr('services.utils.storage_credentials', credentials)
+
+    generate_signed_url = mocker.patch('google.cloud.storage.blob.Blob.generate_signed_url', return_value='https://signed.test/upload')
+
+    with test_app.app_context():
+        upload_url, image_path = generate_image_upload_url('test.png', 'image/png')
+
+    assert upload_url == 'https://signed.test/upload'
+    assert image_path.startswith('test-bucket/')
+    refresh.assert_called_once()
+
+    signing = generate_signed_url.call_args.kwargs
+    assert signing['service_account_email'] == 'uploader@test.iam.gserviceaccount.com'
+    assert signing['access_token'] == 'access-token'
+
+# Create an image file with Pillow
+def create_image_file(mode, size, image_format):
+    image_file = io.BytesIO()
+    Image.new(mode, size).save(image_file, format=image_format)
+    image_file.seek(0)
+
+    return image_file
+
+# Test the thumbnails and WebP/AVIF variants are generated after upload and shown in the listings
+@pytest.mark.parametrize('mode, size, image_format, expected_thumbnail_size, expected_large_size', [
+    ('RGB', (2000, 1000), 'JPEG', (400, 200), (1600, 800)), # Large photo, scaled down keeping the aspect ratio
+    ('P', (300, 500), 'PNG', (240, 400), (300, 500)), # Small palette image, not made bigger
+    (None, None, None, None, None) # Failure Case: Uploaded file isn't an image, the listings show the uploaded file
+])
+
+def test_product_image_derivatives(test_client, fake_gcs, fake_stripe, valid_product_data, test_admin_login, mode, size, image_format, expected_thumbnail_size, expected_large_size):
+    product_id = test_client.post('/product/admin', json=valid_product_data).json['product_id']
+    image_file = create_image_file(mode, size, image_format) if mode else io.BytesIO(b'Fake Image data')
+
+    response = test_client.post(f'/product/admin/product-image/{product_id}', data={'image': (image_file, 'test_image.jpg', 'image/jpeg')})
+
+    assert response.status_code == 201
+
+    product_image = ProductImage.query.filter_by(product_id=product_id).one()
+    listed_image_path = test_client.get('/product/').json['products'][0]['image_path']
+
+    if not mode:
+        assert (product_image.thumbnail_path, product_image.thumbnail_avif_path, product_image.webp_path) == (None, None, None)
+        assert listed_image_path == product_image.image_path
+        assert len(fake_gcs.objects) == 1
+        return
+
+    expected_variants = [
+        (product_image.thumbnail_path, '-thumbnail.webp', 'WEBP', 'image/webp', expected_thumbnail_size),
+        (product_image.thumbnail_avif_path, '-thumbnail.avif', 'AVIF', 'image/avif', expected_thumbnail_size),
+        (product_image.webp_path, '-large.webp', 'WEBP', 'image/webp', expected_large_size)
+    ]
+
+    for image_path, suffix, expected_format, expected_content_type, expected_size in expected_variants:
+        assert image_path == product_image.image_path.rsplit('.', 1)[0] + suffix
+
+        variant = fake_gcs.objects[tuple(image_path.split('/', 1))]
+        with Image.open(io.BytesIO(variant['data'])) as variant_image:
+            assert (variant_image.format, variant_image.size) == (expected_format, expected_size)
+        assert variant['content_type'] == expected_content_type
+
+    # The listings show the thumbnail, the product page gets every variant
+    assert listed_image_path == product_image.thumbnail_path
+    assert test_client.get(f'/product/product-image/{product_id}').json['webp_path'] == product_image.webp_path
+
+    # Replacing the image removes the old image and its variants from the bucket
+    response = test_client.post(f'/product/admin/product-image/{product_id}', data={'image': (create_image_file('RGB', (100, 100), 'JPEG'), 'new_image.jpg', 'image/jpeg')})
+
+    assert response.status_code == 201
+    assert {name.split('-', 1)[1] for _, name in fake_gcs.objects} == {'new_image.jpg', 'new_image-thumbnail.webp', 'new_image-thumbnail.avif', 'new_image-large.webp'}
+
+# Test an uploaded file that can't be read as an image is recorded as failed and not queued again by the scheduled run
+@pytest.mark.parametrize('image_file', ['corrupt', 'decompression_bomb'])
+
+def test_failed_image_derivatives_not_queued_again(test_client, fake_gcs, fake_stripe, valid_product_data, test_admin_login, monkeypatch, mocker, image_file):
+    product_id = test_client.post('/product/admin', json=valid_product_data).json['product_id']
+
+    if image_file == 'corrupt':
+        image_file = io.BytesIO(b'Fake Image data')
+    else:
+        monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000) # More than twice the limit is refused as a decompression bomb
+        image_file = create_image_file('RGB', (100, 100), 'JPEG')
+
+    response = test_client.post(f'/product/admin/product-image/{product_id}', data={'image': (image_file, 'test_image.jpg', 'image/jpeg')})
+
+    assert response.status_code == 201
+
+    failed_image = ProductImage.query.filter_by(product_id=product_id).one()
+    assert failed_image.thumbnail_path is None
+    assert failed_image.derivatives_failed_at is not None
+
+    # An image uploaded before the variants were added is still queued
+    missing_image = ProductImage(image_path='test-bucket/old_image.jpg', product_id=product_id)
+    db.session.add(missing_image)
+    db.session.flush()
+
+    queue_derivatives = mocker.patch.object(ImageDerivativeService, 'queue_derivatives')
+
+    assert ImageDerivativeService.queue_missing_derivatives() == 1
+    queue_derivatives.assert_called_once_with(missing_image.id)
\ No newline at end of file
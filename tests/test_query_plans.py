@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta
+import json
+from zoneinfo import ZoneInfo
+import pytest
+from exts import db
+from models import User, Address, Cart, CartProduct, Category, Product, ProductImage, FeaturedProduct, Order, OrderItem
+from tests.utils import set_auth_cookies, capture_queries
+
+# Fixtures
+
+# Seed enough rows that a missing index would show up as a sequential scan
+@pytest.fixture
+def seed_query_plan_data(test_create_users):
+    admin, customer = test_create_users
+    now = datetime.now(tz=ZoneInfo("UTC"))
+
+    users = [
+        User(full_name=f'User {i}', email=f'user{i}@test.com', password='password', role='guest' if i % 4 == 0 else 'customer', created_at=now - timedelta(hours=i), is_verified=True)
+        for i in range(200)
+    ]
+    db.session.add_all(users)
+
+    categories = [Category(name=f'Category {i}') for i in range(25)]
+    db.session.add_all(categories)
+    db.session.flush()
+
+    db.session.add_all([Cart(user_id=user.id) for user in users])
+
+    products = [
+        Product(name=f'Product {i}', description='Test Description', price=i % 50 + 1, stock=i % 7, reserved_stock=0, category_id=categories[i % len(categories)].id)
+        for i in range(500)
+    ]
+    db.session.add_all(products)
+    db.session.flush()
+
+    db.session.add_all([ProductImage(image_path=f'https://storage.googleapis.com/test/{product.id}.jpg', product_id=product.id) for product in products])
+    db.session.add_all([FeaturedProduct(product_id=product.id) for product in products[:4]])
+
+    for user in [customer, *users]:
+        db.session.add_all([
+            Address(full_name=user.full_name, address_line_1=f'{i} Test Street', city='Test City', postcode='TE1 1ST', is_default=i == 0, user_id=user.id)
+            for i in range(3)
+        ])
+
+    customer_cart = Cart.query.filter_by(user_id=customer.id).first()
+    db.session.add_all([CartProduct(cart_id=customer_cart.id, product_id=product.id, quantity=1) for product in products[1:6]])
+
+    orders = [
+        Order(
+            order_date=now - timedelta(hours=i),
+            total_price=20,
+            status=['Processing', 'Shipped', 'Delivered'][i % 3],
+            full_name='John Doe',
+            address_line_1='123 Test Street',
+            city='Test City',
+            postcode='TE1 1ST',
+            customer_email='test@test.com',
+            stripe_session_id=f'test_session_id_{i}',
+            user_id=customer.id if i % 10 == 0 else users[i % len(users)].id
+        )
+        for i in range(1000)
+    ]
+    db.session.add_all(orders)
+    db.session.flush()
+
+    db.session.add_all([
+        OrderItem(quantity=1, price=10, name=product.name, order_id=order.id, product_id=product.id)
+        for i, order in enumerate(orders)
+        for product in (products[i % len(products)], products[(i + 1) % len(products)])
+    ])
+    db.session.flush()
+
+    # Update the planner statistics for the seeded rows
+    db.session.execute(db.text('ANALYZE'))
+
+    return {
+        'customer_id': customer.id,
+        'category_id': categories[0].id,
+        'product_id': products[1].id,
+        'session_id': 'test_session_id_500',
+    }
+
+# Get the plan of a statement with sequential scans disabled, the planner still uses one if no index can answer the query
+def explain(statement, parameters):
+    db.session.execute(db.text('SET LOCAL enable_seqscan = off'))
+
+    try:
+        plan = db.session.connection().exec_driver_sql(f'EXPLAIN (FORMAT JSON) {statement}', parameters).scalar()
+    finally:
+        db.session.execute(db.text('SET LOCAL enable_seqscan = on'))
+
+    return plan if isinstance(plan, list) else json.loads(plan)
+
+# Get the tables read with a sequential scan anywhere in a plan, reading a whole table without a filter
+# (e.g. every category) can only be a sequential scan so it is allowed at the top of the plan
+def find_sequential_scans(plan, top=True):
+    whole_table = top and 'Filter' not in plan
+    scans = [plan['Relation Name']] if plan.get('Node Type') == 'Seq Scan' and not whole_table else []
+
+    for child in plan.get('Plans', []):
+        scans.extend(find_sequential_scans(child, top=False))
+
+    return scans
+
+# Tests
+
+# Test the queries of the main read routes are answered from an index rather than a sequential scan
+@pytest.mark.parametrize('url, role', [
+    ('/product/', 'customer'), # Shop listing
+    ('/product/?category_id={category_id}', 'customer'), # Shop listing of a category
+    ('/product/?category_id={category_id}&sort_by=Price (Low to High)', 'customer'), # Sorted shop listing of a category
+    ('/product/?category_id={category_id}&min_price=10&max_price=25&include_facets=true', 'customer'), # Filtered shop listing of a category and its facets
+    ('/product/{product_id}', 'customer'), # Product
+    ('/product/featured-product', 'customer'), # Featured products
+    ('/product/search?q=Product 4', 'customer'), # Product search
+    ('/product/search?q=Product&category_id={category_id}', 'customer'), # Product search of a category
+    ('/product/search/autocomplete?q=Prod', 'customer'), # Search suggestions
+    ('/product/suggest?q=Prodct', 'customer'), # Product name suggestions for a misspelt search
+    ('/product/product-image/{product_id}', 'customer'), # Product images
+    ('/category/', 'customer'), # Categories
+    ('/address/', 'customer'), # Addresses
+    ('/address/default', 'customer'), # Default address
+    ('/cart/', 'customer'), # Cart
+    ('/order/', 'customer'), # Customer's orders
+    ('/order/stripe_session_status?session_id={session_id}', 'customer'), # Order of a Stripe session
+    ('/product/admin?cursor={cursor}', 'admin'), # Admin product listing
+    ('/product/admin?category_id={category_id}&cursor={cursor}', 'admin'), # Admin product listing of a category
+    ('/category/admin?cursor={cursor}', 'admin'), # Admin category listing
+    ('/order/admin?cursor={cursor}', 'admin'), # Admin order listing
+    ('/order/admin?status=Shipped&cursor={cursor}', 'admin'), # Admin order listing by status
+    ('/order/admin/user/{customer_id}', 'admin'), # Orders of a user
+    ('/user/admin?cursor={cursor}', 'admin'), # Admin user listing
+])
+
+def test_route_queries_use_indexes(test_client, request, seed_query_plan_data, url, role):
+    set_auth_cookies(test_client, request.getfixturevalue(f'test_{role}_login'))
+
+    # Cursor paginated routes are checked on their second page, where the cursor is compared against the index
+    if '{cursor}' in url:
+        response = test_client.get(url.format(**seed_query_plan_data, cursor=''))
+        assert response.status_code == 200
+
+        seed_query_plan_data = {**seed_query_plan_data, 'cursor': response.json['next_cursor']}
+
+    with capture_queries() as queries:
+        response = test_client.get(url.format(**seed_query_plan_data))
+
+    assert response.status_code == 200
+
+    selects = [(statement, parameters) for statement, parameters in queries if statement.lstrip().upper().startswith('SELECT')]
+    assert selects
+
+    for statement, parameters in selects:
+        plan = explain(statement, parameters)
+
+        assert find_sequential_scans(plan[0]['Plan']) == [], statement
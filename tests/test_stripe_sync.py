@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import pytest
+from sqlalchemy import update
+from exts import db
+from models import Product, StripeProductSync
+from services.stripe_sync_service import StripeSyncService
+
+# Fixtures
+
+# A product already synced to Stripe, changed since without the change being synced
+@pytest.fixture
+def changed_test_product(create_test_product):
+    product = db.session.get(Product, create_test_product[0].json['product_id'])
+    product.name = 'Changed Product'
+
+    StripeSyncService.request_product_sync([product.id])
+    db.session.commit()
+
+    return product
+
+# Tests
+
+# Test a failed sync keeps the product in the outbox and backs off before trying again
+@pytest.mark.parametrize('failures, expected_result', [
+    ([], {'synced': 1, 'failed': 0}), # Success Case
+    ([400], {'synced': 0, 'failed': 1}), # Failure Case: Stripe rejects the request
+    ([500, 500, 500], {'synced': 0, 'failed': 1}) # Failure Case: Stripe is down, after the Stripe library's own retries
+])
+
+def test_process_pending(fake_stripe, changed_test_product, failures, expected_result):
+    fake_stripe.failures.extend(failures)
+
+    result = StripeSyncService.process_pending()
+
+    assert result == expected_result
+
+    sync = db.session.get(StripeProductSync, changed_test_product.id)
+    stripe_name = fake_stripe.objects['products'][changed_test_product.stripe_product_id]['name']
+
+    if expected_result['synced']:
+        assert sync is None
+        assert stripe_name == 'Changed Product'
+    else:
+        assert sync.attempts == 1
+        assert sync.last_error
+        assert sync.locked_until is None
+        assert sync.next_attempt_at > datetime.now(tz=ZoneInfo("UTC"))
+        assert stripe_name == 'Test Product'
+
+        # The product isn't tried again until the backoff is over
+        assert StripeSyncService.process_pending() == {'synced': 0, 'failed': 0}
+
+        db.session.execute(update(StripeProductSync).values(next_attempt_at=datetime.now(tz=ZoneInfo("UTC")) - timedelta(seconds=1)))
+        db.session.commit()
+
+        assert StripeSyncService.process_pending() == {'synced': 1, 'failed': 0}
+        assert db.session.get(StripeProductSync, changed_test_product.id) is None
+        assert fake_stripe.objects['products'][changed_test_product.stripe_product_id]['name'] == 'Changed Product'
+
+# Test a product changed again while it was being synced stays in the outbox for the next run
+def test_product_changed_during_sync(fake_stripe, changed_test_product, mocker):
+    sync_product = StripeSyncService.sync_product
+
+    def sync_product_and_change(product, requested_at):
+        sync_product(product, requested_at)
+
+        StripeSyncService.request_product_sync([product.id])
+        db.session.commit()
+
+    mocker.patch.object(StripeSyncService, 'sync_product', side_effect=sync_product_and_change)
+
+    assert StripeSyncService.process_pending() == {'synced': 1, 'failed': 0}
+
+    sync = db.session.get(StripeProductSync, changed_test_product.id)
+
+    assert sync is not None
+    assert sync.locked_until is None
+
+# Test a sync retried after failing part way through doesn't create a second Stripe product or price
+def test_sync_product_idempotent(fake_stripe, create_test_category):
+    product = Product(name='Unsynced Product', description='Test Description', price=15.00, stock=10, category_id=create_test_category.json['id'])
+    db.session.add(product)
+    db.session.commit()
+
+    requested_at = datetime.now(tz=ZoneInfo("UTC"))
+
+    StripeSyncService.sync_product(product, requested_at)
+    stripe_product_id, stripe_price_id = product.stripe_product_id, product.stripe_price_id
+
+    # The Stripe ids are lost as if the worker crashed before saving them
+    product.stripe_product_id = None
+    product.stripe_price_id = None
+
+    StripeSyncService.sync_product(product, requested_at)
+
+    assert (product.stripe_product_id, product.stripe_price_id) == (stripe_product_id, stripe_price_id)
+    assert len(fake_stripe.objects['products']) == 1
+    assert len(fake_stripe.objects['prices']) == 1
+
+# Test reconcile requests a sync for products changed in Stripe and deactivates stale Stripe prices
+def test_reconcile(fake_stripe, create_four_test_products):
+    products = Product.query.order_by(Product.id).all()
+
+    # A product renamed in the Stripe dashboard
+    fake_stripe.objects['products'][products[0].stripe_product_id]['name'] = 'Renamed In Stripe'
+
+    # A price left active by a sync that failed after creating the new price
+    fake_stripe.objects['prices']['price_stale'] = {'id': 'price_stale', 'object': 'price', 'active': True, 'currency': 'gbp', 'unit_amount': 1, 'product': products[1].stripe_product_id}
+
+    result = StripeSyncService.reconcile()
+
+    assert result == {'products_checked': 4, 'products_drifted': 1, 'prices_deactivated': 1}
+    assert fake_stripe.objects['prices']['price_stale']['active'] is False
+    assert StripeSyncService.get_pending_product_ids([product.id for product in products]) == {products[0].id}
+
+    assert StripeSyncService.process_pending() == {'synced': 1, 'failed': 0}
+    assert fake_stripe.objects['products'][products[0].stripe_product_id]['name'] == products[0].name
+
+    # Nothing has drifted once the product is synced
+    assert StripeSyncService.reconcile() == {'products_checked': 4, 'products_drifted': 0, 'prices_deactivated': 0}
+
+# Test checkout charges the current price of a product waiting to be synced rather than its out of date Stripe price
+@pytest.mark.parametrize('pending_sync', [
+    False, # Synced product
+    True # Product waiting to be synced
+])
+
+def test_checkout_line_items(test_client, fake_stripe, add_test_product_to_cart, mocker, pending_sync):
+    product = Product.query.one()
+
+    if pending_sync:
+        product.price = 25.00
+        StripeSyncService.request_product_sync([product.id])
+        db.session.commit()
+
+    mocked_create_stripe_checkout_session = mocker.patch('services.order_service.create_stripe_checkout_session', return_value=mocker.Mock(id='test_session_id'))
+
+    response = test_client.post('/order/checkout', json={'full_name': 'John Doe', 'address_line_1': '123 Test Street', 'city': 'Test City', 'postcode': 'TE1 1ST'})
+
+    assert response.status_code == 200
+
+    line_items = mocked_create_stripe_checkout_session.call_args.args[2]
+
+    if pending_sync:
+        assert line_items == [{'price_data': {'currency': 'gbp', 'unit_amount': 2500, 'product': product.stripe_product_id}, 'quantity': 1}]
+    else:
+        assert line_items == [{'price': product.stripe_price_id, 'quantity': 1}]
@@ -1,5 +1,14 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 import pytest
-from tests.utils import auth_customer_verification, auth_admin_verification
+from flask_jwt_extended import create_access_token
+from sqlalchemy import delete
+from exts import db
+from models import Address, Cart, CartProduct, Category, DashboardStatistic, Order, Product, User
+from services.statistic_service import USER_COUNT_SHARDS, StatisticService
+from services.stock_service import StockService
+from services.user_service import UserService
+from tests.utils import auth_customer_verification, auth_admin_verification, capture_queries, get_all_cursor_pages
 
 # Fixtures
 
@@ -236,6 +245,30 @@ def test_authenticate_user(request, test_client, expected_status_code, auth_requ
 
     assert response.status_code == expected_status_code
 
+# Test the admin required decorator reads the role from the token, only falling back to the database for tokens without the role claim
+@pytest.mark.parametrize('user_index, role_claim, expected_status_code', [
+    (0, True, 200), # Success Case: Admin token
+    (0, False, 200), # Success Case: Admin token issued before the role claim was added
+    (1, True, 403), # Unauthorised Case: Customer token
+    (1, False, 403) # Unauthorised Case: Customer token issued before the role claim was added
+])
+
+def test_role_claim(test_app, test_client, test_create_users, user_index, role_claim, expected_status_code):
+    user = test_create_users[user_index]
+
+    with test_app.test_request_context():
+        access_token = create_access_token(identity=str(user.id), additional_claims={'role': user.role} if role_claim else None)
+
+    test_client.set_cookie('access_token', access_token)
+
+    with capture_queries() as queries:
+        response = test_client.get('/user/admin?cursor=')
+
+    assert response.status_code == expected_status_code
+
+    # The user is only looked up for tokens without the role claim
+    assert any('WHERE "User".id = ' in statement for statement, _ in queries) != role_claim
+
 # Test refresh token route
 @pytest.mark.parametrize('expected_status_code, auth_required', [
     (200, True), # Success Case
@@ -250,6 +283,36 @@ def test_refresh_token(request, test_client, expected_status_code, auth_required
 
     assert response.status_code == expected_status_code
 
+# Test refreshing the access token reads the role from the database, not from the refresh token
+@pytest.mark.parametrize('new_role, delete_user, expected_refresh_status_code, expected_admin_status_code', [
+    ('admin', False, 200, 200), # Success Case: Customer promoted to admin
+    ('customer', False, 200, 403), # Unauthorised Case: Role unchanged
+    (None, True, 400, None) # Failure Case: User deleted after logging in
+])
+
+def test_refresh_token_role(request, test_client, test_create_users, new_role, delete_user, expected_refresh_status_code, expected_admin_status_code):
+    # Log in as the customer, the refresh token carries the customer role
+    auth_customer_verification(test_client, True, request)
+
+    user = db.session.get(User, test_create_users[1].id)
+
+    if delete_user:
+        db.session.delete(user)
+    else:
+        user.role = new_role
+
+    db.session.commit()
+
+    response = test_client.post('/user/refresh')
+
+    assert response.status_code == expected_refresh_status_code
+
+    # Only a successful refresh replaces the access token
+    if response.status_code == 200:
+        response = test_client.get('/user/admin?cursor=')
+
+        assert response.status_code == expected_admin_status_code
+
 # Test logout user route
 @pytest.mark.parametrize('expected_status_code, auth_required', [
     (200, True), # Success Case
@@ -413,6 +476,170 @@ def test_get_dashboard_data(request, test_client, expected_status_code, auth_req
 
     assert response.status_code == expected_status_code
 
+# Test the admin users route with cursor pagination returns every user once, latest first
+@pytest.mark.parametrize('guest_count, expected_pages', [
+    (0, 1), # Only the admin and customer
+    (8, 1),
+    (20, 3)
+])
+
+def test_get_all_admin_users_by_cursor(test_client, test_admin_login, guest_count, expected_pages):
+    created_at = datetime.now(tz=ZoneInfo("UTC")) - timedelta(days=1)
+
+    # Guests created at the same time are ordered by id
+    for i in range(guest_count):
+        db.session.add(User(full_name='Guest', password='password', role='guest', created_at=created_at))
+    db.session.flush()
+
+    users, pages = get_all_cursor_pages(test_client, '/user/admin', 'users')
+
+    assert pages == expected_pages
+    assert len(users) == guest_count + 2
+    assert len({user['id'] for user in users}) == guest_count + 2
+
+    response = test_client.get('/user/admin?cursor=&include_total=true')
+    assert response.json['total_users'] == guest_count + 2
+
+# Test the dashboard statistics are kept up to date as users and orders change, and match a rebuild from the tables
+@pytest.mark.parametrize('new_status', ['Shipped', 'Delivered'])
+
+def test_dashboard_statistics(test_client, mocker, create_test_order, new_status):
+    year = datetime.now(tz=ZoneInfo("UTC")).year
+
+    # The fixture users were created directly in the database, so start from a rebuild
+    StatisticService.rebuild()
+    assert StatisticService.get_dashboard_statistics(year)['orders_overall'] == 1
+
+    # Create a guest, update the order status and delete a guest
+    mocker.patch('services.order_service.send_email')
+    UserService.create_guest_user()
+    guest_id, _ = UserService.create_guest_user()
+
+    order = Order.query.first()
+    response = test_client.put(f'/order/admin/{order.id}', json={'status': new_status, 'tracking_url': 'https://tracking.test'})
+    assert response.status_code == 200
+
+    db.session.get(User, guest_id).created_at = datetime.now(tz=ZoneInfo("UTC")) - timedelta(days=30)
+    db.session.flush()
+    UserService.delete_old_guest_users(7)
+
+    statistics = StatisticService.get_dashboard_statistics(year)
+
+    assert statistics['total_users'] == 3
+    assert statistics['ongoing_orders'] == (1 if new_status == 'Shipped' else 0)
+    assert statistics['orders_overall'] == 1
+    assert statistics['total_revenue'] == 100.00
+    assert sum(statistics['graph_data'].values()) == 1
+
+    # The dashboard route serves the statistics, and they match a rebuild from the tables
+    response = test_client.get('/user/admin/dashboard')
+    assert response.status_code == 200
+    assert response.json['total_users'] == statistics['total_users']
+
+    StatisticService.rebuild()
+    assert StatisticService.get_dashboard_statistics(year) == statistics
+
+# Test the user count is spread over several rows, so concurrent guest users don't all wait for the lock on one row
+def test_users_statistic_shards(test_create_users):
+    year = datetime.now(tz=ZoneInfo("UTC")).year
+    StatisticService.rebuild()
+
+    for _ in range(32):
+        StatisticService.record_users_created()
+
+    StatisticService.record_users_deleted(2)
+    db.session.flush()
+
+    shards = DashboardStatistic.query.filter(DashboardStatistic.name.like('total_users:%')).count()
+
+    assert 1 < shards <= USER_COUNT_SHARDS
+    assert StatisticService.get_dashboard_statistics(year)['total_users'] == 2 + 32 - 2
+
+# Test deleting expired guest users in batches
+@pytest.mark.parametrize('batch_size, expected_batches', [
+    (1000, 1),
+    (2, 3), # The last batch is smaller than the batch size
+    (5, 1),
+])
+
+def test_delete_old_guest_users(test_create_users, batch_size, expected_batches):
+    now = datetime.now(tz=ZoneInfo("UTC"))
+
+    category = Category(name='Test Category')
+    db.session.add(category)
+    db.session.flush()
+
+    product = Product(name='Test Product', description='Test Description', price=10.00, stock=20, reserved_stock=10, category_id=category.id)
+    db.session.add(product)
+    db.session.flush()
+
+    # Five expired guests each with a cart holding two of the product, and one recent guest
+    guests = []
+    for days in [8, 9, 10, 10, 30, 1]:
+        guest = User(full_name='Guest', password='password', role='guest', created_at=now - timedelta(days=days))
+        db.session.add(guest)
+        db.session.flush()
+
+        cart = Cart(user_id=guest.id)
+        db.session.add(cart)
+        db.session.flush()
+
+        db.session.add(CartProduct(quantity=2, product_id=product.id, cart_id=cart.id))
+        guests.append(guest)
+
+    expired_guest, recent_guest = guests[0], guests[-1]
+
+    # An expired guest with an address and an order
+    db.session.add(Address(full_name='Guest', address_line_1='1 Test Street', city='Test City', postcode='TE1 1ST', is_default=True, user_id=expired_guest.id))
+    order = Order(order_date=now - timedelta(days=8), total_price=10.00, status='Delivered', full_name='Guest', address_line_1='1 Test Street', city='Test City', postcode='TE1 1ST', customer_email='guest@test.com', stripe_session_id='session', user_id=expired_guest.id)
+    db.session.add(order)
+    db.session.flush()
+
+    guest_ids = [guest.id for guest in guests]
+    order_id = order.id
+    db.session.expunge_all()
+
+    result = UserService.delete_old_guest_users(7, batch_size=batch_size)
+
+    assert result == {'users_deleted': 5, 'quantity_released': 10, 'batches': expected_batches}
+
+    # Only the recent guest and the registered users are left
+    assert [user.id for user in User.query.filter(User.id.in_(guest_ids)).all()] == [recent_guest.id]
+    assert User.query.filter(User.role != 'guest').count() == 2
+
+    # The expired guests carts and addresses are deleted, and their reserved stock released
+    assert Cart.query.filter(Cart.user_id.in_(guest_ids)).count() == 1
+    assert Address.query.count() == 0
+    assert db.session.get(Product, product.id).reserved_stock == 0
+
+    # The order is kept without a user
+    assert db.session.get(Order, order_id).user_id is None
+
+# Test a guest deleted while the batch is being deleted, e.g. by an overlapping run, isn't counted
+def test_delete_old_guest_users_concurrently_deleted(test_create_users, mocker):
+    now = datetime.now(tz=ZoneInfo("UTC"))
+
+    guests = [User(full_name='Guest', password='password', role='guest', created_at=now - timedelta(days=days)) for days in [8, 9, 10]]
+    db.session.add_all(guests)
+    db.session.flush()
+
+    concurrently_deleted_id = guests[0].id
+    db.session.expunge_all()
+
+    release_reserved_stock_for_carts = StockService.release_reserved_stock_for_carts
+
+    # Delete one of the guests after the batch has been selected
+    def delete_guest(carts):
+        db.session.execute(delete(User).where(User.id == concurrently_deleted_id))
+        return release_reserved_stock_for_carts(carts)
+
+    mocker.patch.object(StockService, 'release_reserved_stock_for_carts', side_effect=delete_guest)
+
+    result = UserService.delete_old_guest_users(7)
+
+    assert result == {'users_deleted': 2, 'quantity_released': 0, 'batches': 1}
+    assert User.query.filter_by(role='guest').count() == 0
+
 # # Test delete guest users route (Admin)
 # @pytest.mark.parametrize('expected_status_code, auth_required', [
 #     (200, True), # Success Case
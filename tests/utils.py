@@ -1,4 +1,12 @@
-from sqlalchemy import text
+from contextlib import contextmanager
+import hashlib
+import hmac
+import json
+import time
+import uuid
+from sqlalchemy import text, event
+from sqlalchemy.orm import Session
+from exts import db
 
 # Set the authentication cookies
 def set_auth_cookies(client, cookies):
@@ -23,4 +31,86 @@ def auth_admin_verification(test_client, auth_required, request):
     # If auth required is false, unset the authentication cookies
     if not auth_required:
         # Unset the authetication cookies
-        test_logout = request.getfixturevalue('test_logout')
\ No newline at end of file
+        test_logout = request.getfixturevalue('test_logout')
+
+# Record every SQL statement and its parameters executed against the database inside the with block
+@contextmanager
+def capture_queries():
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        queries.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+    try:
+        yield queries
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+# Record every session commit made inside the with block
+@contextmanager
+def count_commits():
+    commits = []
+
+    def after_commit(session):
+        commits.append(session)
+
+    event.listen(Session, 'after_commit', after_commit)
+
+    try:
+        yield commits
+    finally:
+        event.remove(Session, 'after_commit', after_commit)
+
+# Follow the next cursors of a cursor paginated route from the first page, returning every item and the number of pages
+def get_all_cursor_pages(client, url, key):
+    items = []
+    pages = 0
+    cursor = ''
+
+    while cursor is not None:
+        separator = '&' if '?' in url else '?'
+        response = client.get(f'{url}{separator}cursor={cursor}')
+
+        assert response.status_code == 200
+
+        items.extend(response.json[key])
+        pages += 1
+        cursor = response.json['next_cursor']
+
+    return items, pages
+
+# Build a Stripe event, the data object is e.g. a checkout session
+def build_stripe_event(event_type, data_object, event_id=None):
+    return {
+        'id': event_id or f'evt_{uuid.uuid4().hex}',
+        'object': 'event',
+        'type': event_type,
+        'data': {'object': data_object}
+    }
+
+# Build a completed checkout session of the user's cart
+def build_checkout_session(user_id, session_id='test_session_id'):
+    return {
+        'id': session_id,
+        'object': 'checkout.session',
+        'customer': 'cus_test',
+        'customer_details': {'email': 'test@test.com'},
+        'metadata': {
+            'user_id': str(user_id),
+            'full_name': 'John Doe',
+            'address_line_1': '123 Test Street',
+            'address_line_2': 'Test Area',
+            'city': 'Test City',
+            'postcode': 'TE1 1ST'
+        }
+    }
+
+# Post a Stripe event to the webhook route, signed with the test webhook secret like Stripe would
+def post_stripe_event(client, event, secret='whsec_test'):
+    payload = json.dumps(event)
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+
+    return client.post('/order/webhook', data=payload, headers={'Stripe-Signature': f't={timestamp},v1={signature}', 'Content-Type': 'application/json'})